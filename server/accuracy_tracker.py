@@ -0,0 +1,66 @@
+"""Incremental engine-match counts of games in progress, keyed by move prefix."""
+import threading
+
+from collections import OrderedDict
+
+# Local
+from constants import ACCURACY_CACHE_SIZE
+
+
+class AccuracyTracker:
+    """
+    A process-level LRU cache mapping a game prefix (UCI moves) to the number of
+    moves in it that matched the engine's best move. A request for a game that
+    has been seen before only needs engine searches for the plies played since.
+    """
+
+    capacity: int = 0  # Maximum number of game prefixes kept in memory
+
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self._entries: OrderedDict = OrderedDict()  # Space separated UCI prefix -> match count
+        self._lock = threading.Lock()
+        self._counters = {"plies_reused": 0, "plies_evaluated": 0}
+
+    def lookup(self, move_sequence_in_uci: str) -> tuple[int, int]:
+        """
+        Find the longest recorded prefix of a game, given as space separated UCI moves.
+        Returns (number of plies in the prefix, number of matching moves in it).
+        """
+        prefix = move_sequence_in_uci
+        with self._lock:
+            while prefix:
+                player_score = self._entries.get(prefix)
+                if player_score is not None:
+                    self._entries.move_to_end(prefix)
+                    return prefix.count(" ") + 1, player_score
+                prefix = prefix[:max(0, prefix.rfind(" "))]
+        return 0, 0
+
+    def record(self, move_sequence_in_uci: str, ply_count: int, player_score: int, plies_evaluated: int = 0):
+        """
+        Store the match count of a game prefix of ply_count space separated UCI moves.
+        """
+        with self._lock:
+            self._counters["plies_evaluated"] += plies_evaluated
+            self._counters["plies_reused"] += ply_count - plies_evaluated
+            if not move_sequence_in_uci:
+                return
+            self._entries[move_sequence_in_uci] = player_score
+            self._entries.move_to_end(move_sequence_in_uci)
+            # Evict the least recently used prefixes
+            while len(self._entries) > self.capacity:
+                self._entries.popitem(last=False)
+
+    def stats(self) -> dict:
+        """
+        Return reuse counters and current occupancy.
+        """
+        with self._lock:
+            stats_dict = dict(self._counters)
+            stats_dict["resident_prefixes"] = len(self._entries)
+        return stats_dict
+
+
+# Process-wide tracker shared by all requests
+accuracy_tracker = AccuracyTracker(ACCURACY_CACHE_SIZE)
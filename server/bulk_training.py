@@ -0,0 +1,329 @@
+"""
+Bulk persona building: ingestion, opening book and model training for many
+users, scheduled across a pool of worker processes.
+
+Run from the server directory:
+
+    python bulk_training.py user1 user2 ... [--file usernames.txt] [--priority 0]
+"""
+import argparse
+import heapq
+import itertools
+import multiprocessing
+import os
+import resource
+import threading
+import time
+
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+# Local
+from constants import (
+    BULK_TRAINING_MAX_ATTEMPTS,
+    BULK_TRAINING_MAX_CONCURRENT_FETCHES,
+    BULK_TRAINING_MEMORY_LIMIT_BYTES,
+    BULK_TRAINING_RETRY_DELAY_SECONDS,
+    BULK_TRAINING_THREADS_PER_JOB,
+    BULK_TRAINING_WORKERS,
+)
+
+# Set in each worker process by init_worker
+__fetch_semaphore__ = None
+__threads_per_job__ = None
+
+
+def init_worker(fetch_semaphore, threads_per_job: int, memory_limit_bytes: int):
+    """
+    Apply the per-job resource caps in a freshly started worker process.
+    """
+    global __fetch_semaphore__, __threads_per_job__
+    __fetch_semaphore__ = fetch_semaphore
+    __threads_per_job__ = threads_per_job
+    # Numeric libraries size their thread pools from these when they load
+    for variable_name in ("OMP_NUM_THREADS", "OPENBLAS_NUM_THREADS", "MKL_NUM_THREADS"):
+        os.environ[variable_name] = str(threads_per_job)
+    if memory_limit_bytes:
+        # Caps the heap; address space limits break TensorFlow's large virtual reservations
+        resource.setrlimit(resource.RLIMIT_DATA,
+                           (memory_limit_bytes, memory_limit_bytes))
+
+
+def build_persona(lichess_username: str, train_model: bool) -> dict:
+    """
+    Ingest the games of a user, rebuild their opening book and train their model.
+    Runs inside a worker process.
+    """
+    # Imported here so the scheduler process never loads TensorFlow
+    from scripts.util import ingest_games_by_username, write_move_tree
+    from scripts.train_persona_model import train_persona_model
+
+    start_time = time.perf_counter()
+    # Only a bounded number of workers talk to Lichess at once
+    with __fetch_semaphore__:
+        added_game_count = ingest_games_by_username(lichess_username)
+    write_move_tree(lichess_username)
+    version_directory = None
+    if train_model:
+        version_directory = train_persona_model(
+            lichess_username, threads=__threads_per_job__)
+    return {
+        "added_games": added_game_count,
+        "model_version": os.path.basename(version_directory) if version_directory else None,
+        "seconds": time.perf_counter() - start_time,
+    }
+
+
+class BulkTrainingTask:
+    """
+    A persona build waiting in or running from the bulk training queue.
+    """
+
+    lichess_username: str = None  # Username whose persona is built
+    priority: int = 0  # Lower values run first
+    train_model: bool = True  # Whether to train the model after ingestion
+    status: str = "QUEUED"  # QUEUED, RUNNING, COMPLETE or FAILED
+    attempts: int = 0  # Number of times the build was started
+    not_before: float = 0.0  # Monotonic time before which a retry is not started
+    error: str = None  # Error of the last failed attempt
+    result: dict = None  # Summary returned by the last successful attempt
+
+    def __init__(self, lichess_username: str, priority: int, train_model: bool):
+        self.lichess_username = lichess_username
+        self.priority = priority
+        self.train_model = train_model
+
+    def to_dict(self) -> dict:
+        """
+        Return the task as a progress entry.
+        """
+        return {
+            "lichess_username": self.lichess_username,
+            "priority": self.priority,
+            "status": self.status,
+            "attempts": self.attempts,
+            "error": self.error,
+            "result": self.result,
+        }
+
+
+class BulkTrainingScheduler:
+    """
+    A priority queue of persona builds executed on a process pool. Each worker
+    process runs one build and is then replaced, so thread and memory caps
+    apply per job and nothing leaks from one user to the next. Failed builds
+    are retried after a delay up to max_attempts times.
+    """
+
+    def __init__(
+        self,
+        worker_count: int = BULK_TRAINING_WORKERS,
+        threads_per_job: int = BULK_TRAINING_THREADS_PER_JOB,
+        memory_limit_bytes: int = BULK_TRAINING_MEMORY_LIMIT_BYTES,
+        max_concurrent_fetches: int = BULK_TRAINING_MAX_CONCURRENT_FETCHES,
+        max_attempts: int = BULK_TRAINING_MAX_ATTEMPTS,
+        retry_delay_seconds: float = BULK_TRAINING_RETRY_DELAY_SECONDS
+    ):
+        self.worker_count = worker_count
+        self.max_attempts = max_attempts
+        self.retry_delay_seconds = retry_delay_seconds
+        # Fork is unsafe once threads are running, so workers are spawned
+        process_context = multiprocessing.get_context("spawn")
+        self._executor = ProcessPoolExecutor(
+            max_workers=worker_count,
+            mp_context=process_context,
+            max_tasks_per_child=1,
+            initializer=init_worker,
+            initargs=(
+                process_context.BoundedSemaphore(max_concurrent_fetches),
+                threads_per_job,
+                memory_limit_bytes,
+            )
+        )
+        self._queue: list = []  # Heap of (priority, sequence number, task)
+        self._sequence = itertools.count()
+        self._tasks: dict[str, BulkTrainingTask] = {}  # Username -> latest task
+        self._running: dict = {}  # Future -> task
+        self._condition = threading.Condition()
+        self._dispatcher_thread: threading.Thread = None
+        self._started_at = time.monotonic()
+
+    def submit(self, lichess_username_list: list[str], priority: int = 0, train_model: bool = True) -> list[BulkTrainingTask]:
+        """
+        Queue persona builds. Users already queued or running keep their existing task.
+        """
+        task_list = []
+        with self._condition:
+            for lichess_username in lichess_username_list:
+                task = self._tasks.get(lichess_username)
+                if task is None or task.status in ("COMPLETE", "FAILED"):
+                    task = BulkTrainingTask(
+                        lichess_username, priority, train_model)
+                    self._tasks[lichess_username] = task
+                    heapq.heappush(
+                        self._queue, (priority, next(self._sequence), task))
+                task_list.append(task)
+            self._ensure_dispatcher()
+            self._condition.notify()
+        return task_list
+
+    def _ensure_dispatcher(self):
+        """
+        Start the dispatcher thread on first use. Caller must hold the condition.
+        """
+        if self._dispatcher_thread is None:
+            self._dispatcher_thread = threading.Thread(
+                target=self._dispatch_forever,
+                name="bulk-training-dispatcher",
+                daemon=True
+            )
+            self._dispatcher_thread.start()
+
+    def _pop_ready_task(self) -> BulkTrainingTask:
+        """
+        Take the highest priority task whose retry delay has passed. Caller must hold the condition.
+        """
+        now = time.monotonic()
+        deferred_entry_list = []
+        ready_task = None
+        while self._queue:
+            entry = heapq.heappop(self._queue)
+            if entry[2].not_before <= now:
+                ready_task = entry[2]
+                break
+            deferred_entry_list.append(entry)
+        for entry in deferred_entry_list:
+            heapq.heappush(self._queue, entry)
+        return ready_task
+
+    def _dispatch_forever(self):
+        """
+        Keep every worker busy with the best ready task and record finished builds.
+        """
+        while True:
+            with self._condition:
+                while len(self._running) < self.worker_count:
+                    task = self._pop_ready_task()
+                    if task is None:
+                        break
+                    task.status = "RUNNING"
+                    task.attempts += 1
+                    future = self._executor.submit(
+                        build_persona, task.lichess_username, task.train_model)
+                    self._running[future] = task
+                if not self._running:
+                    # Nothing in flight: sleep until work arrives or a retry is due
+                    self._condition.wait(timeout=self.retry_delay_seconds)
+                    continue
+                running_future_list = list(self._running)
+
+            done_future_set, _ = wait(
+                running_future_list, timeout=1.0, return_when=FIRST_COMPLETED)
+
+            with self._condition:
+                for future in done_future_set:
+                    task = self._running.pop(future)
+                    try:
+                        task.result = future.result()
+                        task.error = None
+                        task.status = "COMPLETE"
+                    except Exception as ex:
+                        task.error = f"{type(ex).__name__}: {ex}"
+                        if task.attempts < self.max_attempts:
+                            task.status = "QUEUED"
+                            task.not_before = time.monotonic() + self.retry_delay_seconds
+                            heapq.heappush(
+                                self._queue, (task.priority, next(self._sequence), task))
+                        else:
+                            task.status = "FAILED"
+                self._condition.notify_all()
+
+    def wait_until_idle(self, progress_interval_seconds: float = None):
+        """
+        Block until every queued build has completed or failed, optionally printing progress.
+        """
+        last_progress_time = time.monotonic()
+        with self._condition:
+            while self._queue or self._running:
+                self._condition.wait(timeout=progress_interval_seconds)
+                if progress_interval_seconds and time.monotonic() - last_progress_time >= progress_interval_seconds:
+                    print(self.summary(include_tasks=False))
+                    last_progress_time = time.monotonic()
+
+    def summary(self, include_tasks: bool = True) -> dict:
+        """
+        Return the number of builds per status and, optionally, every task.
+        """
+        with self._condition:
+            task_list = list(self._tasks.values())
+        status_count_dict = {status: 0 for status in (
+            "QUEUED", "RUNNING", "COMPLETE", "FAILED")}
+        for task in task_list:
+            status_count_dict[task.status] += 1
+        summary_dict = {
+            "counts": status_count_dict,
+            "elapsed_seconds": time.monotonic() - self._started_at,
+        }
+        if include_tasks:
+            summary_dict["tasks"] = [task.to_dict() for task in task_list]
+        return summary_dict
+
+
+__bulk_training_scheduler__: BulkTrainingScheduler = None
+__bulk_training_scheduler_lock__ = threading.Lock()
+
+
+def get_bulk_training_scheduler() -> BulkTrainingScheduler:
+    """
+    Return the process-wide bulk training scheduler, creating it on first use.
+    """
+    global __bulk_training_scheduler__
+    with __bulk_training_scheduler_lock__:
+        if __bulk_training_scheduler__ is None:
+            __bulk_training_scheduler__ = BulkTrainingScheduler()
+    return __bulk_training_scheduler__
+
+
+def main():
+    """
+    Main function to build the personas of many users from the command line.
+    """
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("lichess_usernames", nargs="*")
+    parser.add_argument("--file", help="File with one username per line")
+    parser.add_argument("--priority", type=int, default=0,
+                        help="Lower values run first")
+    parser.add_argument("--skip-model", action="store_true",
+                        help="Only ingest games and build opening books")
+    parser.add_argument("--workers", type=int, default=BULK_TRAINING_WORKERS)
+    parser.add_argument("--threads-per-job", type=int,
+                        default=BULK_TRAINING_THREADS_PER_JOB)
+    parser.add_argument("--max-concurrent-fetches", type=int,
+                        default=BULK_TRAINING_MAX_CONCURRENT_FETCHES)
+    args = parser.parse_args()
+
+    lichess_username_list = list(args.lichess_usernames)
+    if args.file:
+        with open(args.file, "r") as username_file:
+            lichess_username_list.extend(
+                line.strip() for line in username_file if line.strip())
+
+    bulk_training_scheduler = BulkTrainingScheduler(
+        worker_count=args.workers,
+        threads_per_job=args.threads_per_job,
+        max_concurrent_fetches=args.max_concurrent_fetches
+    )
+    bulk_training_scheduler.submit(
+        lichess_username_list,
+        priority=args.priority,
+        train_model=not args.skip_model
+    )
+    bulk_training_scheduler.wait_until_idle(progress_interval_seconds=30)
+    summary_dict = bulk_training_scheduler.summary()
+    for task_dict in summary_dict["tasks"]:
+        print(task_dict)
+    print(summary_dict["counts"])
+
+
+# Run the main function if this script is run as the main module
+if __name__ == "__main__":
+    main()
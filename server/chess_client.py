@@ -1,16 +1,62 @@
-import re
+import logging
+import threading
+import time
 import chess
-import pandas as pd
 
-from stockfish import Stockfish
+from bisect import bisect_right
+from contextlib import ExitStack
 
 # Local
-from constants import STOCKFISH_PATH
-from llm_client import LLMClient
-from scripts.util import make_prediction_using_model
+from accuracy_tracker import accuracy_tracker
+from constants import ENGINE_SEARCH_DEPTH, MODEL_DECODING_MODE, MODEL_TOP_K
+from engine_cache import engine_cache, position_key
+from engine_pool import MAX_SKILL_LEVEL, UCIEngine, get_engine_pool, normalize_skill_level
+from llm_client import LLMClient, get_llm_client
+from metrics import model_fallback_count, next_move_latency, time_stage
+from opening_book import OpeningBook, normalize_san
+from scripts.util import make_prediction_using_model, make_ranked_prediction_using_model
 
-# Initialize Stockfish with the given path
-__stockfish__ = Stockfish(STOCKFISH_PATH)
+logger = logging.getLogger(__name__)
+
+
+class MoveSourceStats:
+    """
+    Process-wide counts of where next moves came from and how often the model
+    prediction had to fall back to the engine.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = {
+            "cache": 0,
+            "model": 0,
+            "stockfish": 0,
+            "model_fallbacks": 0,  # Model predictions that failed or had no legal move
+        }
+
+    def record(self, source: str, model_fallback: bool = False):
+        """
+        Count a next move by its source.
+        """
+        with self._lock:
+            self._counters[source] += 1
+            if model_fallback:
+                self._counters["model_fallbacks"] += 1
+
+    def stats(self) -> dict:
+        """
+        Return the counters and the share of model attempts that fell back to the engine.
+        """
+        with self._lock:
+            stats_dict = dict(self._counters)
+        model_attempts = stats_dict["model"] + stats_dict["model_fallbacks"]
+        stats_dict["model_fallback_rate"] = stats_dict["model_fallbacks"] / \
+            model_attempts if model_attempts else 0.0
+        return stats_dict
+
+
+# Process-wide counters shared by all requests
+move_source_stats = MoveSourceStats()
 
 
 class ChessClient:
@@ -22,138 +68,279 @@ class ChessClient:
     move_list_in_san: list[str] = []  # List of moves in Standard Algebraic Notation (SAN)
     move_list_in_uci: list[str] = []  # List of moves in Universal Chess Interface (UCI)
     lichess_username: str = None  # Username of the player on Lichess
-    llm_client: LLMClient = None  # Client for Lichess Ladder Monitor (LLM)
+    board: chess.Board = None  # Board after the last move
+    normalized_san_list: list[str] = None  # The SAN moves as the model reads them: without special characters
+    reset_ply_list: list[int] = None  # Plies after which the halfmove clock restarted (a capture or pawn move)
+    reset_fen_list: list[str] = None  # FEN after each of those plies, None for the starting position
+    position_key_list: list[str] = None  # Engine cache key of the position after each ply, once a search needed them
+    engine: UCIEngine = None  # Engine checked out by the current Stockfish search, if any
+    opening_book: OpeningBook = None  # Opening book that book_node refers to
+    book_node: int = None  # Opening book node of the current position, None once the game left the book
+    book_ply_count: int = 0  # Number of plies book_node accounts for
+    graded_ply_count: int = 0  # Number of plies compared with the engine's best move
+    player_score: int = 0  # Number of graded plies that matched the engine's best move
 
     def __init__(self, move_list_in_san: list[str], lichess_username: str):
         """
         Initialize the ChessClient with a list of moves in SAN and a Lichess username.
         """
-        self.move_list_in_san = move_list_in_san
-        self.move_list_in_uci = self.san_to_uci()
         self.lichess_username = lichess_username
-        self.llm_client = LLMClient()
+        self.board = chess.Board()
+        self.move_list_in_san = []
+        self.move_list_in_uci = []
+        self.normalized_san_list = []
+        self.reset_ply_list = [0]
+        self.reset_fen_list = [None]
+        with time_stage("board_replay"):
+            for san in move_list_in_san:
+                self.push_san(san)
+
+    @property
+    def llm_client(self) -> LLMClient:
+        """
+        The shared LLM client, built the first time a request needs it.
+        """
+        return get_llm_client()
 
-    def san_to_uci(self):
+    def push_san(self, san: str) -> str:
         """
-        Convert a list of moves from Standard Algebraic Notation (SAN) to Universal Chess Interface (UCI).
+        Play a move in Standard Algebraic Notation (SAN) and return it in Universal Chess Interface (UCI).
+        Raises ValueError if the move is not legal. Blank moves are ignored and return None.
+        """
+        san = san.strip()
+        if san == "":
+            return None
+        # Convert the SAN move to a move object and make it on the board
+        move = self.board.parse_san(san)
+        self.board.push(move)
+        self.move_list_in_san.append(san)
+        self.move_list_in_uci.append(move.uci())
+        self.normalized_san_list.append(normalize_san(san))
+        if self.board.halfmove_clock == 0:
+            # Earlier positions can never repeat, so engines only need the moves from here on
+            self.reset_ply_list.append(len(self.move_list_in_uci))
+            self.reset_fen_list.append(self.board.fen())
+        # Once computed, the position keys are kept up to date one ply at a time
+        if self.position_key_list is not None:
+            self.position_key_list.append(position_key(self.board))
+        return move.uci()
+
+    def pop_san(self) -> str:
+        """
+        Take back the last move and return it in SAN. The opening book node and the
+        engine-match score are recomputed by the next request that needs them.
+        """
+        self.board.pop()
+        if self.reset_ply_list[-1] == len(self.move_list_in_uci):
+            self.reset_ply_list.pop()
+            self.reset_fen_list.pop()
+        self.move_list_in_uci.pop()
+        self.normalized_san_list.pop()
+        if self.position_key_list is not None:
+            self.position_key_list.pop()
+        if self.book_ply_count > len(self.move_list_in_uci):
+            # Book nodes only link to their children, so walk again from the root
+            self.opening_book = None
+        if self.graded_ply_count > len(self.move_list_in_uci):
+            self.graded_ply_count = 0
+            self.player_score = 0
+        return self.move_list_in_san.pop()
+
+    def position_keys(self) -> list[str]:
+        """
+        Return the cache key of the position before each move and after the last one.
         """
-        # If no board is provided, create a new one
         board = chess.Board()
-        uci_moves = []
-        for san in self.move_list_in_san:
-            san = san.strip()
-            if san == "":
-                continue
-            # Convert the SAN move to a move object
-            move = board.parse_san(san)
-            # Convert the move object to UCI format
-            uci = move.uci()
-            uci_moves.append(uci)
-            # Make the move on the board
-            board.push(move)
-        return uci_moves
-
-    def determine_stockfish_intelligence_level(self):
+        position_key_list = [position_key(board)]
+        for move in self.move_list_in_uci:
+            board.push_uci(move)
+            position_key_list.append(position_key(board))
+        return position_key_list
+
+    def engine_best_move(self, ply_count: int, skill_level: float, engine_checkout: ExitStack) -> str:
+        """
+        Return the engine's best move after the first ply_count moves, from the engine cache if possible.
+        An engine is only checked out, into engine_checkout, once a position misses the cache.
+        """
+        skill_level = normalize_skill_level(skill_level)
+        position = self.position_key_list[ply_count]
+        found, best_move = engine_cache.get(
+            position, skill_level, ENGINE_SEARCH_DEPTH)
+        if found:
+            return best_move
+
+        if self.engine is None:
+            self.engine = engine_checkout.enter_context(
+                get_engine_pool().checkout())
+        self.engine.configure(skill_level=skill_level, depth=ENGINE_SEARCH_DEPTH)
+        # Start from the last capture or pawn move, so the position sent stays short in long games
+        reset_index = bisect_right(self.reset_ply_list, ply_count) - 1
+        best_move = self.engine.best_move(
+            self.move_list_in_uci[self.reset_ply_list[reset_index]:ply_count],
+            start_fen=self.reset_fen_list[reset_index])
+        engine_cache.put(position, skill_level, ENGINE_SEARCH_DEPTH, best_move)
+        return best_move
+
+    def determine_stockfish_intelligence_level(self, engine_checkout: ExitStack):
         """
         Evaluate a sequence of moves using Stockfish and determine the intelligence level of the player.
         """
-        # Reset the board to the initial position
-        __stockfish__.set_position([])
-        player_score = 0  # Initialize player score
-        for move in self.move_list_in_uci:
-            best_move = __stockfish__.get_best_move()
+        if self.graded_ply_count == 0:
+            # Resume from the longest prefix of this game graded by an earlier request
+            self.graded_ply_count, self.player_score = accuracy_tracker.lookup(
+                " ".join(self.move_list_in_uci))
+        known_ply_count = self.graded_ply_count
+        for move_index in range(known_ply_count, len(self.move_list_in_uci)):
+            move = self.move_list_in_uci[move_index]
+            # Grade the moves against the engine at full strength
+            best_move = self.engine_best_move(
+                move_index, MAX_SKILL_LEVEL, engine_checkout)
             if move == best_move:
-                player_score += 1  # Increment score if the player's move matches Stockfish's best move
-            __stockfish__.make_moves_from_current_position([move])
+                self.player_score += 1  # Increment score if the player's move matches Stockfish's best move
+            self.graded_ply_count = move_index + 1
+        accuracy_tracker.record(
+            " ".join(self.move_list_in_uci),
+            len(self.move_list_in_uci),
+            self.player_score,
+            plies_evaluated=len(self.move_list_in_uci) - known_ply_count
+        )
         # Calculate the intelligence level as a percentage
         intelligence_level = (
-            player_score / len(self.move_list_in_uci)
+            self.player_score / len(self.move_list_in_uci)
         ) * 100 if self.move_list_in_uci else 20
         if intelligence_level > 12:
             intelligence_level -= 4
         return intelligence_level
 
-    def cache_search(self, partial_sequence_str: str, game_history_df: pd.DataFrame):
+    def find_book_node(self, opening_book: OpeningBook) -> int:
         """
-        Search for a partial sequence of moves in the game history cache.
+        Return the opening book node of the current position, walking on from the node found for an earlier position.
         """
-        subset_df = game_history_df[
-            game_history_df["input_sequence"] == partial_sequence_str
-        ]
-        if subset_df.empty:
+        if opening_book is not self.opening_book:
+            self.opening_book = opening_book
+            self.book_node = 0
+            self.book_ply_count = 0
+        while self.book_node is not None and self.book_ply_count < len(self.move_list_in_san):
+            self.book_node = opening_book.child_node(
+                self.book_node, self.move_list_in_san[self.book_ply_count])
+            self.book_ply_count += 1
+        return self.book_node
+
+    def cache_search(self, opening_book: OpeningBook):
+        """
+        Search for the current sequence of moves in the user's opening book.
+        """
+        with time_stage("cache_search"):
+            target_move = opening_book.best_move_at(
+                self.find_book_node(opening_book))
+        if target_move is None:
             return None
 
-        target_move = subset_df["target_move"].value_counts().idxmax()
         return {
             "predicted_move": target_move,
             "source": "cache"
         }
 
-    def predict_using_model(self, partial_sequence_str: str, legal_move_set: set):
+    def predict_using_model(self, partial_sequence_str: str):
         """
         Predict the next move using a trained model.
         """
-        result = make_prediction_using_model(
-            partial_sequence_str,
-            lichess_username=self.lichess_username
-        )
-        if result not in legal_move_set:
+        if MODEL_DECODING_MODE == "legal_top_k":
+            return self.predict_legal_moves_using_model(partial_sequence_str)
+        with time_stage("model_inference"):
+            result = make_prediction_using_model(
+                partial_sequence_str,
+                lichess_username=self.lichess_username
+            )
+        # Parsing checks legality without writing out every legal move in SAN
+        try:
+            move = self.board.parse_san(result)
+        except ValueError:
             raise ValueError("Illegal move by system")
         return {
-            "predicted_move": result,
+            "predicted_move": self.board.san(move),
             "source": "model"
         }
 
+    def predict_legal_moves_using_model(self, partial_sequence_str: str):
+        """
+        Predict the next move using a trained model, choosing only among the legal moves.
+        """
+        legal_move_list = [self.board.san(move)
+                           for move in self.board.legal_moves]
+        with time_stage("model_inference"):
+            candidate_list = make_ranked_prediction_using_model(
+                partial_sequence_str,
+                lichess_username=self.lichess_username,
+                legal_move_list=legal_move_list,
+                top_k=MODEL_TOP_K
+            )
+        if not candidate_list:
+            raise ValueError("No legal move predicted by system")
+        return {
+            "predicted_move": candidate_list[0][0],
+            "source": "model",
+            "candidates": [
+                {"move": move, "probability": probability}
+                for move, probability in candidate_list
+            ],
+        }
+
     def stockfish_best_move_search(self):
         """
         Determine the best move according to Stockfish.
         """
-        # Get stockfish intelligence level from partial_sequence which is a list of SAN moves
-        intelligence_level = self.determine_stockfish_intelligence_level()
-        __stockfish__.set_position(self.move_list_in_uci)
-        __stockfish__.set_skill_level(intelligence_level)
-        # Get the best move from Stockfish
-        best_move = __stockfish__.get_top_moves(1)[0].get("Move")
+        if self.position_key_list is None:
+            self.position_key_list = self.position_keys()
+        # A checked out engine keeps its position and skill level private to this request
+        try:
+            with time_stage("engine_search"), ExitStack() as engine_checkout:
+                # Get stockfish intelligence level from partial_sequence which is a list of SAN moves
+                intelligence_level = self.determine_stockfish_intelligence_level(
+                    engine_checkout)
+                # Get the best move from Stockfish
+                best_move = self.engine_best_move(
+                    len(self.move_list_in_uci), intelligence_level, engine_checkout)
+        finally:
+            # The engine went back to the pool, also when the search failed
+            self.engine = None
 
         return {
             "predicted_move": best_move,
             "source": "stockfish"
         }
 
-    def compute_next_move(self, game_history_df: pd.DataFrame) -> str:
+    def compute_next_move(self, opening_book: OpeningBook) -> str:
         """
         Compute the next move using a combination of cache search, model prediction, and Stockfish.
         """
-        partial_sequence_str = " ".join(self.move_list_in_san).strip()
-        # Remove all special chars from the SAN moves except space (" ") and hyphen ("-")
-        partial_sequence_str = re.sub(r"[^a-zA-Z0-9\s-]", "", partial_sequence_str)
-
-        # Setup Board
-        board = chess.Board()
-        for move in self.move_list_in_san:
-            board.push_san(move)
+        start_time = time.perf_counter()
+        # Special chars removed from the SAN moves except hyphen ("-"), as push_san keeps them
+        partial_sequence_str = " ".join(self.normalized_san_list)
 
         # Option A = Cache search
-        result = self.cache_search(partial_sequence_str, game_history_df)
+        result = self.cache_search(opening_book)
         if result is not None:
+            move_source_stats.record("cache")
+            next_move_latency.observe(time.perf_counter() - start_time, "cache")
             return result
 
-        # Get legal moves
-        legal_move_set = board.legal_moves
-        legal_move_set = set([board.san(move) for move in legal_move_set])
-
         try:
             # Option B = Model predictions
-            result = self.predict_using_model(
-                partial_sequence_str,
-                legal_move_set
-            )
+            result = self.predict_using_model(partial_sequence_str)
             if result is not None:
+                move_source_stats.record("model")
+                next_move_latency.observe(time.perf_counter() - start_time, "model")
                 return result
 
         except Exception as ex:
-            print(ex)
+            logger.warning(
+                "Model prediction for %s failed, falling back to the engine", self.lichess_username, exc_info=True)
+            model_fallback_count.inc(type(ex).__name__)
             # Option C = Stockfish
             result = self.stockfish_best_move_search()
             if result is not None:
+                move_source_stats.record("stockfish", model_fallback=True)
+                next_move_latency.observe(
+                    time.perf_counter() - start_time, "stockfish")
                 return result
\ No newline at end of file
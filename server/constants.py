@@ -1,13 +1,65 @@
 """Constants for the project."""
 import os
 
-# Environment variables
-LICHESS_API_TOKEN = os.environ["LICHESS_API_TOKEN"]
-GEMINI_API_KEY = os.environ["GEMINI_API_KEY"]
+# Environment variables, checked when the client that needs them is first built
+LICHESS_API_TOKEN = os.environ.get("LICHESS_API_TOKEN")
+GEMINI_API_KEY = os.environ.get("GEMINI_API_KEY")
 
 # Other strings
 DATA_DIRECTORY = "data"
-STOCKFISH_PATH = "/opt/homebrew/bin/stockfish"
+STOCKFISH_PATH = os.environ.get("STOCKFISH_PATH", "/opt/homebrew/bin/stockfish")
+ENGINE_CACHE_PATH = os.environ.get(
+    "ENGINE_CACHE_PATH", "../data/cache/engine_cache.sqlite3")
+PERSONA_MANIFEST_PATH = os.environ.get(
+    "PERSONA_MANIFEST_PATH", "../data/personas.json")
+MODEL_DECODING_MODE = os.environ.get(
+    "MODEL_DECODING_MODE", "legal_top_k")  # "legal_top_k", or "argmax" over every label
+LLM_MODEL_NAME = "models/gemini-pro"
+ANONYMOUS_PLAYER = "ANONYMOUS"  # Name stored and served for players without a Lichess account
+LLM_API_ENDPOINT = os.environ.get("LLM_API_ENDPOINT")  # Stand-in Gemini server, e.g. scripts/fake_llm_server.py
+TRACING_ENABLED = os.environ.get(
+    "TRACING_ENABLED", "") == "1"  # Emit OpenTelemetry spans, needs opentelemetry-api and an SDK configured
+PROFILING_TOKEN = os.environ.get("PROFILING_TOKEN")  # Admin secret that requests a profile; profiling is off when unset
+PROFILE_DIRECTORY = os.environ.get(
+    "PROFILE_DIRECTORY", "../data/profiles")  # Where request profiles are kept
 
 # Numbers
 MAX_SEQUENCE_LENGTH = 178
+OPENING_BOOK_CACHE_SIZE = 32  # Opening books kept in memory per process
+MODEL_CACHE_SIZE = 8  # Persona models kept resident per process
+MODEL_CACHE_MAX_BYTES = 512 * 1024 * 1024  # Upper bound on resident model artifact size
+INFERENCE_BATCH_WINDOW_SECONDS = float(
+    os.environ.get("INFERENCE_BATCH_WINDOW_MS", "5")) / 1000  # Time a prediction waits for others to batch with
+INFERENCE_MAX_BATCH_SIZE = int(
+    os.environ.get("INFERENCE_MAX_BATCH_SIZE", "32"))  # Largest batch per forward pass
+INFERENCE_WORKERS = 2  # Threads running batched forward passes
+ENGINE_POOL_SIZE = int(
+    os.environ.get("ENGINE_POOL_SIZE", "4"))  # Engine processes per server process
+ENGINE_SEARCH_DEPTH = 15  # Default search depth of the engines
+ENGINE_TIMEOUT_SECONDS = 10.0  # Longest time to wait on an engine reply
+ENGINE_HEALTH_CHECK_INTERVAL_SECONDS = 30.0  # Time between pings of idle engines
+ACCURACY_CACHE_SIZE = 4096  # Game prefixes whose engine-match counts are kept per process
+ENGINE_CACHE_MAX_ENTRIES = 500_000  # Positions kept in the on-disk engine cache
+INGEST_CHUNK_SIZE = 500  # Games written to disk per ingestion chunk
+HISTORY_LOCAL_BATCH_SIZE = 500  # Games per streamed chunk when serving history from a local copy
+BLOCKING_WORKERS = 16  # Threads running blocking work for route handlers
+TRAINING_JOB_WORKERS = 2  # Persona training jobs run at the same time
+TRAINING_JOB_HISTORY_SIZE = 256  # Finished training jobs kept for status polling
+BULK_TRAINING_WORKERS = 2  # Worker processes building personas in bulk
+BULK_TRAINING_THREADS_PER_JOB = 2  # CPU threads each bulk build may use
+BULK_TRAINING_MEMORY_LIMIT_BYTES = 4 * 1024 * 1024 * 1024  # Heap limit of each bulk build
+BULK_TRAINING_MAX_CONCURRENT_FETCHES = 2  # Bulk builds downloading from Lichess at once
+BULK_TRAINING_MAX_ATTEMPTS = 3  # Attempts per bulk build before it is marked failed
+BULK_TRAINING_RETRY_DELAY_SECONDS = 60.0  # Wait before a failed bulk build is retried
+LLM_MAX_CONCURRENT_REQUESTS = 4  # Prompts sent to the LLM at once per process
+LLM_TIMEOUT_SECONDS = 30.0  # Longest time a prompt may take
+LLM_CACHE_SIZE = 1024  # LLM responses cached per process
+LLM_CACHE_TTL_SECONDS = 3600.0  # Time a cached LLM response stays valid
+GAME_SESSION_MAX_COUNT = 1024  # Game sessions kept in memory per process
+GAME_SESSION_IDLE_SECONDS = 1800.0  # Time after which an unused game session is dropped
+MODEL_TOP_K = 3  # Legal moves returned with a model prediction
+METRICS_LATENCY_BUCKETS = (
+    0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+    0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)  # Upper bounds in seconds of the latency histogram buckets
+PROFILE_MAX_COUNT = 64  # Request profiles kept on disk, oldest dropped first
+PROFILE_SAMPLE_INTERVAL_SECONDS = 0.001  # Time between stack samples of a profiled request
@@ -0,0 +1,128 @@
+"""Persistent cache of engine search results keyed by position and engine settings."""
+import os
+import sqlite3
+import threading
+import time
+
+import chess
+
+# Local
+from constants import ENGINE_CACHE_MAX_ENTRIES, ENGINE_CACHE_PATH
+
+NO_MOVE = ""  # Stored for positions where the engine has no move
+
+
+def position_key(board: chess.Board) -> str:
+    """
+    Return the FEN of a position without the move counters, so transpositions share an entry.
+    """
+    return board.fen().rsplit(" ", 2)[0]
+
+
+class EngineCache:
+    """
+    An SQLite backed cache of best moves. The database file is shared by every
+    server process; each thread uses its own connection and WAL mode lets the
+    workers read while one of them writes. Entries are evicted least recently
+    used first once the table grows past max_entries.
+    """
+
+    database_path: str = None  # Path of the SQLite database file
+    max_entries: int = 0  # Maximum number of cached positions
+    eviction_interval: int = 256  # Number of writes between eviction passes
+
+    def __init__(self, database_path: str, max_entries: int):
+        self.database_path = database_path
+        self.max_entries = max_entries
+        self._thread_local = threading.local()
+        self._lock = threading.Lock()
+        self._counters = {"hits": 0, "misses": 0, "writes": 0, "evictions": 0}
+
+    def _connection(self) -> sqlite3.Connection:
+        """
+        Return the connection of the calling thread, creating the database on first use.
+        """
+        connection = getattr(self._thread_local, "connection", None)
+        if connection is None:
+            os.makedirs(os.path.dirname(self.database_path) or ".", exist_ok=True)
+            connection = sqlite3.connect(
+                self.database_path,
+                timeout=30,
+                isolation_level=None
+            )
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS evaluations ("
+                "position TEXT NOT NULL, "
+                "skill_level INTEGER NOT NULL, "
+                "depth INTEGER NOT NULL, "
+                "best_move TEXT NOT NULL, "
+                "last_used REAL NOT NULL, "
+                "PRIMARY KEY (position, skill_level, depth))"
+            )
+            connection.execute(
+                "CREATE INDEX IF NOT EXISTS evaluations_last_used ON evaluations (last_used)")
+            self._thread_local.connection = connection
+        return connection
+
+    def get(self, position: str, skill_level: int, depth: int) -> tuple[bool, str]:
+        """
+        Look up the best move of a position. Returns (found, best move or None).
+        """
+        connection = self._connection()
+        row = connection.execute(
+            "SELECT best_move FROM evaluations WHERE position = ? AND skill_level = ? AND depth = ?",
+            (position, skill_level, depth)
+        ).fetchone()
+        with self._lock:
+            self._counters["hits" if row is not None else "misses"] += 1
+        if row is None:
+            return False, None
+        connection.execute(
+            "UPDATE evaluations SET last_used = ? WHERE position = ? AND skill_level = ? AND depth = ?",
+            (time.time(), position, skill_level, depth)
+        )
+        return True, row[0] if row[0] != NO_MOVE else None
+
+    def put(self, position: str, skill_level: int, depth: int, best_move: str):
+        """
+        Store the best move of a position.
+        """
+        connection = self._connection()
+        connection.execute(
+            "INSERT OR REPLACE INTO evaluations VALUES (?, ?, ?, ?, ?)",
+            (position, skill_level, depth, best_move or NO_MOVE, time.time())
+        )
+        with self._lock:
+            self._counters["writes"] += 1
+            should_evict = self._counters["writes"] % self.eviction_interval == 0
+        if should_evict:
+            self.evict()
+
+    def evict(self):
+        """
+        Delete the least recently used entries beyond max_entries.
+        """
+        cursor = self._connection().execute(
+            "DELETE FROM evaluations WHERE rowid IN ("
+            "SELECT rowid FROM evaluations ORDER BY last_used ASC "
+            "LIMIT max(0, (SELECT count(*) FROM evaluations) - ?))",
+            (self.max_entries,)
+        )
+        with self._lock:
+            self._counters["evictions"] += cursor.rowcount
+
+    def stats(self) -> dict:
+        """
+        Return hit/miss counters of this process.
+        """
+        with self._lock:
+            stats_dict = dict(self._counters)
+        lookups = stats_dict["hits"] + stats_dict["misses"]
+        stats_dict["hit_rate"] = stats_dict["hits"] / lookups if lookups else 0.0
+        return stats_dict
+
+
+# Process-wide cache shared by all requests
+engine_cache = EngineCache(ENGINE_CACHE_PATH, ENGINE_CACHE_MAX_ENTRIES)
@@ -0,0 +1,325 @@
+"""Pool of UCI chess engine processes shared by all requests."""
+import asyncio
+import logging
+import queue
+import subprocess
+import threading
+import time
+
+from contextlib import asynccontextmanager, contextmanager
+
+# Local
+from constants import (
+    ENGINE_HEALTH_CHECK_INTERVAL_SECONDS,
+    ENGINE_POOL_SIZE,
+    ENGINE_SEARCH_DEPTH,
+    ENGINE_TIMEOUT_SECONDS,
+    STOCKFISH_PATH,
+)
+
+MAX_SKILL_LEVEL = 20  # Highest value of the UCI "Skill Level" option
+
+logger = logging.getLogger(__name__)
+
+
+def normalize_skill_level(skill_level: float) -> int:
+    """
+    Clamp a skill level to the integer range accepted by the engine.
+    """
+    return max(0, min(MAX_SKILL_LEVEL, int(skill_level)))
+
+
+class EngineError(Exception):
+    """Raised when an engine process dies or stops answering."""
+
+
+class UCIEngine:
+    """
+    A single UCI engine process. Not thread safe; use it through an EnginePool checkout.
+    """
+
+    engine_path: str = None  # Path of the engine binary
+    skill_level: int = None  # Skill level currently set on the engine
+    depth: int = ENGINE_SEARCH_DEPTH  # Search depth used by go commands
+    process: subprocess.Popen = None  # The engine process
+    needs_restart: bool = False  # Set when a restart failed, so the next checkout retries it
+
+    def __init__(self, engine_path: str):
+        """
+        Start the engine process and complete the UCI handshake.
+        """
+        self.engine_path = engine_path
+        self.process = subprocess.Popen(
+            [engine_path],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+            text=True,
+            bufsize=1,
+        )
+        # A reader thread lets us wait on engine output with a timeout
+        self._output_lines: queue.Queue = queue.Queue()
+        self._reader_thread = threading.Thread(
+            target=self._read_output,
+            name="uci-reader",
+            daemon=True
+        )
+        self._reader_thread.start()
+
+        self._send("uci")
+        self._read_until("uciok")
+        self.ping()
+
+    def _read_output(self):
+        """
+        Forward engine output lines to the line queue until the process exits.
+        """
+        for line in self.process.stdout:
+            self._output_lines.put(line.strip())
+        # Wake up any reader waiting on a dead engine
+        self._output_lines.put(None)
+
+    def _send(self, command: str):
+        """
+        Send a command to the engine.
+        """
+        try:
+            self.process.stdin.write(f"{command}\n")
+            self.process.stdin.flush()
+        except (BrokenPipeError, OSError) as ex:
+            raise EngineError(f"Engine process is not writable: {ex}")
+
+    def _read_until(self, prefix: str, timeout: float = ENGINE_TIMEOUT_SECONDS) -> list[str]:
+        """
+        Read engine output until a line starting with prefix. Returns every line read.
+        """
+        deadline = time.monotonic() + timeout
+        line_list = []
+        while True:
+            remaining_seconds = deadline - time.monotonic()
+            if remaining_seconds <= 0:
+                raise EngineError(f"Timed out waiting for '{prefix}'")
+            try:
+                line = self._output_lines.get(timeout=remaining_seconds)
+            except queue.Empty:
+                raise EngineError(f"Timed out waiting for '{prefix}'")
+            if line is None:
+                raise EngineError("Engine process exited")
+            line_list.append(line)
+            if line.startswith(prefix):
+                return line_list
+
+    def is_alive(self) -> bool:
+        """
+        Check whether the engine process is still running.
+        """
+        return self.process.poll() is None
+
+    def ping(self, timeout: float = ENGINE_TIMEOUT_SECONDS):
+        """
+        Check that the engine answers. Raises EngineError otherwise.
+        """
+        self._send("isready")
+        self._read_until("readyok", timeout=timeout)
+
+    def configure(self, skill_level: int = MAX_SKILL_LEVEL, depth: int = ENGINE_SEARCH_DEPTH):
+        """
+        Set the skill level and search depth for the next searches.
+        """
+        # Out of range values are ignored by the engine, so clamp them here
+        skill_level = normalize_skill_level(skill_level)
+        if skill_level != self.skill_level:
+            self._send(f"setoption name Skill Level value {skill_level}")
+            self.skill_level = skill_level
+        self.depth = depth
+
+    def best_move(self, move_list_in_uci: list[str], start_fen: str = None) -> str:
+        """
+        Search the position after the given UCI moves, played from start_fen or
+        the starting position, and return the best move, or None if there is none.
+        """
+        position = f"fen {start_fen}" if start_fen else "startpos"
+        if move_list_in_uci:
+            self._send(
+                f"position {position} moves {' '.join(move_list_in_uci)}")
+        else:
+            self._send(f"position {position}")
+        self._send(f"go depth {self.depth}")
+        bestmove_line = self._read_until("bestmove")[-1]
+        best_move = bestmove_line.split(" ")[1] if " " in bestmove_line else None
+        if best_move in (None, "(none)"):
+            return None
+        return best_move
+
+    def quit(self):
+        """
+        Stop the engine process.
+        """
+        try:
+            self._send("quit")
+            self.process.wait(timeout=1)
+        except (EngineError, subprocess.TimeoutExpired):
+            self.process.kill()
+
+
+class EnginePool:
+    """
+    A fixed-size pool of UCI engine processes. Engines are checked out for the
+    duration of a request, so concurrent requests never share engine state.
+    Dead or unresponsive engines are restarted.
+    """
+
+    engine_path: str = None  # Path of the engine binary
+    size: int = 0  # Number of engine processes
+
+    def __init__(self, engine_path: str, size: int):
+        self.engine_path = engine_path
+        self.size = size
+        self._idle_engines: queue.LifoQueue = queue.LifoQueue()
+        self._lock = threading.Lock()
+        self._counters = {"checkouts": 0, "restarts": 0, "wait_seconds_total": 0.0}
+        for _ in range(size):
+            self._idle_engines.put(UCIEngine(engine_path))
+
+        self._health_check_thread = threading.Thread(
+            target=self._health_check_forever,
+            name="engine-health-check",
+            daemon=True
+        )
+        self._health_check_thread.start()
+
+    def _restart(self, engine: UCIEngine) -> UCIEngine:
+        """
+        Replace an engine with a fresh process.
+        """
+        engine.process.kill()
+        with self._lock:
+            self._counters["restarts"] += 1
+        return UCIEngine(self.engine_path)
+
+    def _acquire(self, timeout: float = None) -> UCIEngine:
+        """
+        Take an idle engine from the pool, restarting it if its process has died
+        or its last restart failed.
+        """
+        wait_start_time = time.perf_counter()
+        try:
+            engine = self._idle_engines.get(timeout=timeout)
+        except queue.Empty:
+            raise EngineError("No engine became available in time")
+        with self._lock:
+            self._counters["checkouts"] += 1
+            self._counters["wait_seconds_total"] += time.perf_counter() - \
+                wait_start_time
+        if engine.needs_restart or not engine.is_alive():
+            try:
+                engine = self._restart(engine)
+            except Exception:
+                engine.needs_restart = True
+                self._idle_engines.put(engine)
+                raise
+        return engine
+
+    def _release(self, engine: UCIEngine, failed: bool):
+        """
+        Return an engine to the pool, restarting it if the request using it failed.
+        """
+        if failed or engine.needs_restart or not engine.is_alive():
+            try:
+                engine = self._restart(engine)
+            except Exception:
+                # Keep the pool size constant; the next checkout retries the restart
+                logger.exception("Failed to restart engine %s", self.engine_path)
+                engine.needs_restart = True
+        self._idle_engines.put(engine)
+
+    @contextmanager
+    def checkout(self, timeout: float = None):
+        """
+        Check out an engine for exclusive use inside a with block.
+        """
+        engine = self._acquire(timeout)
+        failed = False
+        try:
+            yield engine
+        except EngineError:
+            failed = True
+            raise
+        finally:
+            self._release(engine, failed)
+
+    @asynccontextmanager
+    async def async_checkout(self, timeout: float = None):
+        """
+        Check out an engine inside an async with block without blocking the event loop.
+        """
+        engine = await asyncio.to_thread(self._acquire, timeout)
+        failed = False
+        try:
+            yield engine
+        except EngineError:
+            failed = True
+            raise
+        finally:
+            self._release(engine, failed)
+
+    def health_check(self):
+        """
+        Ping every idle engine and restart the ones that do not answer.
+        """
+        # Take the idle engines out first so each one is checked exactly once
+        idle_engine_list = []
+        for _ in range(self.size):
+            try:
+                idle_engine_list.append(self._idle_engines.get_nowait())
+            except queue.Empty:
+                break
+        for engine in idle_engine_list:
+            failed = False
+            try:
+                engine.ping()
+            except EngineError:
+                failed = True
+            self._release(engine, failed)
+
+    def _health_check_forever(self):
+        """
+        Run health checks at a fixed interval.
+        """
+        while True:
+            time.sleep(ENGINE_HEALTH_CHECK_INTERVAL_SECONDS)
+            self.health_check()
+
+    def stats(self) -> dict:
+        """
+        Return pool occupancy and checkout counters.
+        """
+        with self._lock:
+            stats_dict = dict(self._counters)
+        stats_dict["size"] = self.size
+        stats_dict["idle"] = self._idle_engines.qsize()
+        return stats_dict
+
+
+__engine_pool__: EnginePool = None
+__engine_pool_lock__ = threading.Lock()
+
+
+def get_engine_pool() -> EnginePool:
+    """
+    Return the process-wide engine pool, starting its engines on first use.
+    """
+    global __engine_pool__
+    with __engine_pool_lock__:
+        if __engine_pool__ is None:
+            __engine_pool__ = EnginePool(STOCKFISH_PATH, ENGINE_POOL_SIZE)
+    return __engine_pool__
+
+
+def get_engine_pool_stats() -> dict:
+    """
+    Return the counters of the process-wide engine pool without starting it.
+    """
+    with __engine_pool_lock__:
+        engine_pool = __engine_pool__
+    return engine_pool.stats() if engine_pool is not None else None
@@ -0,0 +1,179 @@
+"""Server-side game sessions, so clients send one move at a time instead of the whole game."""
+import threading
+import time
+import uuid
+
+import chess
+
+from collections import OrderedDict
+
+# Local
+from chess_client import ChessClient
+from constants import GAME_SESSION_IDLE_SECONDS, GAME_SESSION_MAX_COUNT
+from opening_book import get_opening_book
+
+
+class PersonaNotFoundError(LookupError):
+    """Raised when the user of a game session has no opening book to play from."""
+
+
+class GameSession:
+    """
+    A game in progress against the persona of a user. The ChessClient keeps the
+    board, the move lists, the position keys, the opening book node and the
+    engine-match score, and each of them advances by one ply per move. Engines
+    are sent the moves since the last capture or pawn move. What still grows
+    with the length of the game is joining the moves into a string where one is
+    needed: the model input, and the accuracy tracker key when the engine grades
+    the game.
+    """
+
+    session_id: str = None  # Unique ID the client refers to the session by
+    lichess_username: str = None  # Username whose persona is played against
+    chess_client: ChessClient = None  # Game state and per-session caches
+    last_used_at: float = 0.0  # Monotonic time of the last move
+
+    def __init__(self, lichess_username: str, move_list_in_san: list[str]):
+        self.session_id = uuid.uuid4().hex
+        self.lichess_username = lichess_username
+        self.chess_client = ChessClient(
+            move_list_in_san=move_list_in_san, lichess_username=lichess_username)
+        self.last_used_at = time.monotonic()
+        # Moves of one session are applied one at a time
+        self.lock = threading.Lock()
+
+    def play(self, move_in_san: str = None, reply: bool = True) -> dict:
+        """
+        Play a move of the user, if any, then compute and play the reply of the persona.
+        Raises ValueError if the move is not legal, and PersonaNotFoundError if the user
+        has no opening book. If the reply fails, the move of the user is taken back, so
+        the session is left as it was before the call.
+        """
+        with self.lock:
+            self.last_used_at = time.monotonic()
+            ply_count = len(self.chess_client.move_list_in_san)
+            try:
+                if move_in_san:
+                    self.chess_client.push_san(move_in_san)
+                result = None
+                if reply and not self.chess_client.board.is_game_over():
+                    try:
+                        opening_book = get_opening_book(self.lichess_username)
+                    except FileNotFoundError as ex:
+                        raise PersonaNotFoundError(
+                            f"No opening book for {self.lichess_username}") from ex
+                    result = self.chess_client.compute_next_move(opening_book)
+                    predicted_move = result["predicted_move"]
+                    if result["source"] == "stockfish":
+                        # Engine moves come back in UCI
+                        predicted_move = self.chess_client.board.san(
+                            chess.Move.from_uci(predicted_move))
+                    self.chess_client.push_san(predicted_move)
+            except Exception:
+                # A retry of the same move must find the position it was sent for
+                while len(self.chess_client.move_list_in_san) > ply_count:
+                    self.chess_client.pop_san()
+                raise
+            return dict(self.to_dict(), reply=result)
+
+    def to_dict(self) -> dict:
+        """
+        Return the state of the session.
+        """
+        board = self.chess_client.board
+        return {
+            "session_id": self.session_id,
+            "lichess_username": self.lichess_username,
+            "ply_count": len(self.chess_client.move_list_in_san),
+            "fen": board.fen(),
+            "game_over": board.is_game_over(),
+            "result": board.result() if board.is_game_over() else None,
+        }
+
+
+class GameSessionManager:
+    """
+    Keeps game sessions in memory, bounded by count and evicting the least
+    recently used ones, and drops sessions that have been idle too long.
+    """
+
+    max_sessions: int = 0  # Maximum number of sessions kept
+    idle_seconds: float = 0.0  # Time after which an unused session is dropped
+
+    def __init__(self, max_sessions: int, idle_seconds: float):
+        self.max_sessions = max_sessions
+        self.idle_seconds = idle_seconds
+        self._sessions: OrderedDict = OrderedDict()  # Session ID -> GameSession
+        self._lock = threading.Lock()
+        self._counters = {"created": 0, "expired": 0, "evicted": 0, "moves": 0}
+
+    def _expire(self):
+        """
+        Drop idle sessions and the least recently used ones over capacity. Caller must hold the lock.
+        """
+        now = time.monotonic()
+        # Sessions are kept in order of use, so idle ones are at the front
+        while self._sessions:
+            game_session = next(iter(self._sessions.values()))
+            if now - game_session.last_used_at < self.idle_seconds:
+                break
+            self._sessions.popitem(last=False)
+            self._counters["expired"] += 1
+        while len(self._sessions) > self.max_sessions:
+            self._sessions.popitem(last=False)
+            self._counters["evicted"] += 1
+
+    def create(self, lichess_username: str, move_list_in_san: list[str] = None) -> GameSession:
+        """
+        Start a session, optionally from a game already in progress.
+        Raises ValueError if one of the moves is not legal.
+        """
+        game_session = GameSession(lichess_username, move_list_in_san or [])
+        with self._lock:
+            self._sessions[game_session.session_id] = game_session
+            self._counters["created"] += 1
+            self._expire()
+        return game_session
+
+    def get(self, session_id: str) -> GameSession:
+        """
+        Return a session by ID, or None if it is unknown or expired.
+        """
+        with self._lock:
+            self._expire()
+            game_session = self._sessions.get(session_id)
+            if game_session is not None:
+                self._sessions.move_to_end(session_id)
+        return game_session
+
+    def play(self, game_session: GameSession, move_in_san: str = None, reply: bool = True) -> dict:
+        """
+        Play a move in a session and mark the session as recently used.
+        """
+        result = game_session.play(move_in_san, reply=reply)
+        with self._lock:
+            self._counters["moves"] += 1
+            if game_session.session_id in self._sessions:
+                self._sessions.move_to_end(game_session.session_id)
+        return result
+
+    def close(self, session_id: str) -> bool:
+        """
+        Drop a session. Returns whether it existed.
+        """
+        with self._lock:
+            return self._sessions.pop(session_id, None) is not None
+
+    def stats(self) -> dict:
+        """
+        Return session counters and the number of open sessions.
+        """
+        with self._lock:
+            stats_dict = dict(self._counters)
+            stats_dict["open_sessions"] = len(self._sessions)
+        return stats_dict
+
+
+# Process-wide sessions shared by all requests
+game_session_manager = GameSessionManager(
+    GAME_SESSION_MAX_COUNT, GAME_SESSION_IDLE_SECONDS)
@@ -0,0 +1,181 @@
+"""Micro-batching scheduler for persona model inference."""
+import threading
+import time
+
+import numpy as np
+
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+
+# Local
+from constants import (
+    INFERENCE_BATCH_WINDOW_SECONDS,
+    INFERENCE_MAX_BATCH_SIZE,
+    INFERENCE_WORKERS,
+)
+from model_registry import PersonaModel, get_persona_model
+
+
+class PendingPrediction:
+    """
+    A prediction request waiting in the queue of a persona model.
+    """
+
+    __slots__ = ("moves_in_san_str", "future", "enqueued_at")
+
+    def __init__(self, moves_in_san_str: str):
+        self.moves_in_san_str = moves_in_san_str
+        self.future = Future()
+        self.enqueued_at = time.perf_counter()
+
+
+class InferenceScheduler:
+    """
+    Collects concurrent prediction requests for the same persona model and runs
+    them as a single batched forward pass. A batch is dispatched when it reaches
+    max_batch_size or when its oldest request has waited window_seconds.
+    """
+
+    window_seconds: float = 0.0  # Longest time a request waits for others to join its batch
+    max_batch_size: int = 0  # Largest number of sequences per forward pass
+
+    def __init__(self, window_seconds: float, max_batch_size: int, worker_count: int):
+        self.window_seconds = window_seconds
+        self.max_batch_size = max_batch_size
+        self._queues: dict[str, list[PendingPrediction]] = {}  # Username -> pending requests
+        self._condition = threading.Condition()
+        self._executor = ThreadPoolExecutor(
+            max_workers=worker_count,
+            thread_name_prefix="inference"
+        )
+        self._dispatcher_thread: threading.Thread = None
+        self._started_at = time.perf_counter()
+        self._counters = {
+            "requests": 0,
+            "batches": 0,
+            "max_batch_size_seen": 0,
+            "forward_seconds_total": 0.0,
+        }
+        # Recent queue latencies, bounded so stats stay cheap
+        self._queue_latencies: deque = deque(maxlen=1024)
+
+    def submit(self, lichess_username: str, moves_in_san_str: str) -> Future:
+        """
+        Queue a SAN move sequence for prediction. The returned future resolves to
+        a (PersonaModel, probability distribution) tuple.
+        """
+        pending_prediction = PendingPrediction(moves_in_san_str)
+        with self._condition:
+            self._ensure_dispatcher()
+            self._queues.setdefault(
+                lichess_username, []).append(pending_prediction)
+            self._condition.notify()
+        return pending_prediction.future
+
+    def predict(self, lichess_username: str, moves_in_san_str: str) -> tuple[PersonaModel, np.ndarray]:
+        """
+        Predict the move distribution of a SAN move sequence, blocking until its batch has run.
+        """
+        return self.submit(lichess_username, moves_in_san_str).result()
+
+    def _ensure_dispatcher(self):
+        """
+        Start the dispatcher thread on first use. Caller must hold the condition.
+        """
+        if self._dispatcher_thread is None:
+            self._dispatcher_thread = threading.Thread(
+                target=self._dispatch_forever,
+                name="inference-dispatcher",
+                daemon=True
+            )
+            self._dispatcher_thread.start()
+
+    def _dispatch_forever(self):
+        """
+        Form batches from the queues and hand them to the worker threads.
+        """
+        while True:
+            ready_batch_list = []
+            with self._condition:
+                while not self._queues:
+                    self._condition.wait()
+
+                now = time.perf_counter()
+                next_deadline = None
+                for lichess_username in list(self._queues):
+                    queue = self._queues[lichess_username]
+                    deadline = queue[0].enqueued_at + self.window_seconds
+                    if len(queue) >= self.max_batch_size or now >= deadline:
+                        ready_batch_list.append(
+                            (lichess_username, queue[:self.max_batch_size]))
+                        del queue[:self.max_batch_size]
+                        if not queue:
+                            del self._queues[lichess_username]
+                    elif next_deadline is None or deadline < next_deadline:
+                        next_deadline = deadline
+
+                if not ready_batch_list:
+                    # Sleep until the oldest open batch is due or a new request arrives
+                    self._condition.wait(timeout=next_deadline - now)
+                    continue
+
+            for lichess_username, batch in ready_batch_list:
+                self._executor.submit(self._run_batch, lichess_username, batch)
+
+    def _run_batch(self, lichess_username: str, batch: list[PendingPrediction]):
+        """
+        Run one forward pass for a batch and fan the results out to the waiting requests.
+        """
+        dispatched_at = time.perf_counter()
+        try:
+            persona_model = get_persona_model(lichess_username)
+            prediction_batch = persona_model.predict(
+                [pending.moves_in_san_str for pending in batch])
+        except Exception as ex:
+            for pending_prediction in batch:
+                pending_prediction.future.set_exception(ex)
+            return
+        forward_seconds = time.perf_counter() - dispatched_at
+
+        with self._condition:
+            self._counters["requests"] += len(batch)
+            self._counters["batches"] += 1
+            self._counters["max_batch_size_seen"] = max(
+                self._counters["max_batch_size_seen"], len(batch))
+            self._counters["forward_seconds_total"] += forward_seconds
+            self._queue_latencies.extend(
+                dispatched_at - pending.enqueued_at for pending in batch)
+
+        for pending_prediction, prediction in zip(batch, prediction_batch):
+            pending_prediction.future.set_result((persona_model, prediction))
+
+    def stats(self) -> dict:
+        """
+        Return throughput, batch size and queue latency statistics.
+        """
+        with self._condition:
+            stats_dict = dict(self._counters)
+            queue_latency_list = sorted(self._queue_latencies)
+            stats_dict["queued_requests"] = sum(
+                len(queue) for queue in self._queues.values())
+        elapsed_seconds = time.perf_counter() - self._started_at
+        stats_dict["window_seconds"] = self.window_seconds
+        stats_dict["max_batch_size"] = self.max_batch_size
+        stats_dict["mean_batch_size"] = (
+            stats_dict["requests"] / stats_dict["batches"]
+        ) if stats_dict["batches"] else 0.0
+        stats_dict["requests_per_second"] = stats_dict["requests"] / \
+            elapsed_seconds if elapsed_seconds else 0.0
+        for percentile in (50, 95, 99):
+            stats_dict[f"queue_latency_p{percentile}_seconds"] = float(
+                np.percentile(queue_latency_list, percentile)
+            ) if queue_latency_list else 0.0
+        return stats_dict
+
+
+# Process-wide scheduler shared by all requests
+inference_scheduler = InferenceScheduler(
+    INFERENCE_BATCH_WINDOW_SECONDS,
+    INFERENCE_MAX_BATCH_SIZE,
+    INFERENCE_WORKERS
+)
@@ -0,0 +1,180 @@
+"""Bounded executors for blocking route work and background persona training jobs."""
+import asyncio
+import contextvars
+import itertools
+import logging
+import threading
+import time
+import uuid
+
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from typing import AsyncIterator, Callable, Iterator
+
+# Local
+from constants import BLOCKING_WORKERS, TRAINING_JOB_HISTORY_SIZE, TRAINING_JOB_WORKERS
+from profiling import call_profiled, current_request_profile
+
+logger = logging.getLogger(__name__)
+
+# Threads that run blocking calls (HTTP, file I/O, inference, engines) for the route handlers
+blocking_executor = ThreadPoolExecutor(
+    max_workers=BLOCKING_WORKERS,
+    thread_name_prefix="blocking"
+)
+
+
+async def run_blocking(function: Callable, *args, **kwargs):
+    """
+    Run a blocking function on the blocking executor without stalling the event loop.
+    The function runs in a copy of the caller's context, so trace spans it opens nest under the request.
+    """
+    loop = asyncio.get_running_loop()
+    context = contextvars.copy_context()
+    request_profile = current_request_profile.get()
+    if request_profile is not None:
+        # Sample the executor thread too while it works for a profiled request
+        return await loop.run_in_executor(
+            blocking_executor, partial(context.run, call_profiled, request_profile, function, *args, **kwargs))
+    return await loop.run_in_executor(blocking_executor, partial(context.run, function, *args, **kwargs))
+
+
+async def iterate_blocking(iterator: Iterator, batch_size: int = 1) -> AsyncIterator[list]:
+    """
+    Consume a blocking iterator on the blocking executor, yielding lists of up to batch_size items.
+    The iterator is closed when the consumer stops early.
+    """
+    try:
+        while True:
+            item_batch = await run_blocking(list, itertools.islice(iterator, batch_size))
+            if not item_batch:
+                return
+            yield item_batch
+    finally:
+        close = getattr(iterator, "close", None)
+        if close is not None:
+            await run_blocking(close)
+
+
+class TrainingJob:
+    """
+    A persona training job and its progress.
+    """
+
+    job_id: str = None  # Unique ID used for status polling
+    lichess_username: str = None  # Username whose persona is being trained
+    status: str = "CLONING_QUEUED"  # CLONING_QUEUED, CLONING_IN_PROGRESS, CLONING_COMPLETE or CLONING_FAILED
+    stage: str = None  # Step of the training currently running
+    games_ingested: int = 0  # Games stored so far
+    error: str = None  # Error message of a failed job
+    created_at: float = None  # Epoch seconds when the job was submitted
+    finished_at: float = None  # Epoch seconds when the job completed or failed
+
+    def __init__(self, lichess_username: str):
+        self.job_id = uuid.uuid4().hex
+        self.lichess_username = lichess_username
+        self.created_at = time.time()
+
+    def is_finished(self) -> bool:
+        """
+        Check whether the job has completed or failed.
+        """
+        return self.status in ("CLONING_COMPLETE", "CLONING_FAILED")
+
+    def to_dict(self) -> dict:
+        """
+        Return the job as a response body.
+        """
+        return {
+            "job_id": self.job_id,
+            "lichess_username": self.lichess_username,
+            "status": self.status,
+            "stage": self.stage,
+            "games_ingested": self.games_ingested,
+            "error": self.error,
+            "created_at": self.created_at,
+            "finished_at": self.finished_at,
+        }
+
+
+class TrainingJobManager:
+    """
+    Runs persona training jobs on a bounded thread pool. Concurrent requests for
+    the same username share a single job, and finished jobs are kept for a while
+    so clients can poll their final status.
+    """
+
+    history_size: int = 0  # Maximum number of finished jobs kept
+
+    def __init__(self, worker_count: int, history_size: int):
+        self.history_size = history_size
+        self._executor = ThreadPoolExecutor(
+            max_workers=worker_count,
+            thread_name_prefix="training-job"
+        )
+        self._jobs: OrderedDict = OrderedDict()  # Job ID -> TrainingJob
+        self._active_jobs: dict[str, TrainingJob] = {}  # Username -> unfinished job
+        self._lock = threading.Lock()
+
+    def submit(self, lichess_username: str, train: Callable) -> TrainingJob:
+        """
+        Start a training job for a user, or return the one already running for them.
+        train is called with the job so it can report its progress.
+        """
+        with self._lock:
+            training_job = self._active_jobs.get(lichess_username)
+            if training_job is not None:
+                return training_job
+            training_job = TrainingJob(lichess_username)
+            self._jobs[training_job.job_id] = training_job
+            self._active_jobs[lichess_username] = training_job
+            self._evict()
+        self._executor.submit(self._run, training_job, train)
+        return training_job
+
+    def _run(self, training_job: TrainingJob, train: Callable):
+        """
+        Run a training job and record its outcome.
+        """
+        training_job.status = "CLONING_IN_PROGRESS"
+        try:
+            train(training_job)
+            training_job.status = "CLONING_COMPLETE"
+        except Exception as ex:
+            logger.exception("Training job %s for %s failed", training_job.job_id, training_job.lichess_username)
+            training_job.error = str(ex)
+            training_job.status = "CLONING_FAILED"
+        training_job.finished_at = time.time()
+        with self._lock:
+            self._active_jobs.pop(training_job.lichess_username, None)
+
+    def _evict(self):
+        """
+        Drop the oldest finished jobs beyond the history size. Caller must hold the lock.
+        """
+        finished_job_id_list = [
+            job_id for job_id, training_job in self._jobs.items() if training_job.is_finished()
+        ]
+        for job_id in finished_job_id_list[:max(0, len(finished_job_id_list) - self.history_size)]:
+            del self._jobs[job_id]
+
+    def get(self, job_id: str) -> TrainingJob:
+        """
+        Return a job by its ID, or None if it is unknown or expired.
+        """
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def stats(self) -> dict:
+        """
+        Return the number of jobs per status.
+        """
+        with self._lock:
+            status_list = [training_job.status for training_job in self._jobs.values()]
+        return {status: status_list.count(status) for status in set(status_list)}
+
+
+# Process-wide job manager shared by all requests
+training_job_manager = TrainingJobManager(
+    TRAINING_JOB_WORKERS, TRAINING_JOB_HISTORY_SIZE)
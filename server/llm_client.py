@@ -1,31 +1,102 @@
-import google.generativeai as genai
-from google.generativeai.types import HarmCategory, HarmBlockThreshold
+import asyncio
+import json
+import threading
+import time
+
+from collections import OrderedDict
+from concurrent.futures import Future
 
 # Local
-from constants import GEMINI_API_KEY
+from constants import (
+    GEMINI_API_KEY,
+    LLM_API_ENDPOINT,
+    LLM_CACHE_SIZE,
+    LLM_CACHE_TTL_SECONDS,
+    LLM_MAX_CONCURRENT_REQUESTS,
+    LLM_MODEL_NAME,
+    LLM_TIMEOUT_SECONDS,
+)
+from job_manager import run_blocking
+
+
+def is_timeout_error(ex: Exception) -> bool:
+    """
+    Return whether an error of the SDK or its transport means the request ran out of time.
+    """
+    if isinstance(ex, TimeoutError):
+        return True
+    # gRPC raises DeadlineExceeded and the REST transport requests' Timeout, neither a TimeoutError
+    return any(
+        "Timeout" in error_class.__name__ or error_class.__name__ == "DeadlineExceeded"
+        for error_class in type(ex).__mro__
+    )
+
 
 class LLMClient():
     """
     A client for interacting with the Gemini Pro generative model from Google's GenerativeAI.
+    One client is shared by the whole process: at most max_concurrent_requests
+    prompts are sent at once, responses are cached for cache_ttl_seconds, and
+    identical prompts already in flight share one request.
     """
 
-    model: genai.GenerativeModel = None  # The generative model
+    model = None  # The generative model
+    model_name: str = None  # Name of the generative model
+    timeout_seconds: float = 0.0  # Longest time a prompt may take, including the wait for a free slot
+    cache_size: int = 0  # Maximum number of cached responses
+    cache_ttl_seconds: float = 0.0  # Time a cached response stays valid
 
-    def __init__(self):
+    def __init__(
+        self,
+        model_name: str = LLM_MODEL_NAME,
+        max_concurrent_requests: int = LLM_MAX_CONCURRENT_REQUESTS,
+        timeout_seconds: float = LLM_TIMEOUT_SECONDS,
+        cache_size: int = LLM_CACHE_SIZE,
+        cache_ttl_seconds: float = LLM_CACHE_TTL_SECONDS
+    ):
         """
         Initialize the LLMClient and the generative model.
         """
+        self.model_name = model_name
+        self.timeout_seconds = timeout_seconds
+        self.cache_size = cache_size
+        self.cache_ttl_seconds = cache_ttl_seconds
+        self._semaphore = threading.BoundedSemaphore(max_concurrent_requests)
+        self._lock = threading.Lock()
+        self._cache: OrderedDict = OrderedDict()  # Cache key -> (expiry time, response text)
+        self._in_flight: dict[tuple, Future] = {}  # Cache key -> future of the request being sent
+        self._counters = {
+            "requests": 0,
+            "hits": 0,
+            "coalesced": 0,
+            "errors": 0,
+            "timeouts": 0,
+            "request_seconds_total": 0.0,
+        }
         self.__init_gemini_model__()
 
-    def __init_gemini_model__(self) -> genai.GenerativeModel:
+    def __init_gemini_model__(self):
         """
         Initialize the Gemini Pro generative model with the provided API key and safety settings.
         """
-        # Configure the GenerativeAI with the API key
-        genai.configure(api_key=GEMINI_API_KEY)
+        if not GEMINI_API_KEY:
+            raise RuntimeError("GEMINI_API_KEY is not set")
+        # The SDK is slow to import, so it is only loaded once a client is built
+        import google.generativeai as genai
+        from google.generativeai.types import HarmCategory, HarmBlockThreshold
+
+        # Configure the GenerativeAI with the API key, or point it at a stand-in server
+        if LLM_API_ENDPOINT:
+            genai.configure(
+                api_key=GEMINI_API_KEY,
+                transport="rest",
+                client_options={"api_endpoint": LLM_API_ENDPOINT}
+            )
+        else:
+            genai.configure(api_key=GEMINI_API_KEY)
         # Initialize the generative model with the model path and safety settings
         self.model = genai.GenerativeModel(
-            "models/gemini-pro",
+            self.model_name,
             safety_settings={
                 # Set the harm block thresholds for hate speech and harassment to none
                 HarmCategory.HARM_CATEGORY_HATE_SPEECH: HarmBlockThreshold.BLOCK_NONE,
@@ -33,9 +104,152 @@ class LLMClient():
             }
         )
 
-    def prompt(self, text: str) -> str:
+    def _cache_key(self, text: str, generation_config: dict) -> tuple:
+        """
+        Return the key identifying a prompt together with the settings it is sent with.
+        """
+        return (
+            self.model_name,
+            json.dumps(generation_config or {}, sort_keys=True),
+            text
+        )
+
+    def _claim(self, cache_key: tuple) -> tuple[Future, bool]:
+        """
+        Return the future of a prompt and whether the caller must send the request.
+        The future is already resolved on a cache hit, and shared when the prompt is in flight.
+        """
+        with self._lock:
+            cache_entry = self._cache.get(cache_key)
+            if cache_entry is not None:
+                expires_at, response_text = cache_entry
+                if expires_at > time.monotonic():
+                    self._cache.move_to_end(cache_key)
+                    self._counters["hits"] += 1
+                    future = Future()
+                    future.set_result(response_text)
+                    return future, False
+                del self._cache[cache_key]
+
+            future = self._in_flight.get(cache_key)
+            if future is not None:
+                self._counters["coalesced"] += 1
+                return future, False
+            future = Future()
+            self._in_flight[cache_key] = future
+            return future, True
+
+    def _send(self, cache_key: tuple, text: str, generation_config: dict, future: Future):
+        """
+        Send a prompt to the model, resolve its future and cache the response.
+        """
+        request_start_time = time.perf_counter()
+        try:
+            # Waiting for a free slot counts against the timeout of the prompt
+            if not self._semaphore.acquire(timeout=self.timeout_seconds):
+                raise TimeoutError(
+                    f"No free LLM request slot within {self.timeout_seconds}s")
+            try:
+                remaining_seconds = max(
+                    0.1, self.timeout_seconds - (time.perf_counter() - request_start_time))
+                response = self.model.generate_content(
+                    text,
+                    generation_config=generation_config,
+                    request_options={"timeout": remaining_seconds}
+                )
+                # Generate content using the model and return the text, stripped of leading/trailing whitespace
+                response_text = response.text.strip()
+            finally:
+                self._semaphore.release()
+        except Exception as ex:
+            is_timeout = is_timeout_error(ex)
+            with self._lock:
+                self._in_flight.pop(cache_key, None)
+                self._counters["requests"] += 1
+                self._counters["errors"] += 1
+                if is_timeout:
+                    self._counters["timeouts"] += 1
+            if is_timeout and not isinstance(ex, TimeoutError):
+                # Callers only need to handle one timeout error, whichever transport is used
+                timeout_error = TimeoutError(
+                    f"LLM request timed out after {self.timeout_seconds}s")
+                timeout_error.__cause__ = ex
+                ex = timeout_error
+            future.set_exception(ex)
+            return
+
+        with self._lock:
+            self._in_flight.pop(cache_key, None)
+            self._counters["requests"] += 1
+            self._counters["request_seconds_total"] += time.perf_counter() - \
+                request_start_time
+            self._cache[cache_key] = (
+                time.monotonic() + self.cache_ttl_seconds, response_text)
+            self._cache.move_to_end(cache_key)
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        future.set_result(response_text)
+
+    def prompt_blocking(self, text: str, generation_config: dict = None) -> str:
+        """
+        Generate content using the Gemini Pro model given a prompt text, blocking the calling thread.
+        Raises TimeoutError if no response arrives within timeout_seconds.
+        """
+        cache_key = self._cache_key(text, generation_config)
+        future, must_send = self._claim(cache_key)
+        if must_send:
+            self._send(cache_key, text, generation_config, future)
+        return future.result(timeout=self.timeout_seconds)
+
+    async def prompt(self, text: str, generation_config: dict = None) -> str:
         """
         Generate content using the Gemini Pro model given a prompt text.
+        Raises TimeoutError if no response arrives within timeout_seconds.
         """
-        # Generate content using the model and return the text, stripped of leading/trailing whitespace
-        return self.model.generate_content(text).text.strip()
\ No newline at end of file
+        cache_key = self._cache_key(text, generation_config)
+        future, must_send = self._claim(cache_key)
+        if must_send:
+            # The request keeps running for the other waiters even if this caller is cancelled
+            await asyncio.shield(run_blocking(self._send, cache_key, text, generation_config, future))
+        return await asyncio.wait_for(
+            asyncio.shield(asyncio.wrap_future(future)),
+            timeout=self.timeout_seconds
+        )
+
+    def stats(self) -> dict:
+        """
+        Return request, cache and coalescing counters.
+        """
+        with self._lock:
+            stats_dict = dict(self._counters)
+            stats_dict["cached_responses"] = len(self._cache)
+            stats_dict["in_flight"] = len(self._in_flight)
+        lookups = stats_dict["requests"] + \
+            stats_dict["hits"] + stats_dict["coalesced"]
+        stats_dict["hit_rate"] = (
+            stats_dict["hits"] + stats_dict["coalesced"]) / lookups if lookups else 0.0
+        return stats_dict
+
+
+__llm_client__: LLMClient = None
+__llm_client_lock__ = threading.Lock()
+
+
+def get_llm_client() -> LLMClient:
+    """
+    Return the process-wide LLM client, creating it on first use.
+    """
+    global __llm_client__
+    with __llm_client_lock__:
+        if __llm_client__ is None:
+            __llm_client__ = LLMClient()
+    return __llm_client__
+
+
+def get_llm_client_stats() -> dict:
+    """
+    Return the counters of the process-wide LLM client without creating it.
+    """
+    with __llm_client_lock__:
+        llm_client = __llm_client__
+    return llm_client.stats() if llm_client is not None else None
@@ -1,10 +1,16 @@
 """Module that acts as the entry point for the FastAPI application."""
+import time
 
-from fastapi import FastAPI
+from fastapi import FastAPI, Request
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import PlainTextResponse
 
 # Import routers from local modules
+from constants import PROFILING_TOKEN
+from metrics import http_request_latency, metrics_registry, trace_span
+from profiling import ProfilingMiddleware
 from routes.lichess import router as lichess_router
+from routes.profiles import router as profiles_router
 from routes.train import router as train_router
 
 # Initialize the FastAPI application
@@ -21,10 +27,39 @@ app.add_middleware(
     allow_credentials=True,
 )
 
-# Include the routers for the lichess and train endpoints
+# Include the routers for the lichess, train and profile endpoints
 # The routers handle requests to their respective endpoints
 app.include_router(lichess_router, prefix="/lichess")
 app.include_router(train_router, prefix="/train")
+app.include_router(profiles_router, prefix="/profiles")
+
+# Profile requests that carry the admin profiling token
+# Without a token configured the middleware is not installed, so requests pay nothing for it
+if PROFILING_TOKEN:
+    app.add_middleware(ProfilingMiddleware)
+
+
+@app.middleware("http")
+async def record_request_metrics(request: Request, call_next):
+    """
+    Time every HTTP request until its response starts, labelled by route
+    template rather than path so the number of series stays bounded.
+    """
+    start_time = time.perf_counter()
+    status_code = 500
+    try:
+        with trace_span("http.request", method=request.method, path=request.url.path):
+            response = await call_next(request)
+        status_code = response.status_code
+        return response
+    finally:
+        route = request.scope.get("route")
+        http_request_latency.observe(
+            time.perf_counter() - start_time,
+            request.method,
+            route.path if route is not None else "unmatched",
+            str(status_code)
+        )
 
 
 @app.get("/")
@@ -35,3 +70,14 @@ async def root():
     It returns a simple JSON response {"ping": "pong"}.
     """
     return {"ping": "pong"}
+
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def metrics():
+    """
+    Latency histograms, counters and pipeline gauges in the Prometheus text format.
+    """
+    return PlainTextResponse(
+        metrics_registry.render(),
+        media_type="text/plain; version=0.0.4"
+    )
@@ -0,0 +1,299 @@
+"""Process-wide latency histograms and counters, rendered in the Prometheus text format."""
+import logging
+import math
+import re
+import threading
+import time
+
+from contextlib import contextmanager
+from typing import Callable
+
+# Local
+from constants import METRICS_LATENCY_BUCKETS, TRACING_ENABLED
+
+METRIC_PREFIX = "mirrormate_"
+
+logger = logging.getLogger(__name__)
+
+
+def format_value(value: float) -> str:
+    """
+    Format a sample value the way Prometheus expects it.
+    """
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+def format_labels(label_dict: dict) -> str:
+    """
+    Format label names and values as a Prometheus label set.
+    """
+    if not label_dict:
+        return ""
+    label_list = []
+    for label_name, label_value in label_dict.items():
+        escaped_value = str(label_value).replace(
+            "\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+        label_list.append(f'{label_name}="{escaped_value}"')
+    return "{" + ",".join(label_list) + "}"
+
+
+def get_metric_name(*part_list: str) -> str:
+    """
+    Join name parts into a valid metric name.
+    """
+    return re.sub(r"[^a-zA-Z0-9_]", "_", "_".join(part_list)).lower()
+
+
+class Counter:
+    """
+    A monotonically increasing count per label set.
+    """
+
+    name: str = None  # Metric name, including the prefix
+    help_text: str = None  # Description shown in the exposition
+    label_names: tuple = ()  # Names of the labels, in the order values are passed
+
+    def __init__(self, name: str, help_text: str, label_names: tuple = ()):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = tuple(label_names)
+        self._values: dict[tuple, float] = {}  # Label values -> count
+        self._lock = threading.Lock()
+
+    def inc(self, *label_values, amount: float = 1.0):
+        """
+        Add to the count of a label set.
+        """
+        with self._lock:
+            self._values[label_values] = self._values.get(
+                label_values, 0.0) + amount
+
+    def render(self) -> list[str]:
+        """
+        Return the exposition lines of the counter.
+        """
+        with self._lock:
+            value_items = sorted(self._values.items())
+        line_list = [f"# HELP {self.name} {self.help_text}",
+                     f"# TYPE {self.name} counter"]
+        for label_values, value in value_items:
+            label_dict = dict(zip(self.label_names, label_values))
+            line_list.append(
+                f"{self.name}{format_labels(label_dict)} {format_value(value)}")
+        return line_list
+
+
+class Histogram:
+    """
+    Observed durations per label set, counted into cumulative buckets.
+    """
+
+    name: str = None  # Metric name, including the prefix
+    help_text: str = None  # Description shown in the exposition
+    label_names: tuple = ()  # Names of the labels, in the order values are passed
+    buckets: tuple = ()  # Upper bounds of the buckets, ascending
+
+    def __init__(self, name: str, help_text: str, label_names: tuple = (), buckets: tuple = METRICS_LATENCY_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = tuple(label_names)
+        self.buckets = tuple(sorted(buckets))
+        # Label values -> [count per bucket (non-cumulative, +Inf last), sum, count]
+        self._series: dict[tuple, list] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, *label_values):
+        """
+        Record one observation for a label set.
+        """
+        bucket_index = len(self.buckets)
+        for index, upper_bound in enumerate(self.buckets):
+            if value <= upper_bound:
+                bucket_index = index
+                break
+        with self._lock:
+            series = self._series.get(label_values)
+            if series is None:
+                series = self._series[label_values] = [
+                    [0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][bucket_index] += 1
+            series[1] += value
+            series[2] += 1
+
+    @contextmanager
+    def time(self, *label_values):
+        """
+        Observe the time spent in the block, also when it raises.
+        """
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start_time, *label_values)
+
+    def render(self) -> list[str]:
+        """
+        Return the exposition lines of the histogram.
+        """
+        with self._lock:
+            series_items = sorted(
+                (label_values, (list(series[0]), series[1], series[2]))
+                for label_values, series in self._series.items()
+            )
+        line_list = [f"# HELP {self.name} {self.help_text}",
+                     f"# TYPE {self.name} histogram"]
+        for label_values, (bucket_counts, total, count) in series_items:
+            label_dict = dict(zip(self.label_names, label_values))
+            cumulative_count = 0
+            for upper_bound, bucket_count in zip(self.buckets + (math.inf,), bucket_counts):
+                cumulative_count += bucket_count
+                bucket_labels = dict(label_dict, le=format_value(upper_bound))
+                line_list.append(
+                    f"{self.name}_bucket{format_labels(bucket_labels)} {cumulative_count}")
+            line_list.append(
+                f"{self.name}_sum{format_labels(label_dict)} {format_value(total)}")
+            line_list.append(
+                f"{self.name}_count{format_labels(label_dict)} {count}")
+        return line_list
+
+
+class MetricsRegistry:
+    """
+    The metrics of the process. Histograms and counters are updated as
+    requests run; the statistics of the caches and pools are read as gauges
+    when the metrics are scraped, so they cost nothing in between.
+    """
+
+    def __init__(self):
+        self._metric_list: list = []  # Histograms and counters, in registration order
+        self._stats_functions: dict[str, Callable[[], dict]] = {}  # Gauge group name -> stats function
+        self._lock = threading.Lock()
+
+    def counter(self, name: str, help_text: str, label_names: tuple = ()) -> Counter:
+        """
+        Create and register a counter.
+        """
+        counter = Counter(METRIC_PREFIX + name, help_text, label_names)
+        with self._lock:
+            self._metric_list.append(counter)
+        return counter
+
+    def histogram(self, name: str, help_text: str, label_names: tuple = ()) -> Histogram:
+        """
+        Create and register a latency histogram.
+        """
+        histogram = Histogram(METRIC_PREFIX + name, help_text, label_names)
+        with self._lock:
+            self._metric_list.append(histogram)
+        return histogram
+
+    def register_stats(self, group_name: str, stats_function: Callable[[], dict]):
+        """
+        Expose the numeric entries of a stats dict as gauges named after the group.
+        The function may return None while the component it reports on is not started.
+        """
+        with self._lock:
+            self._stats_functions[group_name] = stats_function
+
+    def render_stats(self) -> list[str]:
+        """
+        Return the exposition lines of the registered stats functions.
+        """
+        with self._lock:
+            stats_function_items = list(self._stats_functions.items())
+        line_list = []
+        for group_name, stats_function in stats_function_items:
+            stats_dict = stats_function()
+            if stats_dict is None:
+                continue
+            for key, value in sorted(stats_dict.items()):
+                if isinstance(value, bool) or not isinstance(value, (int, float)):
+                    continue
+                metric_name = get_metric_name(METRIC_PREFIX + group_name, key)
+                line_list.append(f"# TYPE {metric_name} gauge")
+                line_list.append(f"{metric_name} {format_value(value)}")
+        return line_list
+
+    def render(self) -> str:
+        """
+        Return every metric in the Prometheus text exposition format.
+        """
+        with self._lock:
+            metric_list = list(self._metric_list)
+        line_list = []
+        for metric in metric_list:
+            line_list.extend(metric.render())
+        line_list.extend(self.render_stats())
+        return "\n".join(line_list) + "\n"
+
+
+# Process-wide metrics shared by all requests
+metrics_registry = MetricsRegistry()
+
+# Metrics of the next-move pipeline
+next_move_latency = metrics_registry.histogram(
+    "next_move_seconds",
+    "Time to compute a next move, by the tier that answered it.",
+    ("source",))
+next_move_stage_latency = metrics_registry.histogram(
+    "next_move_stage_seconds",
+    "Time spent in each stage of the next-move pipeline.",
+    ("stage",))
+model_fallback_count = metrics_registry.counter(
+    "model_fallbacks_total",
+    "Model predictions that failed or had no legal move, by error type.",
+    ("reason",))
+http_request_latency = metrics_registry.histogram(
+    "http_request_seconds",
+    "Time until the response of an HTTP request starts, by route and status code.",
+    ("method", "route", "status"))
+
+__tracer__ = None
+__tracer_lock__ = threading.Lock()
+
+
+def get_tracer():
+    """
+    Return the OpenTelemetry tracer, or None when tracing is off or the package is missing.
+    """
+    global __tracer__, TRACING_ENABLED
+    if not TRACING_ENABLED:
+        return None
+    with __tracer_lock__:
+        if __tracer__ is None:
+            try:
+                # Only needed when tracing is turned on
+                from opentelemetry import trace
+            except ImportError:
+                logger.warning(
+                    "TRACING_ENABLED is set but opentelemetry-api is not installed, tracing is off")
+                TRACING_ENABLED = False
+                return None
+            __tracer__ = trace.get_tracer("mirrormate")
+    return __tracer__
+
+
+@contextmanager
+def trace_span(name: str, **attributes):
+    """
+    Run the block in a trace span when tracing is on.
+    """
+    tracer = get_tracer()
+    if tracer is None:
+        yield
+        return
+    with tracer.start_as_current_span(name, attributes=attributes):
+        yield
+
+
+@contextmanager
+def time_stage(stage: str):
+    """
+    Observe the time spent in a stage of the next-move pipeline, in a trace span of its own.
+    """
+    with trace_span(f"next_move.{stage}"), next_move_stage_latency.time(stage):
+        yield
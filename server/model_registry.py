@@ -0,0 +1,251 @@
+"""Registry that keeps loaded persona models resident between requests."""
+import os
+import threading
+import time
+
+import numpy as np
+
+from collections import OrderedDict
+
+# Local
+from constants import MAX_SEQUENCE_LENGTH, MODEL_CACHE_MAX_BYTES, MODEL_CACHE_SIZE
+from persona_pack import PersonaPack, get_persona_pack
+
+# Files that make up a persona model, relative to models/{user}/
+MODEL_ARTIFACT_FILE_NAMES = (
+    "model_arch.json",
+    "model_weights.h5",
+    "tokenizer.pickle",
+    "label_encoder.pickle",
+)
+LOAD_LOCK_STRIPES = 64  # Locks shared by the usernames being loaded, so their number stays fixed
+
+
+def get_user_model_directory(lichess_username: str) -> str:
+    """
+    Return the top-level model directory of a user.
+    """
+    return f"../models/{lichess_username}"
+
+
+def get_model_directory(lichess_username: str) -> str:
+    """
+    Return the directory holding the model artifacts of a user: the version
+    published by the training runner if there is one, otherwise the top-level
+    directory itself.
+    """
+    user_model_directory = get_user_model_directory(lichess_username)
+    current_link_path = os.path.join(user_model_directory, "current")
+    if os.path.isdir(current_link_path):
+        # Resolve the link once so every artifact is read from the same version
+        return os.path.realpath(current_link_path)
+    return user_model_directory
+
+
+def get_artifact_signature(model_directory: str) -> tuple:
+    """
+    Return a signature of the model artifacts that changes whenever any of them is rewritten.
+    Raises FileNotFoundError if an artifact is missing.
+    """
+    signature = []
+    for file_name in MODEL_ARTIFACT_FILE_NAMES:
+        file_stat = os.stat(os.path.join(model_directory, file_name))
+        signature.append((file_stat.st_mtime_ns, file_stat.st_size))
+    return tuple(signature)
+
+
+class PersonaModel:
+    """
+    A loaded persona model together with the tokenizer and label tables it was
+    trained with. The tables are mapped from the persona pack of the model
+    version, so every worker process shares one copy of them.
+    """
+
+    model = None  # Keras model with weights loaded
+    persona_pack: PersonaPack = None  # Tokenizer word index and labels of the model
+    signature: tuple = None  # Artifact signature at load time
+    size_bytes: int = 0  # Approximate resident size, taken from the artifact sizes
+
+    def __init__(self, model_directory: str):
+        """
+        Load the model and its persona pack from a model directory.
+        """
+        # TensorFlow takes seconds to import, so it is loaded with the first model
+        from tensorflow.keras.models import model_from_json
+
+        self.signature = get_artifact_signature(model_directory)
+        self.size_bytes = sum(size for _, size in self.signature)
+
+        # Load the model config and weights
+        with open(os.path.join(model_directory, "model_arch.json"), "r") as model_config_file:
+            model_config = model_config_file.read()
+        self.model = model_from_json(model_config)
+        self.model.load_weights(os.path.join(
+            model_directory, "model_weights.h5"))
+
+        # Map the tokenizer and label tables
+        self.persona_pack = get_persona_pack(model_directory)
+
+    def encode(self, moves_in_san_str_list: list[str]) -> np.ndarray:
+        """
+        Tokenize and pad a batch of SAN move sequences.
+        """
+        from tensorflow.keras.preprocessing.sequence import pad_sequences
+
+        moves_in_san_str_list = [moves.strip()
+                                 for moves in moves_in_san_str_list]
+        sequences = self.persona_pack.texts_to_sequences(moves_in_san_str_list)
+        return pad_sequences(
+            sequences,
+            maxlen=MAX_SEQUENCE_LENGTH,
+            padding="pre"
+        )
+
+    def predict(self, moves_in_san_str_list: list[str]) -> np.ndarray:
+        """
+        Return the move probability distribution for each SAN move sequence in a batch.
+        """
+        padded_sequences = self.encode(moves_in_san_str_list)
+        # Calling the model directly skips the per-call setup of model.predict
+        return self.model(padded_sequences, training=False).numpy()
+
+    def decode(self, prediction: np.ndarray) -> str:
+        """
+        Return the most likely move of a single probability distribution.
+        """
+        return self.persona_pack.label(int(np.argmax(prediction)))
+
+    def decode_legal(self, prediction: np.ndarray, legal_move_list: list[str], top_k: int) -> list[tuple[str, float]]:
+        """
+        Return the top_k most likely legal moves of a single probability distribution,
+        with probabilities renormalized over the legal moves. Returns an empty list if
+        the model never saw any of the legal moves.
+        """
+        candidate_list = []
+        for move in legal_move_list:
+            label_index_array = self.persona_pack.label_indexes(move)
+            if label_index_array is None:
+                continue
+            probability = float(prediction[label_index_array].sum())
+            if probability > 0:
+                candidate_list.append((move, probability))
+        legal_probability = sum(probability for _, probability in candidate_list)
+        if legal_probability <= 0:
+            return []
+        candidate_list.sort(key=lambda candidate: candidate[1], reverse=True)
+        return [
+            (move, probability / legal_probability)
+            for move, probability in candidate_list[:top_k]
+        ]
+
+
+class ModelRegistry:
+    """
+    A process-level LRU cache of persona models bounded by model count and
+    total artifact size. Entries are reloaded when their artifacts change.
+    """
+
+    max_models: int = 0  # Maximum number of models kept resident
+    max_bytes: int = 0  # Maximum total artifact size kept resident
+
+    def __init__(self, max_models: int, max_bytes: int):
+        self.max_models = max_models
+        self.max_bytes = max_bytes
+        self._entries: OrderedDict = OrderedDict()  # Username -> PersonaModel
+        self._lock = threading.Lock()
+        # Lock held while loading, picked by username hash; unrelated users rarely share one
+        self._load_locks = [threading.Lock() for _ in range(LOAD_LOCK_STRIPES)]
+        self._counters = {
+            "hits": 0,
+            "misses": 0,
+            "reloads": 0,
+            "evictions": 0,
+            "load_seconds_total": 0.0,
+        }
+
+    def get(self, lichess_username: str) -> PersonaModel:
+        """
+        Return the persona model of a user, loading it if it is missing or stale.
+        """
+        model_directory = get_model_directory(lichess_username)
+        signature = get_artifact_signature(model_directory)
+
+        with self._lock:
+            persona_model = self._entries.get(lichess_username)
+            if persona_model is not None and persona_model.signature == signature:
+                self._entries.move_to_end(lichess_username)
+                self._counters["hits"] += 1
+                return persona_model
+        load_lock = self._load_locks[hash(lichess_username) % LOAD_LOCK_STRIPES]
+
+        # Only one thread loads a given user; the others wait and reuse its result
+        with load_lock:
+            with self._lock:
+                persona_model = self._entries.get(lichess_username)
+                if persona_model is not None and persona_model.signature == signature:
+                    self._entries.move_to_end(lichess_username)
+                    self._counters["hits"] += 1
+                    return persona_model
+                is_reload = persona_model is not None
+
+            load_start_time = time.perf_counter()
+            persona_model = PersonaModel(model_directory)
+            load_seconds = time.perf_counter() - load_start_time
+
+            with self._lock:
+                self._counters["misses"] += 1
+                self._counters["load_seconds_total"] += load_seconds
+                if is_reload:
+                    self._counters["reloads"] += 1
+                self._entries[lichess_username] = persona_model
+                self._entries.move_to_end(lichess_username)
+                self._evict()
+        return persona_model
+
+    def _evict(self):
+        """
+        Drop least recently used models until the registry is within its bounds.
+        The most recently used model is always kept. Caller must hold the lock.
+        """
+        while len(self._entries) > 1 and (
+            len(self._entries) > self.max_models
+            or self.resident_bytes() > self.max_bytes
+        ):
+            self._entries.popitem(last=False)
+            self._counters["evictions"] += 1
+
+    def resident_bytes(self) -> int:
+        """
+        Return the total artifact size of the resident models.
+        """
+        return sum(persona_model.size_bytes for persona_model in self._entries.values())
+
+    def invalidate(self, lichess_username: str):
+        """
+        Drop the resident model of a user.
+        """
+        with self._lock:
+            self._entries.pop(lichess_username, None)
+
+    def stats(self) -> dict:
+        """
+        Return hit/miss/load-time counters and current occupancy.
+        """
+        with self._lock:
+            stats_dict = dict(self._counters)
+            stats_dict["resident_models"] = len(self._entries)
+            stats_dict["resident_bytes"] = self.resident_bytes()
+        lookups = stats_dict["hits"] + stats_dict["misses"]
+        stats_dict["hit_rate"] = stats_dict["hits"] / lookups if lookups else 0.0
+        return stats_dict
+
+
+# Process-wide registry shared by all requests
+model_registry = ModelRegistry(MODEL_CACHE_SIZE, MODEL_CACHE_MAX_BYTES)
+
+
+def get_persona_model(lichess_username: str) -> PersonaModel:
+    """
+    Return the resident persona model of a user.
+    """
+    return model_registry.get(lichess_username)
@@ -0,0 +1,335 @@
+"""Per-user opening book stored as a compact, memory-mapped move tree."""
+import csv
+import mmap
+import os
+import re
+import struct
+import threading
+
+import numpy as np
+
+from collections import OrderedDict
+
+# Local
+from constants import OPENING_BOOK_CACHE_SIZE
+from metrics import time_stage
+from persona_registry import MOVE_TREE_ARTIFACT, get_file_artifact, persona_registry
+
+# File layout (little endian):
+#   header: magic, version, node count, vocabulary size, vocabulary blob size
+#   child_offsets  uint32[node_count + 1]  children of node i are nodes child_offsets[i]..child_offsets[i + 1] - 1
+#   node_moves     uint16[node_count]      move ID of the edge into each node (NO_MOVE for the root)
+#   user_counts    uint32[node_count]      times the user played the move into each node
+#   best_moves     int32[node_count]       most played continuation of each node, -1 if none
+#   vocabulary     utf-8 SAN moves separated by newlines
+# Nodes are stored breadth first, so the children of a node are contiguous.
+MOVE_TREE_MAGIC = b"MVTREE\0\0"
+MOVE_TREE_VERSION = 1
+MOVE_TREE_HEADER = struct.Struct("<8sIIII")
+NO_MOVE = 0xFFFF
+MAX_VOCABULARY_SIZE = NO_MOVE  # Move IDs must fit in uint16
+
+
+def normalize_san(move: str) -> str:
+    """
+    Strip check, mate and promotion markers so client and stored moves compare equal.
+    """
+    # Same character filter compute_next_move applies to the incoming partial sequence
+    return re.sub(r"[^a-zA-Z0-9-]", "", move)
+
+
+def align(offset: int, alignment: int = 8) -> int:
+    """
+    Round an offset up to a multiple of alignment.
+    """
+    return (offset + alignment - 1) // alignment * alignment
+
+
+class OpeningBookBuilder:
+    """
+    Builds the move tree of a user one game or one continuation at a time and
+    writes it to disk. Memory grows with the number of distinct positions, not
+    with the number of move prefixes.
+    """
+
+    def __init__(self):
+        self.vocabulary: dict[str, int] = {}  # SAN move -> move ID
+        # A node is [children (move ID -> node), user count]
+        self.root: list = [{}, 0]
+        self.node_count = 1
+
+    def move_id(self, move: str) -> int:
+        """
+        Return the ID of a SAN move, assigning the next free one to new moves.
+        """
+        move_id = self.vocabulary.get(move)
+        if move_id is None:
+            if len(self.vocabulary) >= MAX_VOCABULARY_SIZE:
+                raise ValueError("Too many distinct moves for an opening book")
+            move_id = len(self.vocabulary)
+            self.vocabulary[move] = move_id
+        return move_id
+
+    def child(self, node: list, move: str) -> list:
+        """
+        Return the child of a node along a move, creating it if needed.
+        """
+        move_id = self.move_id(move)
+        child = node[0].get(move_id)
+        if child is None:
+            child = [{}, 0]
+            node[0][move_id] = child
+            self.node_count += 1
+        return child
+
+    def add_game(self, move_list: list[str], user_plays_white: bool):
+        """
+        Record a whole game, counting the moves the user played.
+        """
+        node = self.root
+        user_ply_parity = 0 if user_plays_white else 1
+        for ply_index, move in enumerate(move for move in move_list if move != ""):
+            node = self.child(node, move)
+            if ply_index % 2 == user_ply_parity:
+                node[1] += 1
+
+    def add_continuation(self, move_list: list[str], target_move: str, count: int = 1):
+        """
+        Record that the user played target_move after the given move list.
+        """
+        node = self.root
+        for move in move_list:
+            if move == "":
+                continue
+            node = self.child(node, move)
+        self.child(node, target_move)[1] += count
+
+    def write(self, file_path: str):
+        """
+        Write the move tree to a file, replacing it atomically.
+        """
+        child_offsets = np.zeros(self.node_count + 1, dtype="<u4")
+        node_moves = np.full(self.node_count, NO_MOVE, dtype="<u2")
+        user_counts = np.zeros(self.node_count, dtype="<u4")
+        best_moves = np.full(self.node_count, -1, dtype="<i4")
+
+        # Number the nodes breadth first so siblings are contiguous
+        node_queue = [self.root]
+        next_node_index = 1
+        for node_index, node in enumerate(node_queue):
+            child_offsets[node_index] = next_node_index
+            best_count = 0
+            # Ties resolve to the continuation seen first
+            for move_id, child in node[0].items():
+                node_moves[next_node_index] = move_id
+                user_counts[next_node_index] = child[1]
+                if child[1] > best_count:
+                    best_count = child[1]
+                    best_moves[node_index] = move_id
+                node_queue.append(child)
+                next_node_index += 1
+        child_offsets[self.node_count] = next_node_index
+
+        vocabulary_blob = "\n".join(self.vocabulary).encode("utf-8")
+        # A private temporary file lets concurrent writers race safely
+        temporary_file_path = f"{file_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(temporary_file_path, "wb") as move_tree_file:
+            move_tree_file.write(MOVE_TREE_HEADER.pack(
+                MOVE_TREE_MAGIC,
+                MOVE_TREE_VERSION,
+                self.node_count,
+                len(self.vocabulary),
+                len(vocabulary_blob)
+            ))
+            for array in (child_offsets, node_moves, user_counts, best_moves):
+                move_tree_file.write(
+                    b"\0" * (align(move_tree_file.tell()) - move_tree_file.tell()))
+                move_tree_file.write(array.tobytes())
+            move_tree_file.write(vocabulary_blob)
+        os.replace(temporary_file_path, file_path)
+
+
+class OpeningBook:
+    """
+    A read-only move tree mapped from disk. The arrays are views into the file
+    mapping, so loading costs one mmap call plus decoding the move vocabulary,
+    and looking up the most played continuation costs O(plies x branching).
+    """
+
+    node_count: int = 0  # Number of positions in the tree
+
+    def __init__(self, file_path: str):
+        with open(file_path, "rb") as move_tree_file:
+            self._mapping = mmap.mmap(
+                move_tree_file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, self.node_count, vocabulary_size, vocabulary_blob_size = \
+            MOVE_TREE_HEADER.unpack_from(self._mapping, 0)
+        if magic != MOVE_TREE_MAGIC or version != MOVE_TREE_VERSION:
+            raise ValueError(f"{file_path} is not a version {MOVE_TREE_VERSION} move tree")
+
+        offset = MOVE_TREE_HEADER.size
+        array_list = []
+        for dtype, count in (
+            ("<u4", self.node_count + 1),
+            ("<u2", self.node_count),
+            ("<u4", self.node_count),
+            ("<i4", self.node_count),
+        ):
+            offset = align(offset)
+            array_list.append(np.frombuffer(
+                self._mapping, dtype=dtype, count=count, offset=offset))
+            offset += array_list[-1].nbytes
+        self.child_offsets, self.node_moves, self.user_counts, self.best_moves = array_list
+
+        vocabulary_blob = self._mapping[offset:offset + vocabulary_blob_size]
+        self.vocabulary: list[str] = vocabulary_blob.decode(
+            "utf-8").split("\n") if vocabulary_size else []
+        self.normalized_vocabulary = [
+            normalize_san(move) for move in self.vocabulary]
+
+    def child_node(self, node_index: int, move: str) -> int:
+        """
+        Follow one SAN move from a node. Returns the child node index, or None if the move was never played there.
+        """
+        move = normalize_san(move)
+        if move == "":
+            return node_index
+        for child_index in range(self.child_offsets[node_index], self.child_offsets[node_index + 1]):
+            if self.normalized_vocabulary[self.node_moves[child_index]] == move:
+                return child_index
+        return None
+
+    def find_node(self, move_list: list[str]) -> int:
+        """
+        Walk the tree along a list of SAN moves. Returns the node index, or None if the line was never played.
+        """
+        node_index = 0
+        for move in move_list:
+            node_index = self.child_node(node_index, move)
+            if node_index is None:
+                return None
+        return node_index
+
+    def best_move_at(self, node_index: int) -> str:
+        """
+        Return the user's most played move at a node, or None.
+        """
+        if node_index is None or self.best_moves[node_index] < 0:
+            return None
+        return self.vocabulary[self.best_moves[node_index]]
+
+    def best_continuation(self, move_list: list[str]) -> str:
+        """
+        Return the user's most played move after the given move list, or None.
+        """
+        return self.best_move_at(self.find_node(move_list))
+
+    def continuation_counts(self, move_list: list[str]) -> dict[str, int]:
+        """
+        Return how often the user played each move after the given move list.
+        """
+        node_index = self.find_node(move_list)
+        if node_index is None:
+            return {}
+        return {
+            self.vocabulary[self.node_moves[child_index]]: int(self.user_counts[child_index])
+            for child_index in range(self.child_offsets[node_index], self.child_offsets[node_index + 1])
+            if self.user_counts[child_index] > 0
+        }
+
+
+def get_sequence_target_map_path(lichess_username: str) -> str:
+    """
+    Return the path of the legacy processed sequence/target file of a user.
+    """
+    return f"../data/processed/sequence_target_map_{lichess_username}.csv"
+
+
+def get_move_tree_path(lichess_username: str) -> str:
+    """
+    Return the path of the move tree file of a user.
+    """
+    return f"../data/processed/move_tree_{lichess_username}.bin"
+
+
+def convert_sequence_target_csv(csv_file_path: str, move_tree_file_path: str):
+    """
+    Convert a legacy sequence_target_map CSV file into a move tree file.
+    """
+    opening_book_builder = OpeningBookBuilder()
+    with open(csv_file_path, "r") as csv_file:
+        csv_reader = csv.DictReader(csv_file)
+        for row in csv_reader:
+            input_sequence = row.get("input_sequence") or ""
+            target_move = (row.get("target_move") or "").strip()
+            if target_move == "":
+                continue
+            opening_book_builder.add_continuation(
+                input_sequence.split(" "), target_move)
+    opening_book_builder.write(move_tree_file_path)
+
+
+class OpeningBookRegistry:
+    """
+    A process-level LRU cache of opening books. Entries are keyed by username
+    and reloaded when the move tree file on disk changes.
+    """
+
+    capacity: int = 0  # Maximum number of opening books kept in memory
+
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self._entries: OrderedDict = OrderedDict()  # Username -> (file signature, OpeningBook)
+        self._lock = threading.Lock()
+
+    def get(self, lichess_username: str) -> OpeningBook:
+        """
+        Return the opening book of a user, loading it if it is missing or stale.
+        Users that only have a legacy sequence/target CSV are converted on first use.
+        Raises FileNotFoundError if the user has no processed data.
+        """
+        file_path = get_move_tree_path(lichess_username)
+        if not os.path.exists(file_path):
+            convert_sequence_target_csv(
+                get_sequence_target_map_path(lichess_username), file_path)
+            persona_registry.record(
+                lichess_username, MOVE_TREE_ARTIFACT, get_file_artifact(file_path))
+        file_stat = os.stat(file_path)
+        signature = (file_stat.st_mtime_ns, file_stat.st_size)
+
+        with self._lock:
+            entry = self._entries.get(lichess_username)
+            if entry is not None and entry[0] == signature:
+                self._entries.move_to_end(lichess_username)
+                return entry[1]
+
+        # Load outside the lock so a cold user does not block lookups for others
+        opening_book = OpeningBook(file_path)
+
+        with self._lock:
+            self._entries[lichess_username] = (signature, opening_book)
+            self._entries.move_to_end(lichess_username)
+            # Evict the least recently used users
+            while len(self._entries) > self.capacity:
+                self._entries.popitem(last=False)
+        return opening_book
+
+    def invalidate(self, lichess_username: str):
+        """
+        Drop the cached opening book of a user.
+        """
+        with self._lock:
+            self._entries.pop(lichess_username, None)
+
+
+# Process-wide registry shared by all requests
+opening_book_registry = OpeningBookRegistry(OPENING_BOOK_CACHE_SIZE)
+
+
+def get_opening_book(lichess_username: str) -> OpeningBook:
+    """
+    Return the cached opening book of a user.
+    """
+    # Covers the conversion of a legacy CSV and the load of a move tree that is not cached yet
+    with time_stage("opening_book_load"):
+        return opening_book_registry.get(lichess_username)
@@ -0,0 +1,302 @@
+"""Read-only label and tokenizer tables of a persona model, memory-mapped so worker processes share them."""
+import json
+import mmap
+import os
+import pickle
+import struct
+import sys
+import threading
+import zlib
+
+import numpy as np
+
+# Local
+from opening_book import align, normalize_san
+
+PERSONA_PACK_FILE_NAME = "persona_pack.bin"  # Written next to the model artifacts of a version
+PERSONA_PACK_SOURCE_FILE_NAMES = ("tokenizer.pickle", "label_encoder.pickle")  # Artifacts a pack is built from
+PERSONA_PACK_MAGIC = b"PRSPACK\0"
+PERSONA_PACK_VERSION = 1
+# Magic, version, size of the JSON layout that follows
+PERSONA_PACK_HEADER = struct.Struct("<8sII")
+EMPTY_SLOT = -1
+
+
+def get_table_size(key_count: int) -> int:
+    """
+    Return the number of hash table slots for a key count: a power of two at least twice as large.
+    """
+    table_size = 8
+    while table_size < 2 * key_count:
+        table_size *= 2
+    return table_size
+
+
+def build_string_arrays(string_list: list[str]) -> tuple[np.ndarray, bytes]:
+    """
+    Concatenate strings into one UTF-8 blob with the offset of each string, plus one for the end.
+    """
+    encoded_list = [string.encode("utf-8") for string in string_list]
+    string_offsets = np.zeros(len(encoded_list) + 1, dtype="<u4")
+    np.cumsum([len(encoded) for encoded in encoded_list], out=string_offsets[1:])
+    return string_offsets, b"".join(encoded_list)
+
+
+def build_hash_table(string_list: list[str]) -> np.ndarray:
+    """
+    Build an open-addressing hash table mapping each string to its position in the list.
+    """
+    hash_table = np.full(get_table_size(len(string_list)), EMPTY_SLOT, dtype="<i4")
+    mask = len(hash_table) - 1
+    for string_index, string in enumerate(string_list):
+        slot = zlib.crc32(string.encode("utf-8")) & mask
+        while hash_table[slot] != EMPTY_SLOT:
+            slot = (slot + 1) & mask
+        hash_table[slot] = string_index
+    return hash_table
+
+
+def build_persona_pack(label_list: list[str], tokenizer) -> bytes:
+    """
+    Lay out the labels of a label encoder, the labels grouped by the move they
+    spell, and the word index of a Keras tokenizer as one read-only blob.
+    """
+    label_list = [str(label).strip() for label in label_list]
+    group_label_lists: dict[str, list[int]] = {}
+    for label_index, label in enumerate(label_list):
+        # Labels such as "Qh5" and "Qh5+" name the same move in a given position
+        group_label_lists.setdefault(normalize_san(label), []).append(label_index)
+    group_key_list = list(group_label_lists)
+    group_offsets = np.zeros(len(group_key_list) + 1, dtype="<u4")
+    np.cumsum([len(group_label_lists[key]) for key in group_key_list], out=group_offsets[1:])
+    group_label_indexes = np.array(
+        [label_index for key in group_key_list for label_index in group_label_lists[key]], dtype="<u4")
+
+    word_index = getattr(tokenizer, "word_index", None) or {}
+    word_list = list(word_index)
+    word_ids = np.array([word_index[word] for word in word_list], dtype="<u4")
+
+    label_offsets, label_blob = build_string_arrays(label_list)
+    group_key_offsets, group_key_blob = build_string_arrays(group_key_list)
+    word_offsets, word_blob = build_string_arrays(word_list)
+    section_list = [
+        ("label_offsets", label_offsets),
+        ("label_blob", label_blob),
+        ("group_key_offsets", group_key_offsets),
+        ("group_key_blob", group_key_blob),
+        ("group_table", build_hash_table(group_key_list)),
+        ("group_offsets", group_offsets),
+        ("group_label_indexes", group_label_indexes),
+        ("word_offsets", word_offsets),
+        ("word_blob", word_blob),
+        ("word_table", build_hash_table(word_list)),
+        ("word_ids", word_ids),
+    ]
+
+    # Section offsets are relative to the end of the layout, so the layout can describe itself
+    layout = {
+        "label_count": len(label_list),
+        "group_count": len(group_key_list),
+        "word_count": len(word_list),
+        # Settings texts_to_sequences needs to split text the way the tokenizer did
+        "tokenizer": {
+            "filters": getattr(tokenizer, "filters", ""),
+            "lower": getattr(tokenizer, "lower", True),
+            "split": getattr(tokenizer, "split", " "),
+            "num_words": getattr(tokenizer, "num_words", None),
+            "oov_index": word_index.get(getattr(tokenizer, "oov_token", None)),
+        },
+        "sections": {},
+    }
+    section_bytes_list = []
+    offset = 0
+    for section_name, section in section_list:
+        offset = align(offset)
+        section_bytes = section if isinstance(section, bytes) else section.tobytes()
+        layout["sections"][section_name] = {
+            "offset": offset,
+            "size": len(section_bytes),
+            "dtype": None if isinstance(section, bytes) else section.dtype.str,
+        }
+        section_bytes_list.append((offset, section_bytes))
+        offset += len(section_bytes)
+
+    layout_blob = json.dumps(layout, sort_keys=True).encode("utf-8")
+    data_start = align(PERSONA_PACK_HEADER.size + len(layout_blob))
+    pack = bytearray(data_start + offset)
+    PERSONA_PACK_HEADER.pack_into(
+        pack, 0, PERSONA_PACK_MAGIC, PERSONA_PACK_VERSION, len(layout_blob))
+    pack[PERSONA_PACK_HEADER.size:PERSONA_PACK_HEADER.size + len(layout_blob)] = layout_blob
+    for section_offset, section_bytes in section_bytes_list:
+        pack[data_start + section_offset:data_start + section_offset + len(section_bytes)] = section_bytes
+    return bytes(pack)
+
+
+def write_persona_pack(file_path: str, label_list: list[str], tokenizer):
+    """
+    Write the persona pack of a model to a file, replacing it atomically.
+    """
+    pack = build_persona_pack(label_list, tokenizer)
+    # A private temporary file lets concurrent writers race safely
+    temporary_file_path = f"{file_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(temporary_file_path, "wb") as pack_file:
+        pack_file.write(pack)
+    os.replace(temporary_file_path, file_path)
+
+
+class PersonaPack:
+    """
+    The label and tokenizer tables of a persona model, read in place from a
+    buffer. Backed by a file mapping, the tables are shared by every process
+    that opens the same file, and a process holding an old version keeps
+    reading it after a new one replaced the file.
+    """
+
+    label_count: int = 0  # Number of labels the model predicts
+    tokenizer_config: dict = None  # How text is split into words
+
+    def __init__(self, buffer):
+        self._buffer = buffer
+        magic, version, layout_size = PERSONA_PACK_HEADER.unpack_from(buffer, 0)
+        if magic != PERSONA_PACK_MAGIC or version != PERSONA_PACK_VERSION:
+            raise ValueError(f"Not a version {PERSONA_PACK_VERSION} persona pack")
+        layout = json.loads(bytes(
+            buffer[PERSONA_PACK_HEADER.size:PERSONA_PACK_HEADER.size + layout_size]))
+        data_start = align(PERSONA_PACK_HEADER.size + layout_size)
+        self.label_count = layout["label_count"]
+        self.tokenizer_config = layout["tokenizer"]
+
+        buffer_view = memoryview(buffer)
+        for section_name, section in layout["sections"].items():
+            start = data_start + section["offset"]
+            if section["dtype"] is None:
+                # Blobs are sliced per lookup, so only their bounds are kept
+                setattr(self, f"_{section_name}_start", start)
+            elif sys.byteorder == "little":
+                # Memoryviews index faster than numpy arrays one element at a time
+                setattr(self, f"_{section_name}", buffer_view[start:start + section["size"]].cast(
+                    np.dtype(section["dtype"]).char))
+            else:
+                # Packs are little-endian, which native memoryviews cannot read here
+                setattr(self, f"_{section_name}", np.frombuffer(
+                    buffer, dtype=section["dtype"], count=section["size"] // np.dtype(section["dtype"]).itemsize,
+                    offset=start))
+        self._blob = buffer_view
+        self._group_label_index_array = np.frombuffer(
+            buffer, dtype="<u4", count=layout["sections"]["group_label_indexes"]["size"] // 4,
+            offset=data_start + layout["sections"]["group_label_indexes"]["offset"])
+        filters = self.tokenizer_config["filters"] or ""
+        self._translate_map = str.maketrans(
+            {char: self.tokenizer_config["split"] for char in filters})
+
+    def _string_at(self, blob_start: int, string_offsets: memoryview, index: int) -> memoryview:
+        """
+        Return the bytes of one string of a blob.
+        """
+        return self._blob[blob_start + string_offsets[index]:blob_start + string_offsets[index + 1]]
+
+    def _find(self, hash_table: memoryview, blob_start: int, string_offsets: memoryview, key: str) -> int:
+        """
+        Return the position of a string in a hash table, or None if it is not there.
+        """
+        key_bytes = key.encode("utf-8")
+        mask = len(hash_table) - 1
+        slot = zlib.crc32(key_bytes) & mask
+        while True:
+            string_index = hash_table[slot]
+            if string_index == EMPTY_SLOT:
+                return None
+            if self._string_at(blob_start, string_offsets, string_index) == key_bytes:
+                return string_index
+            slot = (slot + 1) & mask
+
+    def label(self, label_index: int) -> str:
+        """
+        Return the SAN move of a label.
+        """
+        return str(self._string_at(self._label_blob_start, self._label_offsets, label_index), "utf-8")
+
+    def label_indexes(self, move: str) -> np.ndarray:
+        """
+        Return the indexes of the labels spelling a SAN move, or None if the model never saw it.
+        """
+        group_index = self._find(
+            self._group_table, self._group_key_blob_start, self._group_key_offsets, normalize_san(move))
+        if group_index is None:
+            return None
+        return self._group_label_index_array[self._group_offsets[group_index]:self._group_offsets[group_index + 1]]
+
+    def word_id(self, word: str) -> int:
+        """
+        Return the tokenizer index of a word, or None if the tokenizer never saw it.
+        """
+        word_index = self._find(
+            self._word_table, self._word_blob_start, self._word_offsets, word)
+        return self._word_ids[word_index] if word_index is not None else None
+
+    def texts_to_sequences(self, text_list: list[str]) -> list[list[int]]:
+        """
+        Turn texts into sequences of word indexes, as Tokenizer.texts_to_sequences does.
+        """
+        num_words = self.tokenizer_config["num_words"]
+        oov_index = self.tokenizer_config["oov_index"]
+        split = self.tokenizer_config["split"]
+        sequence_list = []
+        for text in text_list:
+            if self.tokenizer_config["lower"]:
+                text = text.lower()
+            sequence = []
+            for word in text.translate(self._translate_map).split(split):
+                if not word:
+                    continue
+                word_id = self.word_id(word)
+                if word_id is not None and not (num_words and word_id >= num_words):
+                    sequence.append(word_id)
+                elif oov_index is not None:
+                    sequence.append(oov_index)
+            sequence_list.append(sequence)
+        return sequence_list
+
+
+def open_persona_pack(file_path: str) -> PersonaPack:
+    """
+    Map a persona pack file read-only.
+    """
+    with open(file_path, "rb") as pack_file:
+        mapping = mmap.mmap(pack_file.fileno(), 0, access=mmap.ACCESS_READ)
+    return PersonaPack(mapping)
+
+
+def is_persona_pack_current(model_directory: str) -> bool:
+    """
+    Return whether the persona pack of a model exists and is newer than the pickles it is built from.
+    """
+    try:
+        pack_mtime_ns = os.stat(os.path.join(model_directory, PERSONA_PACK_FILE_NAME)).st_mtime_ns
+    except FileNotFoundError:
+        return False
+    return all(
+        os.stat(os.path.join(model_directory, file_name)).st_mtime_ns <= pack_mtime_ns
+        for file_name in PERSONA_PACK_SOURCE_FILE_NAMES
+    )
+
+
+def get_persona_pack(model_directory: str) -> PersonaPack:
+    """
+    Return the persona pack of a model version. Versions published before
+    packs existed, and the flat models/{user}/ layout whose pickles can be
+    replaced in place, get one built from their pickled tokenizer and label
+    encoder whenever the pack is missing or older than the pickles; if the
+    directory is read-only, this process keeps its own copy.
+    """
+    file_path = os.path.join(model_directory, PERSONA_PACK_FILE_NAME)
+    if not is_persona_pack_current(model_directory):
+        with open(os.path.join(model_directory, "tokenizer.pickle"), "rb") as tokenizer_file:
+            tokenizer = pickle.load(tokenizer_file)
+        with open(os.path.join(model_directory, "label_encoder.pickle"), "rb") as label_encoder_file:
+            label_encoder = pickle.load(label_encoder_file)
+        try:
+            write_persona_pack(file_path, label_encoder.classes_, tokenizer)
+        except OSError:
+            return PersonaPack(build_persona_pack(label_encoder.classes_, tokenizer))
+    return open_persona_pack(file_path)
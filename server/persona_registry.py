@@ -0,0 +1,235 @@
+"""Registry of the artifacts that make up each persona, backed by a manifest file."""
+import fcntl
+import json
+import os
+import threading
+import time
+
+# Local
+from constants import PERSONA_MANIFEST_PATH
+
+# Artifacts tracked per user
+RAW_ARTIFACT = "raw"  # Raw game history CSV
+PROCESSED_ARTIFACT = "processed"  # Legacy sequence/target CSV
+MOVE_TREE_ARTIFACT = "move_tree"  # Opening book index built from the raw games
+MODEL_ARTIFACT = "model"  # Published persona model
+
+
+def get_file_artifact(file_path: str, **fields) -> dict:
+    """
+    Describe a file artifact by its path, size and modification time.
+    Raises FileNotFoundError if the file does not exist.
+    """
+    file_stat = os.stat(file_path)
+    artifact = {
+        "path": file_path,
+        "size_bytes": file_stat.st_size,
+        "version": str(file_stat.st_mtime_ns),
+    }
+    artifact.update(fields)
+    return artifact
+
+
+def is_persona_cloned(persona: dict) -> bool:
+    """
+    Return whether a persona has fully ingested games and an opening book to serve.
+    """
+    if persona is None or not persona.get(RAW_ARTIFACT, {}).get("complete", False):
+        return False
+    return MOVE_TREE_ARTIFACT in persona or PROCESSED_ARTIFACT in persona
+
+
+def scan_persona_artifacts() -> dict:
+    """
+    Build the manifest from the files on disk. Only used when there is no manifest yet.
+    """
+    # Imported here because these modules record their own updates in the registry
+    from model_registry import MODEL_ARTIFACT_FILE_NAMES, get_model_directory
+    from opening_book import get_move_tree_path, get_sequence_target_map_path
+    from scripts.util import get_raw_games_path, read_ingest_state
+
+    lichess_username_set = set()
+    for directory_path, prefix, suffix in (
+        ("../data/raw", "games_", ".csv"),
+        ("../data/processed", "sequence_target_map_", ".csv"),
+        ("../data/processed", "move_tree_", ".bin"),
+    ):
+        if not os.path.isdir(directory_path):
+            continue
+        for file_name in os.listdir(directory_path):
+            if file_name.startswith(prefix) and file_name.endswith(suffix):
+                lichess_username_set.add(file_name[len(prefix):-len(suffix)])
+
+    persona_dict = {}
+    for lichess_username in sorted(lichess_username_set):
+        persona = {}
+        raw_games_path = get_raw_games_path(lichess_username)
+        if os.path.exists(raw_games_path):
+            ingest_state = read_ingest_state(lichess_username)
+            # Files written before incremental ingestion have no state and were always complete
+            persona[RAW_ARTIFACT] = get_file_artifact(
+                raw_games_path,
+                complete=ingest_state is None or ingest_state.get(
+                    "complete", False),
+                game_count=ingest_state.get(
+                    "game_count") if ingest_state else None
+            )
+        for artifact_name, file_path in (
+            (PROCESSED_ARTIFACT, get_sequence_target_map_path(lichess_username)),
+            (MOVE_TREE_ARTIFACT, get_move_tree_path(lichess_username)),
+        ):
+            if os.path.exists(file_path):
+                persona[artifact_name] = get_file_artifact(file_path)
+        model_directory = get_model_directory(lichess_username)
+        if all(os.path.exists(os.path.join(model_directory, file_name)) for file_name in MODEL_ARTIFACT_FILE_NAMES):
+            persona[MODEL_ARTIFACT] = {
+                "path": model_directory,
+                "size_bytes": sum(
+                    os.path.getsize(os.path.join(model_directory, file_name))
+                    for file_name in MODEL_ARTIFACT_FILE_NAMES
+                ),
+                "version": os.path.basename(model_directory),
+            }
+        persona_dict[lichess_username] = persona
+    return persona_dict
+
+
+class PersonaRegistry:
+    """
+    An in-memory index of the raw, processed, move tree and model artifacts of
+    every user, kept in a JSON manifest. The ingestion and training pipelines
+    record each artifact they write, so lookups never scan directories. Other
+    processes (bulk builds, training runs) update the same manifest under a
+    file lock, and the index reloads when the manifest changes.
+    """
+
+    manifest_path: str = None  # Path of the JSON manifest
+
+    def __init__(self, manifest_path: str):
+        self.manifest_path = manifest_path
+        self._personas: dict[str, dict] = {}  # Username -> artifact name -> artifact
+        self._manifest_signature: tuple = None  # (mtime_ns, size) of the manifest last read
+        self._lock = threading.Lock()
+        self._counters = {"lookups": 0, "updates": 0, "reloads": 0}
+
+    def _manifest_stat(self) -> tuple:
+        """
+        Return the signature of the manifest on disk, or None if it does not exist.
+        """
+        try:
+            manifest_stat = os.stat(self.manifest_path)
+        except FileNotFoundError:
+            return None
+        return (manifest_stat.st_mtime_ns, manifest_stat.st_size)
+
+    def _read_manifest(self):
+        """
+        Load the manifest into memory. Caller must hold the lock.
+        """
+        with open(self.manifest_path, "r") as manifest_file:
+            self._personas = json.load(manifest_file)["personas"]
+        self._manifest_signature = self._manifest_stat()
+        self._counters["reloads"] += 1
+
+    def _write_manifest(self):
+        """
+        Atomically replace the manifest with the in-memory index. Caller must hold the lock and the file lock.
+        """
+        with open(f"{self.manifest_path}.tmp", "w") as manifest_file:
+            json.dump({"personas": self._personas},
+                      manifest_file, indent=1, sort_keys=True)
+            manifest_file.flush()
+            os.fsync(manifest_file.fileno())
+        os.replace(f"{self.manifest_path}.tmp", self.manifest_path)
+        self._manifest_signature = self._manifest_stat()
+
+    def _file_lock(self):
+        """
+        Open the lock file that serializes manifest writes across processes.
+        """
+        os.makedirs(os.path.dirname(self.manifest_path) or ".", exist_ok=True)
+        return open(f"{self.manifest_path}.lock", "a")
+
+    def _refresh(self):
+        """
+        Reload the manifest if another process changed it, creating it on first use.
+        Caller must hold the lock.
+        """
+        manifest_signature = self._manifest_stat()
+        if manifest_signature is not None:
+            if manifest_signature != self._manifest_signature:
+                self._read_manifest()
+            return
+        with self._file_lock() as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            if self._manifest_stat() is not None:
+                self._read_manifest()
+                return
+            self._personas = scan_persona_artifacts()
+            self._write_manifest()
+
+    def get(self, lichess_username: str) -> dict:
+        """
+        Return the artifacts of a user by name, or None if the user is unknown.
+        """
+        with self._lock:
+            self._refresh()
+            self._counters["lookups"] += 1
+            persona = self._personas.get(lichess_username)
+            return {name: dict(artifact) for name, artifact in persona.items()} if persona is not None else None
+
+    def is_cloned(self, lichess_username: str) -> bool:
+        """
+        Return whether the games of a user are fully ingested and their opening book can be served.
+        """
+        with self._lock:
+            self._refresh()
+            self._counters["lookups"] += 1
+            return is_persona_cloned(self._personas.get(lichess_username))
+
+    def cloned_usernames(self) -> set[str]:
+        """
+        Return the usernames of every cloned user.
+        """
+        with self._lock:
+            self._refresh()
+            return {
+                lichess_username
+                for lichess_username, persona in self._personas.items()
+                if is_persona_cloned(persona)
+            }
+
+    def record(self, lichess_username: str, artifact_name: str, artifact: dict):
+        """
+        Record a newly written artifact of a user, or drop it when artifact is None.
+        """
+        with self._lock:
+            with self._file_lock() as lock_file:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+                # Merge into the latest manifest so updates from other processes are kept
+                if self._manifest_stat() is not None:
+                    if self._manifest_stat() != self._manifest_signature:
+                        self._read_manifest()
+                else:
+                    self._personas = scan_persona_artifacts()
+                persona = self._personas.setdefault(lichess_username, {})
+                if artifact is None:
+                    persona.pop(artifact_name, None)
+                else:
+                    persona[artifact_name] = dict(
+                        artifact, updated_at=time.time())
+                self._write_manifest()
+            self._counters["updates"] += 1
+
+    def stats(self) -> dict:
+        """
+        Return lookup/update counters and the number of known users.
+        """
+        with self._lock:
+            stats_dict = dict(self._counters)
+            stats_dict["personas"] = len(self._personas)
+        return stats_dict
+
+
+# Process-wide registry shared by all requests
+persona_registry = PersonaRegistry(PERSONA_MANIFEST_PATH)
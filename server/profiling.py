@@ -0,0 +1,301 @@
+"""Opt-in profiling of single requests, kept in a bounded on-disk ring buffer."""
+import hmac
+import json
+import os
+import re
+import sys
+import threading
+import time
+import uuid
+
+from collections import Counter
+from contextvars import ContextVar
+from urllib.parse import parse_qsl, urlencode
+
+# Local
+from constants import PROFILE_DIRECTORY, PROFILE_MAX_COUNT, PROFILE_SAMPLE_INTERVAL_SECONDS, PROFILING_TOKEN
+
+PROFILE_TOKEN_HEADER = b"x-profile-token"  # Header that requests a profile and authorizes the profile routes
+PROFILE_TOKEN_PARAMETER = "profile_token"  # Query parameter doing the same, for clients that cannot set headers
+PROFILE_ID_PATTERN = re.compile(r"^[0-9]+-[0-9a-f]{8}$")
+
+
+def is_profiling_token(token: str) -> bool:
+    """
+    Return whether a token is the admin profiling token. Always False when profiling is off.
+    """
+    if not PROFILING_TOKEN or token is None:
+        return False
+    return hmac.compare_digest(token.encode("utf-8"), PROFILING_TOKEN.encode("utf-8"))
+
+
+def new_profile_id() -> str:
+    """
+    Return a new profile ID, which sorts by creation time.
+    """
+    return f"{time.time_ns() // 1000}-{uuid.uuid4().hex[:8]}"
+
+
+def get_frame_name(code) -> str:
+    """
+    Name a stack frame by function, file and first line.
+    """
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+class RequestProfile:
+    """
+    Stack samples of one request. A sampler thread records the stacks of every
+    thread working on the request: the event loop thread, and the blocking
+    executor threads while they run calls made on behalf of the request. The
+    event loop thread also runs other requests in the meantime, so its samples
+    can include their frames.
+    """
+
+    interval_seconds: float = 0.0  # Time between samples
+    sample_count: int = 0  # Number of sampling rounds taken
+
+    def __init__(self, interval_seconds: float):
+        self.interval_seconds = interval_seconds
+        self._thread_counts: dict[int, int] = {}  # Thread ID -> number of calls it is running for the request
+        self._stack_counts: Counter = Counter()  # Stack, root first -> number of samples
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._sampler_thread: threading.Thread = None
+
+    def add_thread(self, thread_id: int):
+        """
+        Start sampling a thread.
+        """
+        with self._lock:
+            self._thread_counts[thread_id] = self._thread_counts.get(
+                thread_id, 0) + 1
+
+    def remove_thread(self, thread_id: int):
+        """
+        Stop sampling a thread once it finished every call it runs for the request.
+        """
+        with self._lock:
+            self._thread_counts[thread_id] -= 1
+            if self._thread_counts[thread_id] == 0:
+                del self._thread_counts[thread_id]
+
+    def _sample_forever(self):
+        """
+        Record the stacks of the sampled threads until the profile is stopped.
+        """
+        own_thread_id = threading.get_ident()
+        while not self._stopped.wait(self.interval_seconds):
+            with self._lock:
+                thread_id_list = list(self._thread_counts)
+            frame_dict = sys._current_frames()
+            for thread_id in thread_id_list:
+                frame = frame_dict.get(thread_id)
+                if frame is None or thread_id == own_thread_id:
+                    continue
+                stack = []
+                while frame is not None:
+                    stack.append(get_frame_name(frame.f_code))
+                    frame = frame.f_back
+                self._stack_counts[tuple(reversed(stack))] += 1
+            self.sample_count += 1
+
+    def start(self):
+        """
+        Start the sampler thread.
+        """
+        self._sampler_thread = threading.Thread(
+            target=self._sample_forever, name="request-profiler", daemon=True)
+        self._sampler_thread.start()
+
+    def stop(self):
+        """
+        Stop the sampler thread and wait for its last sample.
+        """
+        self._stopped.set()
+        self._sampler_thread.join()
+
+    def folded_stacks(self) -> str:
+        """
+        Return the samples in the folded stack format read by flame graph tools.
+        """
+        return "".join(
+            f"{';'.join(stack)} {count}\n"
+            for stack, count in self._stack_counts.most_common()
+        )
+
+    def top_functions(self, count: int) -> list[dict]:
+        """
+        Return the functions found most often at the top of the sampled stacks.
+        """
+        self_counts = Counter()
+        for stack, stack_count in self._stack_counts.items():
+            self_counts[stack[-1]] += stack_count
+        return [
+            {"function": function_name, "samples": sample_count}
+            for function_name, sample_count in self_counts.most_common(count)
+        ]
+
+
+# Profile of the request being handled, inherited by blocking calls made on its behalf
+current_request_profile: ContextVar[RequestProfile] = ContextVar(
+    "current_request_profile", default=None)
+
+
+def call_profiled(request_profile: RequestProfile, function, *args, **kwargs):
+    """
+    Run a blocking call with its thread sampled for a request profile.
+    """
+    thread_id = threading.get_ident()
+    request_profile.add_thread(thread_id)
+    try:
+        return function(*args, **kwargs)
+    finally:
+        request_profile.remove_thread(thread_id)
+
+
+class ProfileStore:
+    """
+    A ring buffer of request profiles on disk. Each profile is a folded stack
+    file with a JSON summary next to it, and the oldest are dropped once there
+    are more than max_profiles.
+    """
+
+    directory: str = None  # Directory holding the profiles
+    max_profiles: int = 0  # Maximum number of profiles kept
+
+    def __init__(self, directory: str, max_profiles: int):
+        self.directory = directory
+        self.max_profiles = max_profiles
+        self._lock = threading.Lock()
+
+    def get_path(self, profile_id: str, extension: str) -> str:
+        """
+        Return the path of a file of a profile, or None if the ID is malformed.
+        """
+        if not PROFILE_ID_PATTERN.match(profile_id):
+            return None
+        return os.path.join(self.directory, f"{profile_id}.{extension}")
+
+    def list_profile_ids(self) -> list[str]:
+        """
+        Return the IDs of the stored profiles, newest first.
+        """
+        if not os.path.isdir(self.directory):
+            return []
+        return sorted(
+            (file_name[:-len(".json")] for file_name in os.listdir(self.directory)
+             if file_name.endswith(".json") and PROFILE_ID_PATTERN.match(file_name[:-len(".json")])),
+            key=lambda profile_id: int(profile_id.split("-")[0]),
+            reverse=True
+        )
+
+    def save(self, profile_id: str, summary: dict, folded_stacks: str):
+        """
+        Store a profile and drop the oldest ones over capacity.
+        """
+        with self._lock:
+            os.makedirs(self.directory, exist_ok=True)
+            with open(self.get_path(profile_id, "folded"), "w") as folded_file:
+                folded_file.write(folded_stacks)
+            # The summary is written last, so a listed profile always has its samples
+            with open(self.get_path(profile_id, "json"), "w") as summary_file:
+                json.dump(dict(summary, profile_id=profile_id), summary_file)
+            for stale_profile_id in self.list_profile_ids()[self.max_profiles:]:
+                for extension in ("json", "folded"):
+                    try:
+                        os.remove(self.get_path(stale_profile_id, extension))
+                    except FileNotFoundError:
+                        pass
+
+    def list(self) -> list[dict]:
+        """
+        Return the summaries of the stored profiles, newest first.
+        """
+        summary_list = []
+        for profile_id in self.list_profile_ids():
+            try:
+                with open(self.get_path(profile_id, "json"), "r") as summary_file:
+                    summary_list.append(json.load(summary_file))
+            except FileNotFoundError:
+                # Dropped by a concurrent save
+                continue
+        return summary_list
+
+
+# Process-wide store shared by all requests
+profile_store = ProfileStore(PROFILE_DIRECTORY, PROFILE_MAX_COUNT)
+
+
+class ProfilingMiddleware:
+    """
+    ASGI middleware that profiles HTTP requests carrying the admin profiling
+    token, in the X-Profile-Token header or the profile_token query parameter.
+    Other requests only pay for a scan of their headers. The ID of the stored
+    profile is returned in the X-Profile-Id response header.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    def get_request_token(self, scope: dict) -> str:
+        """
+        Return the profiling token a request carries, if any.
+        """
+        for header_name, header_value in scope["headers"]:
+            if header_name == PROFILE_TOKEN_HEADER:
+                return header_value.decode("latin-1")
+        query_string = scope.get("query_string", b"")
+        if PROFILE_TOKEN_PARAMETER.encode() in query_string:
+            return dict(parse_qsl(query_string.decode("latin-1"))).get(PROFILE_TOKEN_PARAMETER)
+        return None
+
+    async def __call__(self, scope, receive, send):
+        if (
+            scope["type"] != "http"
+            or scope["path"].startswith("/profiles")
+            or not is_profiling_token(self.get_request_token(scope))
+        ):
+            await self.app(scope, receive, send)
+            return
+
+        # Imported here because job_manager imports this module
+        from job_manager import run_blocking
+
+        # The ID goes out with the response headers, before the profile is stored
+        profile_id = new_profile_id()
+        response_status = []
+
+        async def send_with_profile_id(message):
+            if message["type"] == "http.response.start":
+                response_status.append(message["status"])
+                message = dict(message, headers=list(
+                    message.get("headers", [])) + [(b"x-profile-id", profile_id.encode())])
+            await send(message)
+
+        request_profile = RequestProfile(PROFILE_SAMPLE_INTERVAL_SECONDS)
+        request_profile.add_thread(threading.get_ident())
+        profile_token = current_request_profile.set(request_profile)
+        start_time = time.perf_counter()
+        request_profile.start()
+        try:
+            await self.app(scope, receive, send_with_profile_id)
+        finally:
+            duration_seconds = time.perf_counter() - start_time
+            request_profile.stop()
+            current_request_profile.reset(profile_token)
+            # The token is not kept with the profile
+            query = [(name, value) for name, value in parse_qsl(scope.get("query_string", b"").decode("latin-1"))
+                     if name != PROFILE_TOKEN_PARAMETER]
+            summary = {
+                "method": scope["method"],
+                "path": scope["path"],
+                "query": urlencode(query),
+                "status": response_status[0] if response_status else None,
+                "duration_seconds": duration_seconds,
+                "created_at": time.time(),
+                "sample_count": request_profile.sample_count,
+                "interval_seconds": request_profile.interval_seconds,
+                "top_functions": request_profile.top_functions(10),
+            }
+            await run_blocking(profile_store.save, profile_id, summary, request_profile.folded_stacks())
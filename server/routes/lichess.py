@@ -1,27 +1,111 @@
 """Routes for interactions with lichess API."""
+import hashlib
+import json
 
 # Import the APIRouter from FastAPI to create API routes
-from fastapi import APIRouter
+from fastapi import APIRouter, HTTPException, Request, Response
+from fastapi.responses import StreamingResponse
 
-# Import the get_games_and_moves_by_username function from the local scripts.util module
-from scripts.util import get_games_and_moves_by_username
+# Import the game export helpers from the local scripts.util module
+from constants import HISTORY_LOCAL_BATCH_SIZE
+from scripts.util import iter_games_and_moves_by_username, iter_local_games_by_username, read_raw_games_columns
+from job_manager import iterate_blocking, run_blocking
+from persona_registry import RAW_ARTIFACT, persona_registry
 
 # Create a new API router
 router = APIRouter()
 
 
+def get_local_history_artifact(username: str, since: int) -> dict:
+    """
+    Return the raw game history artifact of a user if it can answer a history request.
+
+    Args:
+        username (str): The username of the user.
+        since (int): The requested lower bound on the creation time of the games.
+
+    Returns:
+        dict: The raw artifact from the persona registry, or None if Lichess must be asked.
+    """
+    persona = persona_registry.get(username)
+    raw_artifact = persona.get(RAW_ARTIFACT) if persona is not None else None
+    if raw_artifact is None or not raw_artifact.get("complete", False):
+        return None
+    # Files written before creation times were stored cannot filter by since
+    if since is not None and "created_at" not in read_raw_games_columns(raw_artifact["path"]):
+        return None
+    return raw_artifact
+
+
+def get_history_etag(raw_artifact: dict, since: int, limit: int) -> str:
+    """
+    Return the ETag of a history response served from a local copy.
+    """
+    etag_source = f"{raw_artifact['version']}:{raw_artifact['size_bytes']}:{since}:{limit}"
+    return f'"{hashlib.sha1(etag_source.encode("utf-8")).hexdigest()}"'
+
+
+def etag_matches(if_none_match: str, etag: str) -> bool:
+    """
+    Return whether an If-None-Match header matches an ETag.
+    """
+    if if_none_match is None:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    return etag in [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]
+
+
+async def iter_history_lines(game_iterator, batch_size: int):
+    """
+    Serialize games as NDJSON, one chunk per batch read from the blocking iterator.
+    """
+    async for game_batch in iterate_blocking(game_iterator, batch_size):
+        yield "".join(json.dumps(game) + "\n" for game in game_batch)
+
+
 @router.get("/history/{username}")
-async def get_history(username: str):
+async def get_history(username: str, request: Request, since: int = None, limit: int = None):
     """
-    Return the game history of the user.
+    Stream the game history of the user as NDJSON, oldest game first.
+
+    Users whose games are already ingested are served from the local copy with
+    an ETag, so a repeat request with If-None-Match gets a 304 without touching
+    Lichess. Other users are streamed from Lichess as the games arrive.
 
     Args:
         username (str): The username of the user.
+        request (Request): The incoming request, for its If-None-Match header.
+        since (int): Only return games created at or after this epoch millisecond
+            timestamp. To fetch the next page, pass the created_at of the last game plus one.
+        limit (int): Return at most this many games.
 
     Returns:
-        list[dict]: A list of dictionaries, each representing a game.
+        StreamingResponse: One JSON game summary per line.
     """
-    # Call the get_games_and_moves_by_username function to get the games and moves of the user
-    games = get_games_and_moves_by_username(username)
-    # Return the games and moves
-    return games
+    if since is not None and since < 0:
+        raise HTTPException(status_code=400, detail="since must not be negative")
+    if limit is not None and limit <= 0:
+        raise HTTPException(status_code=400, detail="limit must be positive")
+
+    raw_artifact = await run_blocking(get_local_history_artifact, username, since)
+    if raw_artifact is not None:
+        etag = get_history_etag(raw_artifact, since, limit)
+        headers = {"ETag": etag, "Cache-Control": "no-cache"}
+        if etag_matches(request.headers.get("if-none-match"), etag):
+            return Response(status_code=304, headers=headers)
+        game_iterator = iter_local_games_by_username(
+            username, since=since, limit=limit)
+        batch_size = HISTORY_LOCAL_BATCH_SIZE
+    else:
+        headers = {"Cache-Control": "no-store"}
+        # The export is a blocking HTTP stream; each game is sent on as soon as it arrives
+        game_iterator = iter_games_and_moves_by_username(
+            username, since=since, sort="dateAsc", max_games=limit)
+        batch_size = 1
+
+    return StreamingResponse(
+        iter_history_lines(game_iterator, batch_size),
+        media_type="application/x-ndjson",
+        headers=headers
+    )
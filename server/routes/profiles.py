@@ -0,0 +1,66 @@
+"""Routes for listing and downloading request profiles."""
+import os
+
+from fastapi import APIRouter, HTTPException, Request
+from fastapi.responses import FileResponse
+
+# Local
+from job_manager import run_blocking
+from profiling import PROFILE_TOKEN_HEADER, PROFILE_TOKEN_PARAMETER, is_profiling_token, profile_store
+
+# Create a new API router
+router = APIRouter()
+
+
+def check_profiling_token(request: Request):
+    """
+    Reject requests without the admin profiling token.
+
+    Args:
+        request (Request): The incoming request, carrying the token in the
+            X-Profile-Token header or the profile_token query parameter.
+    """
+    token = request.headers.get(PROFILE_TOKEN_HEADER.decode()) or \
+        request.query_params.get(PROFILE_TOKEN_PARAMETER)
+    if not is_profiling_token(token):
+        # Profiling stays invisible to anyone without the token
+        raise HTTPException(status_code=404, detail="Not Found")
+
+
+@router.get("/")
+async def list_profiles(request: Request):
+    """
+    List the stored request profiles, newest first.
+
+    Args:
+        request (Request): The incoming request, for the profiling token.
+
+    Returns:
+        dict: A dictionary with the summary of every stored profile.
+    """
+    check_profiling_token(request)
+    return {"profiles": await run_blocking(profile_store.list)}
+
+
+@router.get("/{profile_id}")
+async def download_profile(profile_id: str, request: Request):
+    """
+    Download the stack samples of a profile in the folded stack format, which
+    flame graph tools such as speedscope and flamegraph.pl read.
+
+    Args:
+        profile_id (str): The ID from the X-Profile-Id header of the profiled response.
+        request (Request): The incoming request, for the profiling token.
+
+    Returns:
+        FileResponse: The folded stacks, one stack and its sample count per line.
+    """
+    check_profiling_token(request)
+    folded_file_path = profile_store.get_path(profile_id, "folded")
+    if folded_file_path is None or not os.path.exists(folded_file_path):
+        raise HTTPException(status_code=404, detail="Unknown profile")
+    return FileResponse(
+        folded_file_path,
+        media_type="text/plain",
+        filename=f"profile_{profile_id}.folded"
+    )
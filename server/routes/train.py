@@ -1,59 +1,142 @@
-from fastapi import APIRouter
+import json
+
+from fastapi import APIRouter, HTTPException, WebSocket, WebSocketDisconnect
+from pydantic import BaseModel
 
 # Local
 from scripts.util import *
-from chess_client import ChessClient
+from accuracy_tracker import accuracy_tracker
+from bulk_training import get_bulk_training_scheduler
+from chess_client import ChessClient, move_source_stats
+from engine_cache import engine_cache
+from engine_pool import get_engine_pool_stats
+from game_session import GameSession, PersonaNotFoundError, game_session_manager
+from inference_scheduler import inference_scheduler
+from job_manager import TrainingJob, run_blocking, training_job_manager
+from llm_client import get_llm_client_stats
+from metrics import metrics_registry
+from model_registry import model_registry
+from opening_book import get_opening_book
+from persona_registry import persona_registry
 
 # Create a new API router
 router = APIRouter()
 
+# Statistics of the move prediction pipeline, served by /stats and exported as gauges by /metrics
+PIPELINE_STATS_FUNCTIONS = {
+    "model_registry": model_registry.stats,
+    "inference_scheduler": inference_scheduler.stats,
+    "engine_pool": get_engine_pool_stats,
+    "accuracy_tracker": accuracy_tracker.stats,
+    "engine_cache": engine_cache.stats,
+    "training_jobs": training_job_manager.stats,
+    "llm_client": get_llm_client_stats,
+    "persona_registry": persona_registry.stats,
+    "game_sessions": game_session_manager.stats,
+    "move_sources": move_source_stats.stats,
+}
+for stats_name, stats_function in PIPELINE_STATS_FUNCTIONS.items():
+    metrics_registry.register_stats(stats_name, stats_function)
+
+
+def run_persona_training(training_job: TrainingJob):
+    """
+    Train the persona of a user inside a background job.
+
+    Args:
+        training_job (TrainingJob): The job to report progress on.
+    """
+    lichess_username = training_job.lichess_username
+
+    def on_chunk_written(game_count: int):
+        training_job.games_ingested = game_count
+
+    # Stream the games of the user into their raw game history file
+    training_job.stage = "FETCHING_GAMES"
+    ingest_games_by_username(
+        lichess_username, on_chunk_written=on_chunk_written)
+    # Build the move tree the opening book is served from
+    training_job.stage = "BUILDING_PERSONA"
+    write_move_tree(lichess_username)
+
 
 @router.get("/persona/{lichess_username}")
 async def train_persona(lichess_username: str):
     """
-    Train the persona of a user.
+    Train the persona of a user in the background.
 
     Args:
         lichess_username (str): The Lichess username of the user.
 
     Returns:
-        dict: A dictionary containing the status of the operation.
+        dict: A dictionary containing the status of the operation and, while
+            training, the training job to poll.
     """
-    # Get the set of cached usernames
-    cached_username_set = get_cached_usernames()
-    # If the username is in the set, return a status indicating that the cloning is complete
-    if lichess_username in cached_username_set:
+    # If the persona registry has the user's games and opening book, the cloning is complete
+    if await run_blocking(persona_registry.is_cloned, lichess_username):
         return {"status": "CLONING_COMPLETE"}
 
-    # Get the games and moves of the user
-    game_history_list = get_games_and_moves_by_username(lichess_username)
-    # Convert the list to a DataFrame
-    game_history_df = pd.DataFrame(game_history_list)
-    # Replace any missing player names with "ANONYMOUS"
-    game_history_df["white_player"] = game_history_df["white_player"].replace(
-        "", "ANONYMOUS")
-    game_history_df["black_player"] = game_history_df["black_player"].replace(
-        "", "ANONYMOUS")
-    game_history_df["winning_player"] = game_history_df["winning_player"].replace(
-        "", "ANONYMOUS")
-    # Save the DataFrame to a CSV file
-    game_history_df.to_csv(f"../data/raw/games_{lichess_username}.csv")
-
-    # Explode the games into moves
-    exploded_game_list = []
-    for game in game_history_list:
-        exploded_game_list.extend(
-            explode_game_into_moves(game, lichess_username))
-
-    # Convert the list of exploded games to a DataFrame
-    exploded_game_df = pd.DataFrame(exploded_game_list, columns=[
-                                    "game_id", "input_sequence", "target_move"])
-    # Save the DataFrame to a CSV file
-    exploded_game_df.to_csv(
-        f"../data/processed/sequence_target_map_{lichess_username}.csv", index="game_id")
-
-    # Return a status indicating that the cloning is complete
-    return {"status": "CLONING_COMPLETE"}
+    # Start a training job, or join the one already running for this user
+    training_job = training_job_manager.submit(
+        lichess_username, run_persona_training)
+    return training_job.to_dict()
+
+
+@router.get("/jobs/{job_id}")
+async def get_training_job(job_id: str):
+    """
+    Get the status and progress of a training job.
+
+    Args:
+        job_id (str): The ID returned when the training was started.
+
+    Returns:
+        dict: A dictionary describing the job.
+    """
+    training_job = training_job_manager.get(job_id)
+    if training_job is None:
+        raise HTTPException(status_code=404, detail="Unknown training job")
+    return training_job.to_dict()
+
+
+class BulkTrainingRequest(BaseModel):
+    """
+    Body of a bulk training request.
+    """
+
+    lichess_usernames: list[str]  # Users whose personas are built
+    priority: int = 0  # Lower values run first
+    train_model: bool = True  # Whether to train the persona models too
+
+
+@router.post("/bulk")
+async def train_personas_in_bulk(bulk_training_request: BulkTrainingRequest):
+    """
+    Queue persona builds for many users.
+
+    Args:
+        bulk_training_request (BulkTrainingRequest): The users and how to build them.
+
+    Returns:
+        dict: A dictionary with the queued tasks.
+    """
+    task_list = get_bulk_training_scheduler().submit(
+        bulk_training_request.lichess_usernames,
+        priority=bulk_training_request.priority,
+        train_model=bulk_training_request.train_model
+    )
+    return {"tasks": [task.to_dict() for task in task_list]}
+
+
+@router.get("/bulk")
+async def get_bulk_training_progress():
+    """
+    Get the progress of the bulk persona builds.
+
+    Returns:
+        dict: A dictionary with the number of builds per status and every task.
+    """
+    return get_bulk_training_scheduler().summary()
 
 
 @router.get("/next-move/")
@@ -68,12 +151,200 @@ async def get_next_move(lichess_username: str, partial_sequence: str):
     Returns:
         str: The next move in the game.
     """
-    # Get the game history of the user
-    game_history_df = get_game_history_df(lichess_username)
+    # Get the opening book built from the game history of the user
+    opening_book = await run_blocking(get_opening_book, lichess_username)
     # Create a ChessClient object
     chess_client = ChessClient(move_list_in_san=partial_sequence.strip().split(
         " "), lichess_username=lichess_username)
-    # Compute the next move using the ChessClient object
-    predicted_move = chess_client.compute_next_move(game_history_df)
+    # Compute the next move using the ChessClient object, off the event loop
+    predicted_move = await run_blocking(chess_client.compute_next_move, opening_book)
     # Return the predicted move
     return predicted_move
+
+
+class GameSessionRequest(BaseModel):
+    """
+    Body of a request starting a game session.
+    """
+
+    lichess_username: str  # Username whose persona is played against
+    moves: list[str] = []  # Moves already played, in SAN
+
+
+class GameSessionMoveRequest(BaseModel):
+    """
+    Body of a move played in a game session.
+    """
+
+    move: str = None  # Move of the user in SAN; omitted when the persona moves first
+    reply: bool = True  # Whether the persona answers the move
+
+
+def get_game_session(session_id: str) -> GameSession:
+    """
+    Return a game session by ID.
+
+    Raises:
+        HTTPException: 404 if the session is unknown or expired.
+    """
+    game_session = game_session_manager.get(session_id)
+    if game_session is None:
+        raise HTTPException(status_code=404, detail="Unknown game session")
+    return game_session
+
+
+@router.post("/sessions")
+async def create_game_session(game_session_request: GameSessionRequest):
+    """
+    Start a game session against the persona of a user.
+
+    Args:
+        game_session_request (GameSessionRequest): The user and the moves played so far.
+
+    Returns:
+        dict: The session ID and the state of the game.
+    """
+    try:
+        # Replaying the moves already played is the only step that depends on the game length
+        game_session = await run_blocking(
+            game_session_manager.create,
+            game_session_request.lichess_username,
+            game_session_request.moves
+        )
+    except ValueError as ex:
+        raise HTTPException(status_code=400, detail=str(ex))
+    return game_session.to_dict()
+
+
+@router.get("/sessions/{session_id}")
+async def get_game_session_state(session_id: str):
+    """
+    Get the state of a game session.
+
+    Args:
+        session_id (str): The ID returned when the session was started.
+
+    Returns:
+        dict: The state of the game.
+    """
+    return get_game_session(session_id).to_dict()
+
+
+@router.post("/sessions/{session_id}/moves")
+async def play_game_session_move(session_id: str, game_session_move_request: GameSessionMoveRequest):
+    """
+    Play the latest move of the user in a game session and get the reply of the persona.
+
+    Args:
+        session_id (str): The ID returned when the session was started.
+        game_session_move_request (GameSessionMoveRequest): The move and whether to reply.
+
+    Returns:
+        dict: The state of the game after the reply, with the reply under "reply".
+    """
+    game_session = get_game_session(session_id)
+    try:
+        return await run_blocking(
+            game_session_manager.play,
+            game_session,
+            game_session_move_request.move,
+            reply=game_session_move_request.reply
+        )
+    except ValueError as ex:
+        raise HTTPException(status_code=400, detail=str(ex))
+    except PersonaNotFoundError as ex:
+        raise HTTPException(status_code=404, detail=str(ex))
+
+
+@router.delete("/sessions/{session_id}")
+async def close_game_session(session_id: str):
+    """
+    End a game session.
+
+    Args:
+        session_id (str): The ID returned when the session was started.
+
+    Returns:
+        dict: Whether the session existed.
+    """
+    return {"closed": game_session_manager.close(session_id)}
+
+
+async def receive_game_session_move(websocket: WebSocket) -> GameSessionMoveRequest:
+    """
+    Receive the next move message of a game session WebSocket.
+
+    Raises:
+        ValueError: If the message is not a text frame holding a JSON object
+            with the fields of a move request.
+    """
+    message = await websocket.receive()
+    if message["type"] == "websocket.disconnect":
+        raise WebSocketDisconnect(message.get("code", 1000))
+    # Binary frames carry their payload under "bytes" instead
+    message_text = message.get("text")
+    if message_text is None:
+        raise ValueError("Messages must be text frames")
+    message = json.loads(message_text)
+    if not isinstance(message, dict):
+        raise ValueError("Messages must be JSON objects")
+    # Same validation as the HTTP move route
+    return GameSessionMoveRequest(**message)
+
+
+@router.websocket("/sessions/{session_id}/ws")
+async def game_session_socket(websocket: WebSocket, session_id: str):
+    """
+    Play a game session over a WebSocket.
+
+    The server first sends the state of the game. Each message from the client
+    is a JSON object with the same fields as a move request, and each answer is
+    the state of the game after the reply, or {"error": ...} for a malformed
+    message, an illegal move, or a user without an opening book. The
+    connection stays open after an error.
+
+    Args:
+        websocket (WebSocket): The connection to the client.
+        session_id (str): The ID returned when the session was started.
+    """
+    await websocket.accept()
+    game_session = game_session_manager.get(session_id)
+    if game_session is None:
+        await websocket.close(code=4404, reason="Unknown game session")
+        return
+    await websocket.send_json(game_session.to_dict())
+    try:
+        while True:
+            try:
+                game_session_move_request = await receive_game_session_move(websocket)
+                result = await run_blocking(
+                    game_session_manager.play,
+                    game_session,
+                    game_session_move_request.move,
+                    reply=game_session_move_request.reply
+                )
+            except ValueError as ex:
+                # Malformed messages and illegal moves
+                await websocket.send_json({"error": str(ex)})
+                continue
+            except PersonaNotFoundError as ex:
+                await websocket.send_json({"error": str(ex)})
+                continue
+            await websocket.send_json(result)
+    except WebSocketDisconnect:
+        pass
+
+
+@router.get("/stats")
+async def get_stats():
+    """
+    Get the cache statistics of the move prediction pipeline.
+
+    Returns:
+        dict: A dictionary of counters per cache. Components that have not
+            started yet, such as the engine pool, are null.
+    """
+    return {
+        stats_name: stats_function()
+        for stats_name, stats_function in PIPELINE_STATS_FUNCTIONS.items()
+    }
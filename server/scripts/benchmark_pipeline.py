@@ -0,0 +1,551 @@
+"""
+Benchmark suite for the next-move pipeline and the data preparation scripts.
+
+Run from the server directory:
+
+    python -m scripts.benchmark_pipeline [--games 2000] [--samples 500] [--save-baseline] [--compare]
+
+Each stage runs on the checked-in data/ files plus a seeded synthetic game
+history, with the fake UCI engine standing in for Stockfish and a stub model
+standing in for the trained persona models, so no network, engine binary or
+TensorFlow install is needed. Engine cache and persona manifest go to a
+temporary directory. Every stage reports latency percentiles and throughput;
+--save-baseline stores the results and --compare checks a run against them.
+The baseline at ../benchmarks/pipeline_baseline.json is checked in; record it
+again with --save-baseline when a change is meant to move the numbers or the
+benchmarks run on other hardware.
+"""
+import argparse
+import asyncio
+import csv
+import json
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import zlib
+
+from concurrent.futures import ThreadPoolExecutor
+
+SERVER_DIRECTORY = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+FAKE_ENGINE_PATH = os.path.join(
+    SERVER_DIRECTORY, "scripts", "fake_uci_engine.py")
+DEFAULT_BASELINE_PATH = "../benchmarks/pipeline_baseline.json"
+REAL_USERNAME = "ruchitoshniwal1"  # Checked-in user with raw games and a sequence/target map
+SYNTHETIC_USERNAME = "benchmark_synthetic"  # User the synthetic history is written for
+
+
+def make_synthetic_games(game_count: int, seed: int) -> list[dict]:
+    """
+    Play random games in the layout of the raw game history files. Openings
+    favour a few moves per position, so the synthetic opening book has depth
+    the way the book of a real player does.
+    """
+    import chess
+
+    rng = random.Random(seed)
+    game_list = []
+    for game_index in range(game_count):
+        board = chess.Board()
+        move_list = []
+        ply_limit = rng.randint(20, 140)
+        while len(move_list) < ply_limit and not board.is_game_over():
+            legal_move_list = sorted(board.legal_moves, key=chess.Move.uci)
+            if len(move_list) < 12:
+                # Same position, same preferences: a seeded ranking of the legal moves
+                position_rng = random.Random(zlib.crc32(board.fen().encode()))
+                position_rng.shuffle(legal_move_list)
+                move = rng.choices(
+                    legal_move_list[:3], weights=[6, 3, 1][:len(legal_move_list)])[0]
+            else:
+                move = rng.choice(legal_move_list)
+            move_list.append(board.san(move))
+            board.push(move)
+        user_plays_white = game_index % 2 == 0
+        game_list.append({
+            "game_id": f"synthetic{game_index:06d}",
+            "white_player": SYNTHETIC_USERNAME if user_plays_white else "opponent",
+            "black_player": "opponent" if user_plays_white else SYNTHETIC_USERNAME,
+            "winning_player": None,
+            "move_list": " ".join(move_list),
+            "created_at": 1_600_000_000_000 + game_index * 60_000,
+        })
+    return game_list
+
+
+def read_raw_games(lichess_username: str) -> list[dict]:
+    """
+    Read the checked-in raw games of a user, skipping games without moves.
+    """
+    with open(f"../data/raw/games_{lichess_username}.csv", "r") as csv_file:
+        return [row for row in csv.DictReader(csv_file) if row.get("move_list")]
+
+
+def is_standard_sequence(move_list: list[str]) -> bool:
+    """
+    Return whether SAN moves replay from the standard starting position; the
+    checked-in histories include variant games, such as crazyhouse drops.
+    """
+    import chess
+
+    board = chess.Board()
+    try:
+        for move in move_list:
+            board.push_san(move)
+    except ValueError:
+        return False
+    return True
+
+
+def read_input_sequences(lichess_username: str) -> list[str]:
+    """
+    Read the standard-chess input sequences of the legacy sequence/target map of a user.
+    """
+    with open(f"../data/processed/sequence_target_map_{lichess_username}.csv", "r") as csv_file:
+        return [
+            row["input_sequence"] for row in csv.DictReader(csv_file)
+            if row.get("input_sequence") and is_standard_sequence(row["input_sequence"].split(" "))
+        ]
+
+
+def sample_prefixes(game_list: list[dict], sample_count: int, rng: random.Random, max_ply_count: int = None) -> list[list[str]]:
+    """
+    Cut random games at random plies, as the partial sequences a client would send.
+    """
+    prefix_list = []
+    for _ in range(sample_count):
+        move_list = rng.choice(game_list)["move_list"].split(" ")
+        ply_count = rng.randint(1, min(len(move_list), max_ply_count or len(move_list)))
+        prefix_list.append(move_list[:ply_count])
+    return prefix_list
+
+
+def make_stub_persona_model(label_list: list[str], temporary_directory: str):
+    """
+    Build a stand-in for a trained persona model: the labels come from real
+    target moves and each sequence gets a fixed pseudo-random distribution over
+    them, so predictions are decoded by the real code without TensorFlow.
+    """
+    import numpy as np
+
+    from model_registry import PersonaModel
+    from persona_pack import PERSONA_PACK_FILE_NAME, open_persona_pack, write_persona_pack
+
+    persona_pack_path = os.path.join(temporary_directory, PERSONA_PACK_FILE_NAME)
+    write_persona_pack(persona_pack_path, sorted(set(label_list)), tokenizer=None)
+
+    class StubPersonaModel(PersonaModel):
+        def __init__(self):
+            self.signature = ()
+            self.size_bytes = 0
+            self.persona_pack = open_persona_pack(persona_pack_path)
+
+        def predict(self, moves_in_san_str_list: list[str]) -> np.ndarray:
+            prediction_list = []
+            for moves_in_san_str in moves_in_san_str_list:
+                rng = np.random.default_rng(
+                    zlib.crc32(moves_in_san_str.encode()))
+                logits = rng.standard_normal(
+                    self.persona_pack.label_count) * 3
+                exponents = np.exp(logits - logits.max())
+                prediction_list.append(exponents / exponents.sum())
+            return np.array(prediction_list, dtype=np.float32)
+
+    return StubPersonaModel()
+
+
+def summarize_latencies(latency_list: list[float], elapsed_seconds: float, item_count: int = None) -> dict:
+    """
+    Return latency percentiles in milliseconds and the throughput of a stage.
+    """
+    import numpy as np
+
+    latency_array = np.array(latency_list) * 1000
+    summary = {
+        "count": len(latency_list),
+        "p50_ms": float(np.percentile(latency_array, 50)),
+        "p90_ms": float(np.percentile(latency_array, 90)),
+        "p99_ms": float(np.percentile(latency_array, 99)),
+        "max_ms": float(latency_array.max()),
+        "mean_ms": float(latency_array.mean()),
+        "ops_per_second": len(latency_list) / elapsed_seconds if elapsed_seconds else 0.0,
+    }
+    if item_count is not None:
+        summary["items"] = item_count
+        summary["items_per_second"] = item_count / \
+            elapsed_seconds if elapsed_seconds else 0.0
+    return summary
+
+
+def measure(operation, input_list: list, warmup_list: list = (), concurrency: int = 1, item_count: int = None) -> dict:
+    """
+    Time an operation on every input, after running it untimed on the warm-up inputs.
+    With a concurrency above one, inputs are spread over that many threads.
+    """
+    for warmup_input in warmup_list:
+        operation(warmup_input)
+
+    latency_list = []
+    latency_lock = threading.Lock()
+
+    def timed_operation(operation_input):
+        operation_start_time = time.perf_counter()
+        operation(operation_input)
+        latency = time.perf_counter() - operation_start_time
+        with latency_lock:
+            latency_list.append(latency)
+
+    start_time = time.perf_counter()
+    if concurrency > 1:
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            list(executor.map(timed_operation, input_list))
+    else:
+        for operation_input in input_list:
+            timed_operation(operation_input)
+    return summarize_latencies(latency_list, time.perf_counter() - start_time, item_count)
+
+
+async def asgi_get(app, path: str, query: dict) -> int:
+    """
+    Send a GET request straight to an ASGI app and return the response status.
+    """
+    from urllib.parse import urlencode
+
+    scope = {
+        "type": "http", "asgi": {"version": "3.0"}, "http_version": "1.1",
+        "method": "GET", "scheme": "http", "path": path, "raw_path": path.encode(),
+        "query_string": urlencode(query).encode(), "root_path": "",
+        "headers": [(b"host", b"localhost")],
+        "client": ("127.0.0.1", 0), "server": ("localhost", 80),
+    }
+    response_status = []
+
+    async def receive():
+        return {"type": "http.request", "body": b"", "more_body": False}
+
+    async def send(message):
+        if message["type"] == "http.response.start":
+            response_status.append(message["status"])
+
+    await app(scope, receive, send)
+    return response_status[0]
+
+
+async def measure_asgi(app, path: str, query_list: list[dict], warmup_count: int, concurrency: int) -> dict:
+    """
+    Time GET requests to an ASGI app, at most concurrency of them in flight at once.
+    """
+    for query in query_list[:warmup_count]:
+        await asgi_get(app, path, query)
+
+    semaphore = asyncio.Semaphore(concurrency)
+    latency_list = []
+    status_counts = {}
+
+    async def timed_request(query: dict):
+        async with semaphore:
+            request_start_time = time.perf_counter()
+            status = await asgi_get(app, path, query)
+            latency_list.append(time.perf_counter() - request_start_time)
+            status_counts[status] = status_counts.get(status, 0) + 1
+
+    start_time = time.perf_counter()
+    await asyncio.gather(*(timed_request(query) for query in query_list[warmup_count:]))
+    summary = summarize_latencies(
+        latency_list, time.perf_counter() - start_time)
+    summary["status_counts"] = {str(status): count for status, count in sorted(status_counts.items())}
+    return summary
+
+
+def run_benchmarks(args, temporary_directory: str) -> dict:
+    """
+    Run every stage and return the summary of each, or the reason it was skipped.
+    """
+    # Local modules read their settings at import, after main() configured the environment
+    import chess
+
+    import inference_scheduler as inference_scheduler_module
+    from chess_client import ChessClient
+    from opening_book import OpeningBook, OpeningBookBuilder, get_opening_book
+    from scripts.board_encoder import PLANE_PIECES, encode_bitboards, game_to_bitboards
+    from scripts.util import (
+        RAW_GAME_COLUMNS,
+        explode_game_into_moves,
+        make_prediction_using_model,
+        make_ranked_prediction_using_model,
+    )
+
+    rng = random.Random(args.seed)
+    stage_dict = {}
+
+    print(f"Generating {args.games} synthetic games (seed {args.seed})...")
+    synthetic_game_list = make_synthetic_games(args.games, args.seed)
+    real_game_list = read_raw_games(REAL_USERNAME)
+    real_book_sequence_list = read_input_sequences(REAL_USERNAME)
+
+    # Opening book lookups, on the real book and on one built from the synthetic history
+    synthetic_book_path = os.path.join(temporary_directory, "move_tree_synthetic.bin")
+    opening_book_builder = OpeningBookBuilder()
+    for game in synthetic_game_list:
+        opening_book_builder.add_game(
+            game["move_list"].split(" "), game["white_player"] == SYNTHETIC_USERNAME)
+    opening_book_builder.write(synthetic_book_path)
+    synthetic_opening_book = OpeningBook(synthetic_book_path)
+    real_opening_book = get_opening_book(REAL_USERNAME)
+
+    real_book_query_list = [
+        sequence.split(" ") for sequence in rng.choices(real_book_sequence_list, k=args.samples)]
+    synthetic_book_query_list = sample_prefixes(
+        synthetic_game_list, args.samples, rng, max_ply_count=16)
+    stage_dict["cache_search (checked-in book)"] = measure(
+        lambda move_list: ChessClient(move_list, REAL_USERNAME).cache_search(real_opening_book),
+        real_book_query_list, warmup_list=real_book_query_list[:args.warmup])
+    stage_dict["cache_search (synthetic book)"] = measure(
+        lambda move_list: ChessClient(move_list, SYNTHETIC_USERNAME).cache_search(synthetic_opening_book),
+        synthetic_book_query_list, warmup_list=synthetic_book_query_list[:args.warmup])
+
+    # Game explosion into (sequence, target) rows
+    for data_name, game_list, lichess_username in (
+        ("checked-in games", real_game_list, REAL_USERNAME),
+        ("synthetic games", synthetic_game_list, SYNTHETIC_USERNAME),
+    ):
+        stage_dict[f"explode_game_into_moves ({data_name})"] = measure(
+            lambda game: explode_game_into_moves(game, lichess_username),
+            game_list,
+            warmup_list=game_list[:args.warmup],
+            item_count=sum(len(game["move_list"].split(" ")) for game in game_list))
+
+    # Board feature extraction for the training dataset
+    vocabulary_dict = {piece.symbol(): plane_index + 1 for plane_index, piece in enumerate(PLANE_PIECES)}
+    vocabulary_dict["EMPTY"] = -1
+    stage_dict["board feature extraction (synthetic games)"] = measure(
+        lambda game: encode_bitboards(game_to_bitboards(
+            game["move_list"].split(" "), start_index=0, step=2), vocabulary_dict),
+        synthetic_game_list,
+        warmup_list=synthetic_game_list[:args.warmup],
+        item_count=len(synthetic_game_list))
+    try:
+        # The training scripts import their neighbours as top-level modules
+        sys.path.insert(0, os.path.join(SERVER_DIRECTORY, "scripts"))
+        from deep_learning_approach import create_dataset
+    except ImportError as ex:
+        stage_dict["create_dataset (synthetic games)"] = {"skipped": f"{type(ex).__name__}: {ex}"}
+    else:
+        synthetic_raw_path = f"../data/raw/games_{SYNTHETIC_USERNAME}.csv"
+        with open(synthetic_raw_path, "w", newline="") as csv_file:
+            csv_writer = csv.DictWriter(csv_file, fieldnames=RAW_GAME_COLUMNS)
+            csv_writer.writeheader()
+            for game_index, game in enumerate(synthetic_game_list):
+                csv_writer.writerow(dict(game, **{"": game_index}))
+        try:
+            stage_dict["create_dataset (synthetic games)"] = measure(
+                lambda _: create_dataset(SYNTHETIC_USERNAME, vocabulary_dict, worker_count=args.dataset_workers),
+                range(args.dataset_repeats),
+                item_count=len(synthetic_game_list) * args.dataset_repeats)
+        finally:
+            os.remove(synthetic_raw_path)
+
+    # Model predictions through the inference scheduler, with the stub model
+    stub_persona_model = make_stub_persona_model(
+        [row[2] for game in real_game_list for row in explode_game_into_moves(game, REAL_USERNAME)],
+        temporary_directory)
+    inference_scheduler_module.get_persona_model = lambda lichess_username: stub_persona_model
+    prediction_query_list = [
+        " ".join(move_list) for move_list in sample_prefixes(synthetic_game_list, args.samples, rng)]
+    stage_dict["make_prediction_using_model"] = measure(
+        lambda moves_in_san_str: make_prediction_using_model(moves_in_san_str, REAL_USERNAME),
+        prediction_query_list, warmup_list=prediction_query_list[:args.warmup])
+    stage_dict[f"make_prediction_using_model ({args.concurrency} threads)"] = measure(
+        lambda moves_in_san_str: make_prediction_using_model(moves_in_san_str, REAL_USERNAME),
+        prediction_query_list, concurrency=args.concurrency)
+    ranked_query_list = []
+    for move_list in sample_prefixes(synthetic_game_list, args.samples, rng):
+        board = chess.Board()
+        for move in move_list:
+            board.push_san(move)
+        ranked_query_list.append(
+            (" ".join(move_list), [board.san(move) for move in board.legal_moves]))
+    stage_dict["make_ranked_prediction_using_model"] = measure(
+        lambda ranked_query: make_ranked_prediction_using_model(
+            ranked_query[0], REAL_USERNAME, ranked_query[1], top_k=3),
+        ranked_query_list, warmup_list=ranked_query_list[:args.warmup])
+
+    # Engine fallback with the fake engine: first on new positions, then on the same ones again
+    engine_query_list = sample_prefixes(
+        synthetic_game_list, args.engine_samples, rng, max_ply_count=60)
+    stage_dict["stockfish_best_move_search (cold)"] = measure(
+        lambda move_list: ChessClient(move_list, SYNTHETIC_USERNAME).stockfish_best_move_search(),
+        engine_query_list)
+    stage_dict["stockfish_best_move_search (warm)"] = measure(
+        lambda move_list: ChessClient(move_list, SYNTHETIC_USERNAME).stockfish_best_move_search(),
+        engine_query_list)
+
+    # The whole route, driven through the ASGI app
+    try:
+        import main
+    except ImportError as ex:
+        stage_dict["GET /train/next-move/"] = {"skipped": f"{type(ex).__name__}: {ex}"}
+    else:
+        # Half the requests are answered by the book, half by the model
+        next_move_query_list = [
+            {"lichess_username": REAL_USERNAME, "partial_sequence": " ".join(move_list)}
+            for move_list in real_book_query_list[:args.samples // 2] + sample_prefixes(
+                synthetic_game_list, args.samples - args.samples // 2, rng)
+        ]
+        rng.shuffle(next_move_query_list)
+        stage_dict[f"GET /train/next-move/ ({args.concurrency} concurrent)"] = asyncio.run(measure_asgi(
+            main.app, "/train/next-move/", next_move_query_list,
+            warmup_count=args.warmup, concurrency=args.concurrency))
+
+    return stage_dict
+
+
+def get_git_commit() -> str:
+    """
+    Return the commit the tree is at, marked when it has local changes, or None outside a git checkout.
+    """
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=SERVER_DIRECTORY, capture_output=True, text=True, check=True
+        ).stdout.strip()
+        dirty = subprocess.run(
+            ["git", "status", "--porcelain", "--untracked-files=no"],
+            cwd=SERVER_DIRECTORY, capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return f"{commit}-dirty" if dirty else commit
+
+
+def print_results(stage_dict: dict):
+    """
+    Print one line per stage.
+    """
+    name_width = max(len(stage_name) for stage_name in stage_dict)
+    print(f"{'stage':<{name_width}}  {'count':>6}  {'p50 ms':>9}  {'p90 ms':>9}  {'p99 ms':>9}  {'max ms':>9}  {'ops/s':>10}")
+    for stage_name, summary in stage_dict.items():
+        if "skipped" in summary:
+            print(f"{stage_name:<{name_width}}  skipped ({summary['skipped']})")
+            continue
+        line = (
+            f"{stage_name:<{name_width}}  {summary['count']:>6}  {summary['p50_ms']:>9.3f}  {summary['p90_ms']:>9.3f}  "
+            f"{summary['p99_ms']:>9.3f}  {summary['max_ms']:>9.3f}  {summary['ops_per_second']:>10.1f}")
+        if "items_per_second" in summary:
+            line += f"  ({summary['items_per_second']:.1f} items/s)"
+        print(line)
+
+
+def compare_results(stage_dict: dict, baseline: dict, threshold: float) -> list[str]:
+    """
+    Print the change of every stage against a baseline and return the stages that regressed.
+    A stage regresses when its p50 latency grew, or its throughput fell, by more than threshold.
+    """
+    print(f"\nCompared with baseline {baseline['meta'].get('commit')} ({baseline['meta'].get('created_at')}):")
+    regressed_stage_list = []
+    for stage_name, summary in stage_dict.items():
+        baseline_summary = baseline["stages"].get(stage_name)
+        if "skipped" in summary or baseline_summary is None or "skipped" in baseline_summary:
+            continue
+        p50_change = summary["p50_ms"] / baseline_summary["p50_ms"] - 1 if baseline_summary["p50_ms"] else 0.0
+        throughput_change = summary["ops_per_second"] / baseline_summary["ops_per_second"] - 1 \
+            if baseline_summary["ops_per_second"] else 0.0
+        regressed = p50_change > threshold or throughput_change < -threshold
+        if regressed:
+            regressed_stage_list.append(stage_name)
+        print(f"  {stage_name}: p50 {p50_change:+.1%}, throughput {throughput_change:+.1%}"
+              f"{'  REGRESSION' if regressed else ''}")
+    return regressed_stage_list
+
+
+def main():
+    """
+    Main function to run the pipeline benchmark from the command line.
+    """
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--games", type=int, default=2000,
+                        help="Number of synthetic games")
+    parser.add_argument("--samples", type=int, default=500,
+                        help="Timed operations per stage")
+    parser.add_argument("--engine-samples", type=int, default=50,
+                        help="Timed operations per engine stage")
+    parser.add_argument("--warmup", type=int, default=5,
+                        help="Untimed operations before each stage")
+    parser.add_argument("--concurrency", type=int, default=8,
+                        help="Threads or in-flight requests in the concurrent stages")
+    parser.add_argument("--dataset-repeats", type=int, default=3)
+    parser.add_argument("--dataset-workers", type=int,
+                        default=os.cpu_count() or 1)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--engine", default=FAKE_ENGINE_PATH,
+                        help="UCI engine to search with, the fake engine by default")
+    parser.add_argument("--baseline", default=DEFAULT_BASELINE_PATH,
+                        help="Baseline file to save to or compare with")
+    parser.add_argument("--save-baseline", action="store_true",
+                        help="Store the results as the baseline")
+    parser.add_argument("--compare", action="store_true",
+                        help="Compare the results with the baseline")
+    parser.add_argument("--threshold", type=float, default=0.2,
+                        help="Relative slowdown counted as a regression")
+    parser.add_argument("--output", help="Also write the results to this file")
+    args = parser.parse_args()
+
+    temporary_directory = tempfile.mkdtemp(prefix="benchmark_pipeline_")
+    os.environ["STOCKFISH_PATH"] = args.engine
+    os.environ["ENGINE_CACHE_PATH"] = os.path.join(
+        temporary_directory, "engine_cache.sqlite3")
+    os.environ["PERSONA_MANIFEST_PATH"] = os.path.join(
+        temporary_directory, "personas.json")
+    try:
+        stage_dict = run_benchmarks(args, temporary_directory)
+    finally:
+        shutil.rmtree(temporary_directory, ignore_errors=True)
+
+    results = {
+        "meta": {
+            "commit": get_git_commit(),
+            "created_at": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+            "python": platform.python_version(),
+            "machine": platform.machine(),
+            "cpu_count": os.cpu_count(),
+            "arguments": dict(
+                {name: value for name, value in vars(args).items()
+                 if name not in ("baseline", "save_baseline", "compare", "output")},
+                # Relative, so baselines compare across checkouts
+                engine=os.path.relpath(args.engine, SERVER_DIRECTORY)),
+        },
+        "stages": stage_dict,
+    }
+    print()
+    print_results(stage_dict)
+
+    regressed_stage_list = []
+    if args.compare:
+        if not os.path.exists(args.baseline):
+            print(f"\nNo baseline at {args.baseline}, run with --save-baseline first")
+        else:
+            with open(args.baseline, "r") as baseline_file:
+                baseline = json.load(baseline_file)
+            if baseline["meta"]["arguments"] != results["meta"]["arguments"]:
+                print("\nWarning: the baseline was recorded with different arguments")
+            regressed_stage_list = compare_results(stage_dict, baseline, args.threshold)
+
+    for file_path in (args.output, args.baseline if args.save_baseline else None):
+        if file_path:
+            os.makedirs(os.path.dirname(file_path) or ".", exist_ok=True)
+            with open(file_path, "w") as output_file:
+                json.dump(results, output_file, indent=1)
+            print(f"\nResults written to {file_path}")
+
+    if regressed_stage_list:
+        sys.exit(1)
+
+
+# Run the main function if this script is run as the main module
+if __name__ == "__main__":
+    main()
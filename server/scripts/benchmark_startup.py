@@ -0,0 +1,130 @@
+"""
+Startup benchmark for the API server: how long a fresh worker takes to import
+main.py and to answer its first requests.
+
+Run from the server directory:
+
+    python -m scripts.benchmark_startup [--runs 5] [--path /] [--import-profile]
+
+Every run starts a new interpreter, so nothing is shared with earlier runs.
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+SERVER_DIRECTORY = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Runs inside the fresh interpreter; requests are sent straight to the ASGI app
+CHILD_SOURCE = """
+import asyncio, json, sys, time
+
+start_time = time.perf_counter()
+import main
+import_seconds = time.perf_counter() - start_time
+
+
+async def request(path):
+    scope = {
+        "type": "http", "asgi": {"version": "3.0"}, "http_version": "1.1",
+        "method": "GET", "scheme": "http", "path": path, "raw_path": path.encode(),
+        "query_string": b"", "root_path": "", "headers": [(b"host", b"localhost")],
+        "client": ("127.0.0.1", 0), "server": ("localhost", 80),
+    }
+    response_status = []
+
+    async def receive():
+        return {"type": "http.request", "body": b"", "more_body": False}
+
+    async def send(message):
+        if message["type"] == "http.response.start":
+            response_status.append(message["status"])
+
+    request_start_time = time.perf_counter()
+    await main.app(scope, receive, send)
+    return time.perf_counter() - request_start_time, response_status[0]
+
+
+first_request_seconds, status = asyncio.run(request(sys.argv[1]))
+second_request_seconds, _ = asyncio.run(request(sys.argv[1]))
+print(json.dumps({
+    "import_seconds": import_seconds,
+    "first_request_seconds": first_request_seconds,
+    "second_request_seconds": second_request_seconds,
+    "status": status,
+    "heavy_modules_loaded": sorted(
+        name for name in ("tensorflow", "pandas", "berserk", "google.generativeai", "torch")
+        if name in sys.modules
+    ),
+}))
+"""
+
+
+def run_once(path: str) -> dict:
+    """
+    Start a fresh interpreter, import the app and time its first two requests.
+    """
+    completed_process = subprocess.run(
+        [sys.executable, "-c", CHILD_SOURCE, path],
+        cwd=SERVER_DIRECTORY,
+        capture_output=True,
+        text=True
+    )
+    if completed_process.returncode != 0:
+        raise RuntimeError(
+            f"Startup run failed:\n{completed_process.stderr}")
+    return json.loads(completed_process.stdout.strip().splitlines()[-1])
+
+
+def get_import_profile(top_count: int) -> list[tuple[int, str]]:
+    """
+    Return the modules that took longest to import on their own, in microseconds.
+    """
+    completed_process = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import main"],
+        cwd=SERVER_DIRECTORY,
+        capture_output=True,
+        text=True,
+        check=True
+    )
+    profile_list = []
+    for line in completed_process.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        # Lines look like "import time:  self_us | cumulative_us |   module"
+        self_us, _, module_name = line[len("import time:"):].split("|")
+        profile_list.append((int(self_us), module_name.strip()))
+    return sorted(profile_list, reverse=True)[:top_count]
+
+
+def main():
+    """
+    Main function to run the startup benchmark from the command line.
+    """
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--path", default="/",
+                        help="Endpoint requested after the import")
+    parser.add_argument("--import-profile", action="store_true",
+                        help="Also list the slowest imports")
+    args = parser.parse_args()
+
+    result_list = [run_once(args.path) for _ in range(args.runs)]
+    for metric in ("import_seconds", "first_request_seconds", "second_request_seconds"):
+        value_list = [result[metric] for result in result_list]
+        print(
+            f"{metric}: median {statistics.median(value_list) * 1000:.1f}ms, "
+            f"min {min(value_list) * 1000:.1f}ms, max {max(value_list) * 1000:.1f}ms")
+    print(f"status: {result_list[-1]['status']}")
+    print(f"heavy modules loaded: {result_list[-1]['heavy_modules_loaded']}")
+
+    if args.import_profile:
+        for self_us, module_name in get_import_profile(top_count=15):
+            print(f"{self_us / 1000:10.1f}ms  {module_name}")
+
+
+# Run the main function if this script is run as the main module
+if __name__ == "__main__":
+    main()
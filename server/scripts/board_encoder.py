@@ -0,0 +1,85 @@
+import chess
+import numpy as np
+
+# Piece planes in vocabulary order (sorted symbols, as in get_vocabulary)
+PLANE_PIECES = sorted(
+    (chess.Piece(piece_type, color) for piece_type in chess.PIECE_TYPES for color in chess.COLORS),
+    key=lambda piece: piece.symbol()
+)
+PLANE_COUNT = len(PLANE_PIECES)
+BOARD_SQUARE_COUNT = 64
+# Square shown at each position of str(board): rank 8 first, files a to h
+FLAT_LIST_SQUARES = np.array([
+    chess.square(file_index, rank_index)
+    for rank_index in range(7, -1, -1)
+    for file_index in range(8)
+])
+
+
+def board_to_bitboards(board: chess.Board, bitboard_row: np.ndarray = None) -> np.ndarray:
+    """Write the bitboard of every piece plane of a board into a uint64 row."""
+    if bitboard_row is None:
+        bitboard_row = np.empty(PLANE_COUNT, dtype=np.uint64)
+    for plane_index, piece in enumerate(PLANE_PIECES):
+        bitboard_row[plane_index] = board.pieces_mask(
+            piece.piece_type, piece.color)
+    return bitboard_row
+
+
+def bitboards_to_planes(bitboards: np.ndarray) -> np.ndarray:
+    """Expand (n, 12) bitboards into (n, 12, 64) 0/1 piece planes indexed by square (a1 = 0)."""
+    bitboards = np.ascontiguousarray(bitboards, dtype="<u8")
+    return np.unpackbits(
+        bitboards.view(np.uint8).reshape(len(bitboards), PLANE_COUNT, 8),
+        axis=2,
+        bitorder="little"
+    )
+
+
+def get_plane_codes(vocabulary_dict: dict) -> np.ndarray:
+    """Return the vocabulary code of each piece plane."""
+    return np.array([vocabulary_dict[piece.symbol()] for piece in PLANE_PIECES], dtype=np.int8)
+
+
+def encode_bitboards(bitboards: np.ndarray, vocabulary_dict: dict) -> np.ndarray:
+    """Encode (n, 12) bitboards as (n, 64) int8 vocabulary codes in str(board) order (rank 8 first)."""
+    planes = bitboards_to_planes(bitboards)[:, :, FLAT_LIST_SQUARES]
+    # Each square is set in at most one plane, so the weighted sum picks its piece code
+    codes = np.einsum(
+        "nps,p->ns", planes, get_plane_codes(vocabulary_dict).astype(np.int16))
+    codes[planes.max(axis=1) == 0] = vocabulary_dict["EMPTY"]
+    return codes.astype(np.int8)
+
+
+def encode_boards(board_list: list[chess.Board], vocabulary_dict: dict) -> np.ndarray:
+    """Encode a batch of boards as (n, 64) int8 vocabulary codes."""
+    bitboards = np.empty((len(board_list), PLANE_COUNT), dtype=np.uint64)
+    for board_index, board in enumerate(board_list):
+        board_to_bitboards(board, bitboards[board_index])
+    return encode_bitboards(bitboards, vocabulary_dict)
+
+
+def encode_board(board: chess.Board, vocabulary_dict: dict) -> np.ndarray:
+    """Encode one board as 64 int8 vocabulary codes."""
+    return encode_bitboards(board_to_bitboards(board)[None, :], vocabulary_dict)[0]
+
+
+def game_to_bitboards(move_list: list[str], start_index: int = 0, step: int = 1,
+                      played_move_list: list[chess.Move] = None) -> np.ndarray:
+    """
+    Play a game on a single board and return the bitboards of the position before
+    moves start_index, start_index + step, ... as a (n, 12) uint64 array. The
+    moves played from those positions are appended to played_move_list if given.
+    """
+    bitboards = np.empty(
+        (len(range(start_index, len(move_list), step)), PLANE_COUNT), dtype=np.uint64)
+    board = chess.Board()
+    for move_idx, move in enumerate(move_list):
+        is_recorded = move_idx >= start_index and (move_idx - start_index) % step == 0
+        if is_recorded:
+            board_to_bitboards(
+                board, bitboards[(move_idx - start_index) // step])
+        played_move = board.push_san(move)
+        if is_recorded and played_move_list is not None:
+            played_move_list.append(played_move)
+    return bitboards
@@ -0,0 +1,39 @@
+import os
+import sys
+
+# Local import
+from opening_book import convert_sequence_target_csv, get_move_tree_path, get_sequence_target_map_path
+from persona_registry import MOVE_TREE_ARTIFACT, get_file_artifact, persona_registry
+
+
+def main():
+    """
+    Main function to convert legacy sequence_target_map CSV files into move tree files.
+    Run from the server directory as:
+
+        python -m scripts.convert_sequence_target_maps [lichess_username ...]
+
+    Without usernames, every sequence_target_map CSV in the processed data directory is converted.
+    """
+    # Get the Lichess usernames from the command line arguments
+    lichess_username_list = sys.argv[1:]
+    if not lichess_username_list:
+        lichess_username_list = [
+            file_name[len("sequence_target_map_"):-len(".csv")]
+            for file_name in sorted(os.listdir("../data/processed"))
+            if file_name.startswith("sequence_target_map_") and file_name.endswith(".csv")
+        ]
+
+    for lichess_username in lichess_username_list:
+        csv_file_path = get_sequence_target_map_path(lichess_username)
+        move_tree_file_path = get_move_tree_path(lichess_username)
+        convert_sequence_target_csv(csv_file_path, move_tree_file_path)
+        persona_registry.record(
+            lichess_username, MOVE_TREE_ARTIFACT, get_file_artifact(move_tree_file_path))
+        print(
+            f"{lichess_username}: {os.path.getsize(csv_file_path)} bytes -> {os.path.getsize(move_tree_file_path)} bytes")
+
+
+# Run the main function if this script is run as the main module
+if __name__ == "__main__":
+    main()
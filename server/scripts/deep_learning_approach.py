@@ -1,34 +1,82 @@
+import os
+import sys
+import time
+import numpy as np
 import pandas as pd
 import chess
 import torch
 import torch.nn as nn
 import torch.optim as optim
 
-from torch.utils.data import DataLoader, Dataset
-from sklearn.model_selection import GroupShuffleSplit
-from sklearn.preprocessing import LabelEncoder
+from concurrent.futures import ProcessPoolExecutor
+from torch.utils.data import DataLoader, IterableDataset, get_worker_info
 
-# Initialize label encoder and hyperparameters
-label_encoder = LabelEncoder()
+# Local import
+from board_encoder import BOARD_SQUARE_COUNT, encode_bitboards, game_to_bitboards
+from move_encoding import MOVE_UCI_LIST, encode_moves
+from shard_dataset import ShardWriter, load_manifest, open_shard
+
+# Hyperparameters
 NUM_EPOCHS = 25
-BATCH_SIZE = 12
+BATCH_SIZE = 256
 LEARNING_RATE = 0.001
+DATASET_WORKERS = os.cpu_count() or 1  # Processes extracting board features
+DATASET_CHUNK_SIZE = 16  # Games sent to a worker process at a time
+SHARD_SIZE = 65536  # Positions per dataset shard
+DATALOADER_WORKERS = 2  # Processes streaming shards into each DataLoader
+VALIDATION_FRACTION = 0.2  # Share of games held out for validation
 
 # Define a PyTorch Dataset for chess data
 
 
-class ChessDataset(Dataset):
-    """A PyTorch Dataset for chess data."""
-
-    def __init__(self, features, labels):
-        self.features = features
-        self.labels = labels
-
-    def __len__(self):
-        return len(self.features)
-
-    def __getitem__(self, index):
-        return self.features[index], self.labels[index]
+class ChessDataset(IterableDataset):
+    """
+    A PyTorch Dataset streaming chess positions from memory-mapped shards.
+    Each DataLoader worker reads its own subset of the shards, and only rows
+    of games selected by game_mask are yielded.
+    """
+
+    def __init__(self, shard_directory: str, game_mask: np.ndarray = None, shuffle: bool = False, seed: int = 0):
+        self.shard_directory = shard_directory
+        self.manifest = load_manifest(shard_directory)
+        self.game_mask = game_mask
+        self.shuffle = shuffle
+        self.seed = seed
+        self.epoch = 0
+
+    def set_epoch(self, epoch: int):
+        """Change the shuffling order for the next pass."""
+        self.epoch = epoch
+
+    def __iter__(self):
+        shard_index_list = list(range(len(self.manifest["shard_row_counts"])))
+        # Every worker draws the same shard order, then keeps its own share of it
+        rng = np.random.default_rng(self.seed + self.epoch)
+        if self.shuffle:
+            rng.shuffle(shard_index_list)
+        worker_info = get_worker_info()
+        if worker_info is not None:
+            shard_index_list = shard_index_list[worker_info.id::worker_info.num_workers]
+            rng = np.random.default_rng(
+                [self.seed + self.epoch, worker_info.id])
+
+        for shard_index in shard_index_list:
+            features, labels, games = open_shard(
+                self.shard_directory,
+                shard_index,
+                self.manifest["shard_row_counts"][shard_index]
+            )
+            row_indexes = np.arange(len(labels))
+            if self.game_mask is not None:
+                row_indexes = row_indexes[self.game_mask[games]]
+            if self.shuffle:
+                rng.shuffle(row_indexes)
+            # Memory stays bounded by one shard
+            shard_features = torch.from_numpy(
+                features[row_indexes].astype(np.float32))
+            shard_labels = torch.from_numpy(labels[row_indexes])
+            for row_index in range(len(row_indexes)):
+                yield shard_features[row_index], shard_labels[row_index]
 
 # Define a PyTorch neural network for chess move prediction
 
@@ -54,20 +102,6 @@ class ChessNN(nn.Module):
         x = self.output_layer(x)
         return x
 
-# Function to convert the board to a flat list
-
-
-def board_to_flat_list(board):
-    """Convert a chess board to a flat list."""
-    board_string = board.__str__()
-    rows = board_string.split("\n")
-    flat_list = []
-    for row in rows:
-        pieces = row.split(" ")
-        flat_list.extend(pieces)
-    flat_list = [None if piece == "." else piece for piece in flat_list]
-    return flat_list
-
 # Function to get the vocabulary of the chess board
 
 
@@ -82,15 +116,6 @@ def get_vocabulary() -> tuple[dict, dict]:
     reverse_vocabulary_dict = {i: char for char, i in vocabulary_dict.items()}
     return vocabulary_dict, reverse_vocabulary_dict
 
-# Function to encode the DataFrame using the vocabulary
-
-
-def encode_df(df: pd.DataFrame, vocabulary_dict: dict) -> pd.DataFrame:
-    """Encode the DataFrame using the vocabulary."""
-    df = df.fillna("EMPTY")
-    df = df.map(lambda x: vocabulary_dict[x] if x in vocabulary_dict else x)
-    return df
-
 # Function to decode the model prediction
 
 
@@ -100,82 +125,143 @@ def decode_model_prediction(prediction_list: list, reverse_vocabulary_dict: dict
     ret_list = [None if x == "EMPTY" else x for x in ret_list]
     return ret_list
 
-# Function to create the dataset
+# Function to extract the board features of one game
 
 
-def create_dataset(lichess_username: str) -> pd.DataFrame:
-    """Create the dataset."""
-    data_df = pd.read_csv(f"../data/raw/games_{lichess_username}.csv")
-    output_df = pd.DataFrame()
-    game_list = []
+def extract_game_features(game: tuple[list[str], int, dict]) -> tuple[np.ndarray, np.ndarray]:
+    """Extract the encoded board before every move of the user in one game, and the move IDs of those moves."""
+    move_list, generator_start_index, vocabulary_dict = game
+    # Advance a single board through the game, then encode all its positions at once
+    played_move_list = []
+    bitboards = game_to_bitboards(
+        move_list, start_index=generator_start_index, step=2, played_move_list=played_move_list)
+    return encode_bitboards(bitboards, vocabulary_dict), encode_moves(played_move_list)
+
+# Function to read the games of a user
+
 
-    for _, row in data_df.iterrows():
-        game_id = row.get("game_id")
-        white_player = row.get("white_player")
-        move_list = row.get("move_list")
+def read_games(lichess_username: str) -> tuple[list[str], list[tuple], list[str]]:
+    """Read the games of a user as (game IDs, extraction inputs, target moves)."""
+    data_df = pd.read_csv(f"../data/raw/games_{lichess_username}.csv")
 
+    game_id_list = []
+    game_list = []
+    target_move_list = []
+    for game_id, white_player, move_list in zip(data_df["game_id"], data_df["white_player"], data_df["move_list"]):
         if isinstance(move_list, float):
             continue
 
         move_list = move_list.split(" ")
-
         generator_start_index = 0 if white_player == lichess_username else 1
-        for move_idx in range(generator_start_index, len(move_list), 2):
-            target_move = move_list[move_idx]
-            input_sequence_list = move_list[:move_idx]
+        game_id_list.append(game_id)
+        game_list.append((move_list, generator_start_index))
+        target_move_list.extend(move_list[generator_start_index::2])
+    return game_id_list, game_list, target_move_list
+
+# Function to extract the board features of many games
+
+
+def iter_game_features(game_list: list[tuple], vocabulary_dict: dict, worker_count: int = DATASET_WORKERS):
+    """Extract the features and move IDs of each game on a process pool, yielding them in game order."""
+    start_time = time.perf_counter()
+    row_count = 0
+    with ProcessPoolExecutor(max_workers=worker_count) as executor:
+        for game_feature_array, game_move_id_array in executor.map(
+            extract_game_features,
+            [(move_list, generator_start_index, vocabulary_dict)
+             for move_list, generator_start_index in game_list],
+            chunksize=DATASET_CHUNK_SIZE
+        ):
+            row_count += len(game_feature_array)
+            yield game_feature_array, game_move_id_array
+
+    elapsed_seconds = time.perf_counter() - start_time
+    print(
+        f"Extracted {row_count} boards from {len(game_list)} games in {elapsed_seconds:.2f}s "
+        f"({len(game_list) / elapsed_seconds:.1f} games/sec)")
 
-            board = chess.Board()
-            for input_move in input_sequence_list:
-                board.push_san(input_move)
+# Function to create the dataset
 
-            board_flat_list = [game_id]
-            board_flat_list.extend(board_to_flat_list(board))
-            board_flat_list.append(target_move)
-            game_list.append(board_flat_list)
 
-    output_df = pd.DataFrame(game_list)
+def create_dataset(lichess_username: str, vocabulary_dict: dict, worker_count: int = DATASET_WORKERS) -> pd.DataFrame:
+    """Create the dataset of encoded boards and target moves in memory."""
+    game_id_list, game_list, target_move_list = read_games(lichess_username)
+
+    # One row per target move, so the arrays can be sized before extraction
+    row_count_list = [
+        len(range(generator_start_index, len(move_list), 2))
+        for move_list, generator_start_index in game_list
+    ]
+    feature_array = np.empty(
+        (sum(row_count_list), BOARD_SQUARE_COUNT), dtype=np.int8)
+
+    row_index = 0
+    for game_feature_array, _ in iter_game_features(game_list, vocabulary_dict, worker_count):
+        feature_array[row_index:row_index +
+                      len(game_feature_array)] = game_feature_array
+        row_index += len(game_feature_array)
+
+    output_df = pd.DataFrame(
+        feature_array, columns=range(1, BOARD_SQUARE_COUNT + 1))
+    output_df.insert(0, 0, np.repeat(game_id_list, row_count_list))
+    output_df[BOARD_SQUARE_COUNT + 1] = target_move_list
     return output_df
 
-# Function to split the dataset into train and validation
+# Function to write the dataset as shards
 
 
-def get_dataset_split(df: pd.DataFrame) -> tuple[pd.DataFrame, pd.DataFrame, pd.DataFrame, pd.DataFrame]:
-    """Split the dataset into train and validation."""
-    df = df.rename(columns={0: "game_id", len(df.columns)-1: "target_move"})
+def write_dataset_shards(lichess_username: str, vocabulary_dict: dict, shard_directory: str,
+                         shard_size: int = SHARD_SIZE, worker_count: int = DATASET_WORKERS) -> dict:
+    """Create the dataset of a user as memory-mapped shards and return their manifest."""
+    game_id_list, game_list, _ = read_games(lichess_username)
 
-    X = df.drop(['target_move', 'game_id'], axis=1)
-    y = df['target_move']
-    y_integers = label_encoder.fit_transform(y.values)
+    # Labels are move IDs, so every user's model shares one fixed label space
+    shard_writer = ShardWriter(
+        shard_directory,
+        shard_size,
+        BOARD_SQUARE_COUNT,
+        MOVE_UCI_LIST,
+        [str(game_id) for game_id in game_id_list]
+    )
+    for game_index, (game_feature_array, game_move_id_array) in enumerate(
+            iter_game_features(game_list, vocabulary_dict, worker_count)):
+        shard_writer.write(
+            game_feature_array,
+            game_move_id_array,
+            np.full(len(game_feature_array), game_index, dtype=np.int32)
+        )
+    shard_writer.close()
+    return load_manifest(shard_directory)
 
-    gss = GroupShuffleSplit(test_size=0.2, n_splits=1, random_state=0)
-    train_idx, val_idx = next(gss.split(X, y, groups=df['game_id']))
+# Function to split the dataset into train and validation
 
-    X_train, X_val = X.iloc[train_idx], X.iloc[val_idx]
-    y_train, y_val = y_integers[train_idx], y_integers[val_idx]
 
-    print("Shapes:", X_train.shape, X_val.shape, y_train.shape, y_val.shape)
-    return X_train, X_val, y_train, y_val
+def get_validation_game_mask(game_count: int, seed: int = 0) -> np.ndarray:
+    """Pick the games held out for validation, so no game is split across train and validation."""
+    validation_game_mask = np.zeros(game_count, dtype=bool)
+    rng = np.random.default_rng(seed)
+    validation_game_mask[rng.permutation(game_count)[
+        :int(round(game_count * VALIDATION_FRACTION))]] = True
+    return validation_game_mask
 
 # Function to train the model
 
 
-def train_model(df: pd.DataFrame):
-    """Train the model."""
-    X_train, X_val, y_train, y_val = get_dataset_split(df)
-
-    X_train_tensor = torch.FloatTensor(X_train.values)
-    y_train_tensor = torch.LongTensor(y_train)
-    X_val_tensor = torch.FloatTensor(X_val.values)
-    y_val_tensor = torch.LongTensor(y_val)
+def train_model(shard_directory: str):
+    """Train the model on the dataset shards in a directory."""
+    manifest = load_manifest(shard_directory)
+    validation_game_mask = get_validation_game_mask(len(manifest["game_ids"]))
 
-    train_dataset = ChessDataset(X_train_tensor, y_train_tensor)
-    val_dataset = ChessDataset(X_val_tensor, y_val_tensor)
+    train_dataset = ChessDataset(
+        shard_directory, game_mask=~validation_game_mask, shuffle=True)
+    val_dataset = ChessDataset(shard_directory, game_mask=validation_game_mask)
     train_loader = DataLoader(
-        train_dataset, batch_size=BATCH_SIZE, shuffle=False)
-    val_loader = DataLoader(val_dataset, batch_size=BATCH_SIZE, shuffle=False)
+        train_dataset, batch_size=BATCH_SIZE, num_workers=DATALOADER_WORKERS)
+    val_loader = DataLoader(val_dataset, batch_size=BATCH_SIZE,
+                            num_workers=DATALOADER_WORKERS)
 
-    input_dim = int(X_train.shape[1])
-    output_dim = int(df.iloc[:, -1:].nunique().values[0])
+    input_dim = int(manifest["feature_width"])
+    output_dim = len(manifest["labels"])
 
     model = ChessNN(input_dim=input_dim, output_dim=output_dim)
     criterion = nn.CrossEntropyLoss()
@@ -189,6 +275,7 @@ def train_model(df: pd.DataFrame):
 
     model.train()
     for epoch in range(NUM_EPOCHS):
+        train_dataset.set_epoch(epoch)
         for features, labels in train_loader:
             optimizer.zero_grad()
             outputs = model(features)
@@ -222,15 +309,18 @@ def save_model(model: ChessNN, model_name: str):
 
 def main():
     """Main function."""
-    lichess_username = "ritutoshniwal"
+    # Get the Lichess username from the command line arguments
+    lichess_username = str(sys.argv[-1]).strip()
     vocabulary_dict, reverse_vocabulary_dict = get_vocabulary()
 
-    dataset_df = create_dataset(lichess_username)
-    dataset_df = encode_df(dataset_df, vocabulary_dict)
+    # Write the encoded boards to disk so training streams them instead of holding them in memory
+    shard_directory = f"../data/shards/{lichess_username}"
+    manifest = write_dataset_shards(
+        lichess_username, vocabulary_dict, shard_directory)
 
-    print(dataset_df.describe())
+    print("Shard rows:", manifest["shard_row_counts"])
 
-    model = train_model(dataset_df)
+    model = train_model(shard_directory)
 
     save_model(model, "../models/chess_nn_model.pth")
 
@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+"""
+A minimal stand-in for the Gemini API.
+
+It answers generateContent requests over REST with an echo of the last
+prompt, so the LLM client can be exercised without network access or an
+API key:
+
+    python scripts/fake_llm_server.py --port 8089 &
+    LLM_API_ENDPOINT=http://127.0.0.1:8089 GEMINI_API_KEY=stub uvicorn main:app
+
+GET /stats returns the number of generateContent requests served and the
+most that were in flight at once.
+"""
+import argparse
+import json
+import threading
+import time
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class FakeLLMServer(ThreadingHTTPServer):
+    """
+    A threaded HTTP server counting the generateContent requests it serves.
+    """
+
+    delay_seconds: float = 0.0  # Time every generateContent request takes
+    request_count: int = 0  # generateContent requests received
+    in_flight_count: int = 0  # generateContent requests being answered
+    max_in_flight_count: int = 0  # Most generateContent requests answered at once
+
+    def __init__(self, server_address: tuple, delay_seconds: float = 0.0):
+        super().__init__(server_address, FakeLLMRequestHandler)
+        self.delay_seconds = delay_seconds
+        self.counter_lock = threading.Lock()
+
+    def stats(self) -> dict:
+        """
+        Return the request counters.
+        """
+        with self.counter_lock:
+            return {"requests": self.request_count, "max_in_flight": self.max_in_flight_count}
+
+
+class FakeLLMRequestHandler(BaseHTTPRequestHandler):
+    """
+    Serves generateContent and stats requests.
+    """
+
+    def send_json(self, status_code: int, body: dict):
+        """
+        Write a JSON response.
+        """
+        encoded_body = json.dumps(body).encode("utf-8")
+        self.send_response(status_code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(encoded_body)))
+        self.end_headers()
+        self.wfile.write(encoded_body)
+
+    def do_POST(self):
+        """
+        Answer POST /v1beta/models/{model}:generateContent with an echo of the prompt.
+        """
+        path = self.path.split("?")[0]
+        if not path.endswith(":generateContent"):
+            self.send_json(404, {"error": {"code": 404, "message": "Not found"}})
+            return
+        request_body = json.loads(self.rfile.read(
+            int(self.headers.get("Content-Length", 0))) or b"{}")
+        with self.server.counter_lock:
+            self.server.request_count += 1
+            self.server.in_flight_count += 1
+            self.server.max_in_flight_count = max(
+                self.server.max_in_flight_count, self.server.in_flight_count)
+        try:
+            time.sleep(self.server.delay_seconds)
+        finally:
+            with self.server.counter_lock:
+                self.server.in_flight_count -= 1
+
+        # The prompt is the text of the last part of the last content
+        content_list = request_body.get("contents", [])
+        prompt_text = ""
+        if content_list and content_list[-1].get("parts"):
+            prompt_text = content_list[-1]["parts"][-1].get("text", "")
+        self.send_json(200, {
+            "candidates": [{
+                "content": {"parts": [{"text": f"Echo: {prompt_text}"}], "role": "model"},
+                "finishReason": "STOP",
+                "index": 0,
+            }],
+        })
+
+    def do_GET(self):
+        """
+        Answer GET /stats with the request counters.
+        """
+        if self.path.split("?")[0] != "/stats":
+            self.send_json(404, {"error": {"code": 404, "message": "Not found"}})
+            return
+        self.send_json(200, self.server.stats())
+
+    def log_message(self, format, *args):
+        """
+        Keep the output quiet.
+        """
+
+
+def main():
+    """
+    Serve the fake Gemini API until interrupted.
+    """
+    parser = argparse.ArgumentParser(description="Stand-in Gemini API server")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8089)
+    parser.add_argument("--delay", type=float, default=0.0,
+                        help="Seconds every generateContent request takes")
+    args = parser.parse_args()
+
+    server = FakeLLMServer((args.host, args.port), delay_seconds=args.delay)
+    print(f"Fake LLM server listening on http://{args.host}:{args.port}", flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
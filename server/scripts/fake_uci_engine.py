@@ -0,0 +1,57 @@
+#!/usr/bin/env python3
+"""
+A minimal stand-in for a UCI engine such as Stockfish.
+
+It speaks enough of the UCI protocol for the engine pool and answers every
+search instantly with the first legal move in UCI order, so the move pipeline
+can be exercised without an engine binary:
+
+    STOCKFISH_PATH=scripts/fake_uci_engine.py uvicorn main:app
+"""
+import sys
+
+import chess
+
+
+def main():
+    """
+    Read UCI commands from stdin and answer them on stdout.
+    """
+    board = chess.Board()
+    for line in sys.stdin:
+        token_list = line.strip().split(" ")
+        command = token_list[0]
+
+        if command == "uci":
+            print("id name FakeUCIEngine")
+            print("option name Skill Level type spin default 20 min 0 max 20")
+            print("uciok")
+        elif command == "isready":
+            print("readyok")
+        elif command == "ucinewgame":
+            board = chess.Board()
+        elif command == "position":
+            # position startpos [moves m1 m2 ...] or position fen <fen> [moves ...]
+            if len(token_list) > 1 and token_list[1] == "fen":
+                fen_end_index = token_list.index(
+                    "moves") if "moves" in token_list else len(token_list)
+                board = chess.Board(" ".join(token_list[2:fen_end_index]))
+            else:
+                board = chess.Board()
+            if "moves" in token_list:
+                for move in token_list[token_list.index("moves") + 1:]:
+                    board.push_uci(move)
+        elif command == "go":
+            legal_move_list = sorted(move.uci() for move in board.legal_moves)
+            if legal_move_list:
+                print(f"info depth 1 multipv 1 score cp 0 pv {legal_move_list[0]}")
+                print(f"bestmove {legal_move_list[0]}")
+            else:
+                print("bestmove (none)")
+        elif command == "quit":
+            break
+        sys.stdout.flush()
+
+
+if __name__ == "__main__":
+    main()
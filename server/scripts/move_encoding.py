@@ -0,0 +1,117 @@
+import chess
+import numpy as np
+
+# Directions a queen moves in, as (file, rank) steps
+QUEEN_DIRECTIONS = [(-1, -1), (-1, 0), (-1, 1), (0, -1),
+                    (0, 1), (1, -1), (1, 0), (1, 1)]
+KNIGHT_JUMPS = [(-2, -1), (-2, 1), (-1, -2), (-1, 2),
+                (1, -2), (1, 2), (2, -1), (2, 1)]
+PROMOTION_PIECE_TYPES = [chess.KNIGHT, chess.BISHOP, chess.ROOK, chess.QUEEN]
+PROMOTION_SLOTS = chess.KING  # Promotion piece types fit below this, None counts as 0
+NO_MOVE_ID = -1
+
+
+def get_move_key(from_square: int, to_square: int, promotion: int = None) -> int:
+    """Return the position of a from/to/promotion triple in the move ID table."""
+    return (from_square * 64 + to_square) * PROMOTION_SLOTS + (promotion or 0)
+
+
+def build_move_list() -> list[chess.Move]:
+    """
+    List every move a legal position can contain: each queen line and knight
+    jump between two squares, plus each pawn step or capture onto the last
+    rank with every promotion piece. King moves, castling (written as the king
+    move) and en passant are all queen lines, so the list is exact and small.
+    """
+    move_list = []
+    for from_square in chess.SQUARES:
+        from_file, from_rank = chess.square_file(from_square), chess.square_rank(from_square)
+        to_square_set = set()
+        for file_step, rank_step in QUEEN_DIRECTIONS:
+            for distance in range(1, 8):
+                to_file, to_rank = from_file + file_step * distance, from_rank + rank_step * distance
+                if not (0 <= to_file < 8 and 0 <= to_rank < 8):
+                    break
+                to_square_set.add(chess.square(to_file, to_rank))
+        for file_step, rank_step in KNIGHT_JUMPS:
+            to_file, to_rank = from_file + file_step, from_rank + rank_step
+            if 0 <= to_file < 8 and 0 <= to_rank < 8:
+                to_square_set.add(chess.square(to_file, to_rank))
+        move_list.extend(chess.Move(from_square, to_square) for to_square in sorted(to_square_set))
+
+        # White promotes from the 7th rank, black from the 2nd
+        for promotion_from_rank, rank_step in ((6, 1), (1, -1)):
+            if from_rank != promotion_from_rank:
+                continue
+            for file_step in (-1, 0, 1):
+                if 0 <= from_file + file_step < 8:
+                    to_square = chess.square(from_file + file_step, from_rank + rank_step)
+                    move_list.extend(chess.Move(from_square, to_square, promotion=piece_type)
+                                     for piece_type in PROMOTION_PIECE_TYPES)
+    return move_list
+
+
+# Move ID -> move, and the same in UCI
+MOVE_LIST = build_move_list()
+MOVE_UCI_LIST = [move.uci() for move in MOVE_LIST]
+MOVE_COUNT = len(MOVE_LIST)
+# Move key -> move ID, NO_MOVE_ID for triples no position allows
+MOVE_ID_TABLE = [NO_MOVE_ID] * (64 * 64 * PROMOTION_SLOTS)
+for move_id, move in enumerate(MOVE_LIST):
+    MOVE_ID_TABLE[get_move_key(move.from_square, move.to_square, move.promotion)] = move_id
+MOVE_ID_ARRAY = np.array(MOVE_ID_TABLE, dtype=np.int16)
+
+
+def encode_move(move: chess.Move) -> int:
+    """Return the ID of a move."""
+    move_id = MOVE_ID_TABLE[get_move_key(move.from_square, move.to_square, move.promotion)] \
+        if not move.drop else NO_MOVE_ID
+    if move_id == NO_MOVE_ID:
+        raise ValueError(f"No move ID for {move.uci()}")
+    return move_id
+
+
+def decode_move(move_id: int) -> chess.Move:
+    """Return the move of an ID."""
+    return MOVE_LIST[move_id]
+
+
+def encode_moves(move_list: list[chess.Move]) -> np.ndarray:
+    """Encode moves as a uint16 array of move IDs."""
+    return np.array([encode_move(move) for move in move_list], dtype=np.uint16)
+
+
+def encode_san(board: chess.Board, san: str) -> int:
+    """Return the ID of a SAN move played on a board."""
+    return encode_move(board.parse_san(san))
+
+
+def decode_san(board: chess.Board, move_id: int) -> str:
+    """Return the SAN of a move ID on a board, where the move must be legal."""
+    return board.san(MOVE_LIST[move_id])
+
+
+def encode_game(move_list: list[str]) -> np.ndarray:
+    """Play a game of SAN moves on a single board and return its moves as uint16 move IDs."""
+    board = chess.Board()
+    return encode_moves([board.push_san(move) for move in move_list])
+
+
+def decode_game(move_ids: np.ndarray) -> list[str]:
+    """Replay a game of move IDs on a single board and return its SAN moves."""
+    board = chess.Board()
+    san_list = []
+    for move_id in move_ids:
+        move = MOVE_LIST[move_id]
+        san_list.append(board.san(move))
+        board.push(move)
+    return san_list
+
+
+def get_legal_move_ids(board: chess.Board) -> np.ndarray:
+    """Return the IDs of the legal moves of a board, for masking predictions over the move IDs."""
+    legal_move_list = list(board.legal_moves)
+    keys = np.fromiter(
+        (get_move_key(move.from_square, move.to_square, move.promotion) for move in legal_move_list),
+        dtype=np.int64, count=len(legal_move_list))
+    return MOVE_ID_ARRAY[keys].astype(np.uint16)
@@ -0,0 +1,104 @@
+import json
+import os
+
+import numpy as np
+
+MANIFEST_FILE_NAME = "manifest.json"
+SHARD_ARRAYS = ("features", "labels", "games")
+
+
+def get_shard_path(shard_directory: str, shard_index: int, array_name: str) -> str:
+    """Return the path of one array of a shard."""
+    return os.path.join(shard_directory, f"shard_{shard_index:05d}_{array_name}.npy")
+
+
+class ShardWriter:
+    """
+    Writes rows of (features, label, game index) into fixed-size .npy shards
+    through memory maps, so only the shard being filled is touched. The
+    manifest records the row count of every shard plus the label and game
+    ID lists needed to decode them.
+    """
+
+    def __init__(self, shard_directory: str, shard_size: int, feature_width: int,
+                 label_list: list[str], game_id_list: list[str], feature_dtype=np.int8):
+        self.shard_directory = shard_directory
+        self.shard_size = shard_size
+        self.feature_width = feature_width
+        self.feature_dtype = np.dtype(feature_dtype)
+        self.label_list = label_list
+        self.game_id_list = game_id_list
+        self.shard_row_count_list = []
+        self._shard = None  # (features, labels, games) memory maps of the open shard
+        self._shard_row_count = 0
+        os.makedirs(shard_directory, exist_ok=True)
+
+    def _open_shard(self):
+        """Allocate the next shard on disk."""
+        shard_index = len(self.shard_row_count_list)
+        self._shard = (
+            np.lib.format.open_memmap(
+                get_shard_path(self.shard_directory, shard_index, "features"),
+                mode="w+", dtype=self.feature_dtype, shape=(self.shard_size, self.feature_width)),
+            np.lib.format.open_memmap(
+                get_shard_path(self.shard_directory, shard_index, "labels"),
+                mode="w+", dtype=np.int64, shape=(self.shard_size,)),
+            np.lib.format.open_memmap(
+                get_shard_path(self.shard_directory, shard_index, "games"),
+                mode="w+", dtype=np.int32, shape=(self.shard_size,)),
+        )
+        self.shard_row_count_list.append(0)
+        self._shard_row_count = 0
+
+    def _close_shard(self):
+        """Flush the open shard and record its row count."""
+        for array in self._shard:
+            array.flush()
+        self.shard_row_count_list[-1] = self._shard_row_count
+        self._shard = None
+
+    def write(self, features: np.ndarray, labels: np.ndarray, games: np.ndarray):
+        """Append rows, spilling into new shards as they fill up."""
+        row_index = 0
+        while row_index < len(features):
+            if self._shard is None:
+                self._open_shard()
+            row_count = min(len(features) - row_index,
+                            self.shard_size - self._shard_row_count)
+            shard_slice = slice(self._shard_row_count,
+                                self._shard_row_count + row_count)
+            for array, values in zip(self._shard, (features, labels, games)):
+                array[shard_slice] = values[row_index:row_index + row_count]
+            self._shard_row_count += row_count
+            row_index += row_count
+            if self._shard_row_count == self.shard_size:
+                self._close_shard()
+
+    def close(self):
+        """Flush the last shard and write the manifest."""
+        if self._shard is not None:
+            self._close_shard()
+        manifest = {
+            "shard_size": self.shard_size,
+            "feature_width": self.feature_width,
+            "feature_dtype": self.feature_dtype.str,
+            "shard_row_counts": self.shard_row_count_list,
+            "labels": self.label_list,
+            "game_ids": self.game_id_list,
+        }
+        with open(os.path.join(self.shard_directory, MANIFEST_FILE_NAME), "w") as manifest_file:
+            json.dump(manifest, manifest_file)
+
+
+def load_manifest(shard_directory: str) -> dict:
+    """Read the manifest of a shard directory."""
+    with open(os.path.join(shard_directory, MANIFEST_FILE_NAME), "r") as manifest_file:
+        return json.load(manifest_file)
+
+
+def open_shard(shard_directory: str, shard_index: int, row_count: int) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Memory-map the (features, labels, games) arrays of a shard, trimmed to its rows."""
+    return tuple(
+        np.load(get_shard_path(shard_directory, shard_index, array_name), mmap_mode="r")[:row_count]
+        for array_name in SHARD_ARRAYS
+    )
@@ -0,0 +1,314 @@
+"""
+Offline training runner for the persona models served by the next-move pipeline.
+
+Run from the server directory after the games of a user have been ingested:
+
+    python -m scripts.train_persona_model <lichess_username> [--threads 4] [--resume]
+
+The runner trains the GRU move model on the raw game history of the user and
+publishes model_arch.json, model_weights.h5, tokenizer.pickle,
+label_encoder.pickle and the persona pack mapped by the server as a new
+version under models/{user}/versions/. The models/{user}/current link is then
+switched to it in one step, so the server never sees a partially written
+artifact set.
+"""
+import argparse
+import csv
+import json
+import os
+import pickle
+import shutil
+import time
+import uuid
+
+import numpy as np
+import tensorflow as tf
+
+from sklearn.preprocessing import LabelEncoder
+from tensorflow.keras.callbacks import BackupAndRestore, EarlyStopping
+from tensorflow.keras.layers import GRU, Dense, Dropout, Embedding
+from tensorflow.keras.models import Sequential
+from tensorflow.keras.optimizers import Adam
+from tensorflow.keras.preprocessing.text import Tokenizer
+
+# Local
+from constants import MAX_SEQUENCE_LENGTH
+from model_registry import MODEL_ARTIFACT_FILE_NAMES, get_user_model_directory
+from persona_pack import PERSONA_PACK_FILE_NAME, write_persona_pack
+from persona_registry import MODEL_ARTIFACT, persona_registry
+
+# Training defaults
+BATCH_SIZE = 512
+MAX_EPOCHS = 30
+EARLY_STOPPING_PATIENCE = 3
+LEARNING_RATE = 0.001
+VALIDATION_FRACTION = 0.2  # Share of games held out for validation
+SHUFFLE_BUFFER_SIZE = 65536
+MODEL_VERSIONS_KEPT = 3  # Published versions kept per user, including the current one
+
+
+def read_games(lichess_username: str) -> list[tuple[list[str], int]]:
+    """
+    Read the games of a user as (move list, index of the first move played by the user).
+    """
+    game_list = []
+    with open(f"../data/raw/games_{lichess_username}.csv", "r", newline="") as raw_games_file:
+        for game in csv.DictReader(raw_games_file):
+            move_list = [move for move in (game["move_list"] or "").split(" ") if move != ""]
+            if not move_list:
+                continue
+            generator_start_index = 0 if game["white_player"] == lichess_username else 1
+            game_list.append((move_list, generator_start_index))
+    return game_list
+
+
+def fit_encoders(game_list: list[tuple[list[str], int]]) -> tuple[Tokenizer, LabelEncoder]:
+    """
+    Fit the move tokenizer on every game and the label encoder on the moves played by the user.
+    """
+    tokenizer = Tokenizer()
+    tokenizer.fit_on_texts(" ".join(move_list) for move_list, _ in game_list)
+    label_encoder = LabelEncoder()
+    label_encoder.fit([
+        move
+        for move_list, generator_start_index in game_list
+        for move in move_list[generator_start_index::2]
+    ])
+    return tokenizer, label_encoder
+
+
+def build_examples(
+    game_list: list[tuple[list[str], int]],
+    tokenizer: Tokenizer,
+    label_encoder: LabelEncoder,
+    max_sequence_length: int = MAX_SEQUENCE_LENGTH
+) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Build the padded token sequence before every move of the user, its label and its game index.
+    Sequences match what the server feeds the model: pre-padded and keeping the latest tokens.
+    """
+    row_count = sum(
+        len(range(generator_start_index, len(move_list), 2))
+        for move_list, generator_start_index in game_list
+    )
+    sequences = np.zeros((row_count, max_sequence_length), dtype=np.int32)
+    labels = np.empty(row_count, dtype=np.int32)
+    game_indexes = np.empty(row_count, dtype=np.int32)
+
+    row_index = 0
+    for game_index, (move_list, generator_start_index) in enumerate(game_list):
+        # Tokenize each move once; every prefix is then a slice of the game's token list
+        token_list = []
+        prefix_end_list = []
+        for move_tokens in tokenizer.texts_to_sequences(move_list):
+            prefix_end_list.append(len(token_list))
+            token_list.extend(move_tokens)
+        target_list = move_list[generator_start_index::2]
+        label_list = label_encoder.transform(target_list)
+        for target_index, move_index in enumerate(range(generator_start_index, len(move_list), 2)):
+            prefix_tokens = token_list[:prefix_end_list[move_index]][-max_sequence_length:]
+            if prefix_tokens:
+                sequences[row_index, -len(prefix_tokens):] = prefix_tokens
+            labels[row_index] = label_list[target_index]
+            game_indexes[row_index] = game_index
+            row_index += 1
+    return sequences, labels, game_indexes
+
+
+def build_model(vocabulary_size: int, class_count: int, max_sequence_length: int = MAX_SEQUENCE_LENGTH) -> Sequential:
+    """
+    Build the GRU move model, with the same architecture as the notebooks.
+    """
+    model = Sequential()
+    model.add(Embedding(vocabulary_size, 128, input_length=max_sequence_length))
+    model.add(GRU(400))
+    model.add(Dropout(0.2))
+    model.add(Dense(class_count, activation="softmax"))
+    return model
+
+
+def publish_artifacts(lichess_username: str, model: Sequential, tokenizer: Tokenizer,
+                      label_encoder: LabelEncoder, metadata: dict) -> str:
+    """
+    Write the artifact set as a new version and switch models/{user}/current to it atomically.
+    Returns the directory of the new version.
+    """
+    user_model_directory = get_user_model_directory(lichess_username)
+    versions_directory = os.path.join(user_model_directory, "versions")
+    # The random suffix keeps publishes for the same user in the same second apart
+    version = f"{time.strftime('%Y%m%dT%H%M%SZ', time.gmtime())}-{uuid.uuid4().hex[:8]}"
+    staging_directory = os.path.join(versions_directory, f".{version}.tmp")
+    version_directory = os.path.join(versions_directory, version)
+    os.makedirs(staging_directory)
+
+    with open(os.path.join(staging_directory, "model_arch.json"), "w") as model_arch_file:
+        model_arch_file.write(model.to_json())
+    model.save_weights(os.path.join(staging_directory, "model_weights.h5"))
+    with open(os.path.join(staging_directory, "tokenizer.pickle"), "wb") as tokenizer_file:
+        pickle.dump(tokenizer, tokenizer_file, protocol=pickle.HIGHEST_PROTOCOL)
+    with open(os.path.join(staging_directory, "label_encoder.pickle"), "wb") as label_encoder_file:
+        pickle.dump(label_encoder, label_encoder_file,
+                    protocol=pickle.HIGHEST_PROTOCOL)
+    # Server workers map the tokenizer and label tables from the pack instead of unpickling them
+    write_persona_pack(os.path.join(staging_directory, PERSONA_PACK_FILE_NAME),
+                       label_encoder.classes_, tokenizer)
+    with open(os.path.join(staging_directory, "metadata.json"), "w") as metadata_file:
+        json.dump(dict(metadata, version=version), metadata_file, indent=2)
+
+    # Renames are atomic, so readers see either the old version or the complete new one
+    os.rename(staging_directory, version_directory)
+    current_link_path = os.path.join(user_model_directory, "current")
+    # A private temporary link lets concurrent publishes race safely and ignores links left by a crash
+    temporary_link_path = f"{current_link_path}.{version}.tmp"
+    os.symlink(os.path.join("versions", version), temporary_link_path)
+    os.replace(temporary_link_path, current_link_path)
+
+    # Drop the oldest versions, never the one a concurrent publish just made current
+    current_version = os.path.basename(os.readlink(current_link_path))
+    version_list = sorted(
+        version_name for version_name in os.listdir(versions_directory) if not version_name.startswith("."))
+    for old_version in version_list[:-MODEL_VERSIONS_KEPT]:
+        if old_version != current_version:
+            shutil.rmtree(os.path.join(versions_directory, old_version), ignore_errors=True)
+
+    persona_registry.record(lichess_username, MODEL_ARTIFACT, {
+        "path": version_directory,
+        "size_bytes": sum(
+            os.path.getsize(os.path.join(version_directory, file_name))
+            for file_name in MODEL_ARTIFACT_FILE_NAMES
+        ),
+        "version": version,
+    })
+    return version_directory
+
+
+def train_persona_model(
+    lichess_username: str,
+    threads: int = None,
+    batch_size: int = BATCH_SIZE,
+    max_epochs: int = MAX_EPOCHS,
+    patience: int = EARLY_STOPPING_PATIENCE,
+    resume: bool = False,
+    seed: int = 0
+) -> str:
+    """
+    Train the persona model of a user and publish it. Returns the directory of the published version.
+    """
+    if threads:
+        # Must run before TensorFlow executes any op
+        tf.config.threading.set_intra_op_parallelism_threads(threads)
+        tf.config.threading.set_inter_op_parallelism_threads(
+            max(1, threads // 2))
+    tf.keras.utils.set_random_seed(seed)
+
+    # Checkpoints and the encoders of an interrupted run live here until the model is published
+    training_directory = os.path.join(
+        get_user_model_directory(lichess_username), "training")
+    encoder_file_path = os.path.join(training_directory, "encoders.pickle")
+    if not resume:
+        shutil.rmtree(training_directory, ignore_errors=True)
+    os.makedirs(training_directory, exist_ok=True)
+
+    start_time = time.perf_counter()
+    game_list = read_games(lichess_username)
+    if resume and os.path.exists(encoder_file_path):
+        # Resumed weights only make sense with the token and label indexes they were trained with
+        with open(encoder_file_path, "rb") as encoder_file:
+            tokenizer, label_encoder = pickle.load(encoder_file)
+    else:
+        tokenizer, label_encoder = fit_encoders(game_list)
+        with open(encoder_file_path, "wb") as encoder_file:
+            pickle.dump((tokenizer, label_encoder), encoder_file,
+                        protocol=pickle.HIGHEST_PROTOCOL)
+    sequences, labels, game_indexes = build_examples(
+        game_list, tokenizer, label_encoder)
+    print(
+        f"Built {len(labels)} examples from {len(game_list)} games in {time.perf_counter() - start_time:.2f}s")
+
+    # Hold out whole games so positions of one game never land on both sides
+    rng = np.random.default_rng(seed)
+    validation_game_mask = np.zeros(len(game_list), dtype=bool)
+    validation_game_mask[rng.permutation(len(game_list))[
+        :int(round(len(game_list) * VALIDATION_FRACTION))]] = True
+    validation_row_mask = validation_game_mask[game_indexes]
+
+    train_dataset = tf.data.Dataset.from_tensor_slices(
+        (sequences[~validation_row_mask], labels[~validation_row_mask])
+    ).shuffle(
+        min(SHUFFLE_BUFFER_SIZE, int((~validation_row_mask).sum())) or 1,
+        seed=seed,
+        reshuffle_each_iteration=True
+    ).batch(batch_size).prefetch(tf.data.AUTOTUNE)
+    validation_dataset = tf.data.Dataset.from_tensor_slices(
+        (sequences[validation_row_mask], labels[validation_row_mask])
+    ).batch(batch_size).prefetch(tf.data.AUTOTUNE)
+
+    model = build_model(len(tokenizer.word_index) + 1,
+                        len(label_encoder.classes_))
+    # Integer labels avoid materializing one-hot targets
+    model.compile(
+        loss="sparse_categorical_crossentropy",
+        optimizer=Adam(learning_rate=LEARNING_RATE),
+        metrics=["accuracy"]
+    )
+    history = model.fit(
+        train_dataset,
+        epochs=max_epochs,
+        validation_data=validation_dataset,
+        callbacks=[
+            # Saves weights, optimizer state and epoch after every epoch and restores them on restart
+            BackupAndRestore(os.path.join(training_directory, "backup")),
+            EarlyStopping(monitor="val_loss", patience=patience,
+                          restore_best_weights=True, verbose=1),
+        ],
+        verbose=2
+    )
+
+    metadata = {
+        "lichess_username": lichess_username,
+        "games": len(game_list),
+        "examples": int(len(labels)),
+        "epochs": len(history.history.get("loss", [])),
+        "val_loss": min(history.history.get("val_loss", [float("nan")])),
+        "val_accuracy": max(history.history.get("val_accuracy", [float("nan")])),
+        "batch_size": batch_size,
+        "training_seconds": time.perf_counter() - start_time,
+    }
+    version_directory = publish_artifacts(
+        lichess_username, model, tokenizer, label_encoder, metadata)
+    shutil.rmtree(training_directory, ignore_errors=True)
+    print(f"Published {version_directory}: {metadata}")
+    return version_directory
+
+
+def main():
+    """
+    Main function to train and publish the persona model of a user from the command line.
+    """
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("lichess_username")
+    parser.add_argument("--threads", type=int, default=os.cpu_count(),
+                        help="TensorFlow intra-op threads")
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE)
+    parser.add_argument("--max-epochs", type=int, default=MAX_EPOCHS)
+    parser.add_argument("--patience", type=int, default=EARLY_STOPPING_PATIENCE,
+                        help="Epochs without validation improvement before stopping")
+    parser.add_argument("--resume", action="store_true",
+                        help="Continue an interrupted run from its last checkpoint")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    train_persona_model(
+        args.lichess_username,
+        threads=args.threads,
+        batch_size=args.batch_size,
+        max_epochs=args.max_epochs,
+        patience=args.patience,
+        resume=args.resume,
+        seed=args.seed
+    )
+
+
+# Run the main function if this script is run as the main module
+if __name__ == "__main__":
+    main()
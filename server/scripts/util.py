@@ -1,24 +1,49 @@
 import csv
+import json
 import os
-import pickle
-import berserk
-import numpy as np
-import pandas as pd
+import threading
+
+from collections import deque
+from datetime import datetime
+from itertools import islice
+from typing import TYPE_CHECKING, Callable, Iterator
 
 from tqdm import tqdm
-from tensorflow.keras.preprocessing.sequence import pad_sequences
-from tensorflow.keras.models import model_from_json
 
-from constants import MAX_SEQUENCE_LENGTH
+from constants import ANONYMOUS_PLAYER, INGEST_CHUNK_SIZE, LICHESS_API_TOKEN
+from inference_scheduler import inference_scheduler
+from opening_book import OpeningBookBuilder, get_move_tree_path
+from persona_registry import MOVE_TREE_ARTIFACT, RAW_ARTIFACT, get_file_artifact, persona_registry
+
+if TYPE_CHECKING:
+    import berserk
+    import pandas as pd
+
+# Built on first use so importing this module stays cheap
+__berserk_client__ = None
+__berserk_client_lock__ = threading.Lock()
 
-# Get the Lichess API token from the environment variables
-LICHESS_API_TOKEN = os.environ["LICHESS_API_TOKEN"]
-# Create a Berserk session and client using the Lichess API token
-berserk_session = berserk.TokenSession(LICHESS_API_TOKEN)
-berserk_client = berserk.Client(session=berserk_session)
 
+def get_berserk_client() -> "berserk.Client":
+    """
+    Return the process-wide Berserk client, creating it on first use.
 
-def get_game_history_df(lichess_username: str) -> pd.DataFrame:
+    Returns:
+        berserk.Client: A client authenticated with the Lichess API token.
+    """
+    global __berserk_client__
+    with __berserk_client_lock__:
+        if __berserk_client__ is None:
+            if not LICHESS_API_TOKEN:
+                raise RuntimeError("LICHESS_API_TOKEN is not set")
+            import berserk
+            # Create a Berserk session and client using the Lichess API token
+            berserk_session = berserk.TokenSession(LICHESS_API_TOKEN)
+            __berserk_client__ = berserk.Client(session=berserk_session)
+    return __berserk_client__
+
+
+def get_game_history_df(lichess_username: str) -> "pd.DataFrame":
     """
     Get the game history DataFrame of a user by their Lichess username.
 
@@ -28,6 +53,8 @@ def get_game_history_df(lichess_username: str) -> pd.DataFrame:
     Returns:
         pd.DataFrame: The game history DataFrame of the user.
     """
+    import pandas as pd
+
     # Define the path of the game history file
     game_history_file_path = f"../data/processed/sequence_target_map_{lichess_username}.csv"
     # Read the game history file into a DataFrame
@@ -37,50 +64,317 @@ def get_game_history_df(lichess_username: str) -> pd.DataFrame:
     return game_history_df
 
 
-def get_games_and_moves_by_username(username: str) -> list[dict]:
+def summarize_game(game: dict) -> dict:
     """
-    Get the games and moves of a user by their username.
+    Summarize a game from the Lichess export.
+
+    Args:
+        game (dict): A game as returned by the Berserk client.
+
+    Returns:
+        dict: The game summary, or None if the game is not a standard chess game.
+    """
+    # Skip the game if its variant is not "standard"
+    variant = game.get("variant", None)
+    if variant != "standard":
+        return None
+    # Get the game ID, players, and moves
+    game_id = game.get("id", "")
+    players = game.get("players", {})
+    # Players without an account have no user, the same name the raw game history files store for them
+    white_player = players.get("white", {}).get("user", {}).get("name") or ANONYMOUS_PLAYER
+    black_player = players.get("black", {}).get("user", {}).get("name") or ANONYMOUS_PLAYER
+    winning_player = game.get("winner", "")
+    winning_player = white_player if winning_player == "white" else black_player
+    move_list = game.get("moves", "")
+    # Berserk converts timestamps to datetimes; keep them as epoch milliseconds
+    created_at = game.get("createdAt", None)
+    if isinstance(created_at, datetime):
+        created_at = int(created_at.timestamp() * 1000)
+
+    # Create a dictionary summarizing the game
+    return {
+        "game_id": game_id,
+        "white_player": white_player,
+        "black_player": black_player,
+        "winning_player": winning_player,
+        "move_list": move_list,
+        "created_at": created_at,
+    }
+
+
+def iter_games_and_moves_by_username(
+    username: str,
+    since: int = None,
+    sort: str = None,
+    max_games: int = None,
+    export_games: Callable = None
+) -> Iterator[dict]:
+    """
+    Stream the games and moves of a user by their username as they are exported.
 
     Args:
         username (str): The username of the user.
+        since (int): Only export games created at or after this epoch millisecond timestamp.
+        sort (str): "dateAsc" or "dateDesc"; Lichess defaults to newest first.
+        max_games (int): Export at most this many games; all of them if None.
+        export_games (Callable): Stand-in for the Berserk export_by_player call.
 
     Returns:
-        list[dict]: A list of dictionaries, each representing a game.
+        Iterator[dict]: An iterator of dictionaries, each representing a game.
     """
+    export_games = export_games or get_berserk_client().games.export_by_player
     # Export the games of the user using the Berserk client
-    games = berserk_client.games.export_by_player(
+    games = export_games(
         username,
+        since=since,
+        sort=sort,
+        max=max_games,
         analysed=False,
         evals=False,
         moves=True
     )
-    game_list = []
     # Loop through each game
     for game in tqdm(games):
-        # Skip the game if its variant is not "standard"
-        variant = game.get("variant", None)
-        if variant != "standard":
-            continue
-        # Get the game ID, players, and moves
-        game_id = game.get("id", "")
-        players = game.get("players", {})
-        white_player = players.get("white", {}).get("user", {}).get("name", "")
-        black_player = players.get("black", {}).get("user", {}).get("name", "")
-        winning_player = game.get("winner", "")
-        winning_player = white_player if winning_player == "white" else black_player
-        move_list = game.get("moves", "")
-
-        # Create a dictionary summarizing the game
-        game_summary_dict = {
-            "game_id": game_id,
-            "white_player": white_player,
-            "black_player": black_player,
-            "winning_player": winning_player,
-            "move_list": move_list,
+        game_summary_dict = summarize_game(game)
+        if game_summary_dict is not None:
+            yield game_summary_dict
+
+
+def get_games_and_moves_by_username(username: str) -> list[dict]:
+    """
+    Get the games and moves of a user by their username.
+
+    Args:
+        username (str): The username of the user.
+
+    Returns:
+        list[dict]: A list of dictionaries, each representing a game.
+    """
+    return list(iter_games_and_moves_by_username(username))
+
+
+def get_raw_games_path(lichess_username: str) -> str:
+    """
+    Return the path of the raw game history file of a user.
+    """
+    return f"../data/raw/games_{lichess_username}.csv"
+
+
+def get_ingest_state_path(lichess_username: str) -> str:
+    """
+    Return the path of the ingestion state file of a user.
+    """
+    return f"../data/raw/games_{lichess_username}.state.json"
+
+
+def read_ingest_state(lichess_username: str) -> dict:
+    """
+    Read the ingestion state of a user.
+
+    Args:
+        lichess_username (str): The Lichess username of the user.
+
+    Returns:
+        dict: The ingestion state, or None if the user was never ingested incrementally.
+    """
+    try:
+        with open(get_ingest_state_path(lichess_username), "r") as state_file:
+            return json.load(state_file)
+    except FileNotFoundError:
+        return None
+
+
+def write_ingest_state(lichess_username: str, ingest_state: dict):
+    """
+    Atomically replace the ingestion state of a user.
+
+    Args:
+        lichess_username (str): The Lichess username of the user.
+        ingest_state (dict): The ingestion state.
+    """
+    state_file_path = get_ingest_state_path(lichess_username)
+    with open(f"{state_file_path}.tmp", "w") as state_file:
+        json.dump(ingest_state, state_file)
+        state_file.flush()
+        os.fsync(state_file.fileno())
+    os.replace(f"{state_file_path}.tmp", state_file_path)
+
+
+RAW_GAME_COLUMNS = ["", "game_id", "white_player",
+                    "black_player", "winning_player", "move_list", "created_at"]
+
+
+def read_raw_games_columns(raw_games_path: str) -> list[str]:
+    """
+    Return the header of a raw game history file.
+
+    Args:
+        raw_games_path (str): The path of the raw game history file.
+
+    Returns:
+        list[str]: The column names, or an empty list if the file is empty.
+    """
+    with open(raw_games_path, "r", newline="") as raw_games_file:
+        return next(csv.reader(raw_games_file), [])
+
+
+def iter_local_games_by_username(lichess_username: str, since: int = None, limit: int = None) -> Iterator[dict]:
+    """
+    Stream the games of a user from their raw game history file, oldest first.
+    Files written before incremental ingestion have no ingestion state and list
+    the newest game first, so they are read backwards.
+
+    Args:
+        lichess_username (str): The Lichess username of the user.
+        since (int): Only yield games created at or after this epoch millisecond timestamp.
+            Requires a file with a created_at column.
+        limit (int): Yield at most this many games; all of them if None.
+
+    Returns:
+        Iterator[dict]: An iterator of game summaries, as yielded by iter_games_and_moves_by_username.
+    """
+    newest_first = read_ingest_state(lichess_username) is None
+
+    def iter_matching_games(raw_games_file) -> Iterator[dict]:
+        for game in csv.DictReader(raw_games_file):
+            created_at = game.get("created_at")
+            created_at = int(created_at) if created_at else None
+            if since is not None and (created_at is None or created_at < since):
+                continue
+            yield {
+                "game_id": game["game_id"],
+                "white_player": game["white_player"],
+                "black_player": game["black_player"],
+                "winning_player": game["winning_player"],
+                "move_list": game["move_list"],
+                "created_at": created_at,
+            }
+
+    with open(get_raw_games_path(lichess_username), "r", newline="") as raw_games_file:
+        game_iterator = iter_matching_games(raw_games_file)
+        if newest_first:
+            # The oldest games are at the end of the file; only the last limit of them are kept
+            game_iterator = reversed(deque(game_iterator, maxlen=limit))
+        yield from islice(game_iterator, limit)
+
+
+def ingest_games_by_username(
+    lichess_username: str,
+    export_games: Callable = None,
+    on_chunk_written: Callable = None
+) -> int:
+    """
+    Stream the games of a user into their raw game history file in chunks.
+
+    Games are exported oldest first. After each chunk is on disk the state file
+    records the file size and the high-water mark (creation time and ID of the
+    newest game written), so an interrupted ingestion resumes where it stopped
+    and a refresh only exports games newer than the ones already stored.
+
+    Args:
+        lichess_username (str): The Lichess username of the user.
+        export_games (Callable): Stand-in for the Berserk export_by_player call.
+        on_chunk_written (Callable): Called with the number of games stored so far after each chunk.
+
+    Returns:
+        int: The number of games added to the file.
+    """
+    raw_games_path = get_raw_games_path(lichess_username)
+    ingest_state = read_ingest_state(lichess_username)
+    if (
+        ingest_state is None
+        or not os.path.exists(raw_games_path)
+        or read_raw_games_columns(raw_games_path) != RAW_GAME_COLUMNS
+    ):
+        # Files written before incremental ingestion carry no high-water mark,
+        # and older layouts lack the creation time, so start over
+        with open(raw_games_path, "w", newline="") as raw_games_file:
+            csv.writer(raw_games_file).writerow(RAW_GAME_COLUMNS)
+            file_size = raw_games_file.tell()
+        ingest_state = {
+            "since": None,
+            "last_game_id": None,
+            "game_count": 0,
+            "file_size": file_size,
         }
-        # Add the game summary dictionary to the list
-        game_list.append(game_summary_dict)
-    return game_list
+    ingest_state["complete"] = False
+    write_ingest_state(lichess_username, ingest_state)
+    persona_registry.record(lichess_username, RAW_ARTIFACT, get_file_artifact(
+        raw_games_path, complete=False, game_count=ingest_state["game_count"]))
+
+    added_game_count = 0
+    with open(raw_games_path, "r+", newline="") as raw_games_file:
+        # Drop anything written after the last complete chunk of an interrupted run
+        raw_games_file.truncate(ingest_state["file_size"])
+        raw_games_file.seek(ingest_state["file_size"])
+        csv_writer = csv.writer(raw_games_file)
+
+        def write_chunk(game_chunk: list[dict]):
+            if not game_chunk:
+                return
+            for game in game_chunk:
+                csv_writer.writerow([
+                    ingest_state["game_count"],
+                    game["game_id"],
+                    game["white_player"],
+                    game["black_player"],
+                    game["winning_player"],
+                    game["move_list"],
+                    game["created_at"],
+                ])
+                ingest_state["game_count"] += 1
+            raw_games_file.flush()
+            os.fsync(raw_games_file.fileno())
+            ingest_state["file_size"] = raw_games_file.tell()
+            ingest_state["since"] = game_chunk[-1]["created_at"]
+            ingest_state["last_game_id"] = game_chunk[-1]["game_id"]
+            write_ingest_state(lichess_username, ingest_state)
+            if on_chunk_written is not None:
+                on_chunk_written(ingest_state["game_count"])
+
+        game_chunk = []
+        for game in iter_games_and_moves_by_username(
+            lichess_username,
+            since=ingest_state["since"],
+            sort="dateAsc",
+            export_games=export_games
+        ):
+            # since is inclusive, so the newest stored game comes back once
+            if game["game_id"] == ingest_state["last_game_id"]:
+                continue
+            game_chunk.append(game)
+            added_game_count += 1
+            if len(game_chunk) >= INGEST_CHUNK_SIZE:
+                write_chunk(game_chunk)
+                game_chunk = []
+        write_chunk(game_chunk)
+
+    ingest_state["complete"] = True
+    write_ingest_state(lichess_username, ingest_state)
+    persona_registry.record(lichess_username, RAW_ARTIFACT, get_file_artifact(
+        raw_games_path, complete=True, game_count=ingest_state["game_count"]))
+    return added_game_count
+
+
+def write_move_tree(lichess_username: str):
+    """
+    Rebuild the move tree (opening book) file of a user from their raw game history file, one game at a time.
+
+    Args:
+        lichess_username (str): The Lichess username of the user.
+    """
+    opening_book_builder = OpeningBookBuilder()
+    with open(get_raw_games_path(lichess_username), "r", newline="") as raw_games_file:
+        for game in csv.DictReader(raw_games_file):
+            opening_book_builder.add_game(
+                game["move_list"].split(" "),
+                user_plays_white=game["white_player"] == lichess_username
+            )
+    move_tree_file_path = get_move_tree_path(lichess_username)
+    opening_book_builder.write(move_tree_file_path)
+    persona_registry.record(lichess_username, MOVE_TREE_ARTIFACT,
+                            get_file_artifact(move_tree_file_path))
 
 
 def get_cached_usernames() -> set[str]:
@@ -90,18 +384,8 @@ def get_cached_usernames() -> set[str]:
     Returns:
         set[str]: A set of usernames.
     """
-    # Get the list of CSV files in the raw data directory
-    csv_list = os.listdir("../data/raw")
-    csv_list = [csv_file for csv_file in csv_list if csv_file.endswith(".csv")]
-    cached_username_set = set()
-    # Loop through each CSV file
-    for csv_file in csv_list:
-        # Extract the username from the file name
-        username = csv_file.replace("games_", "")
-        username = username.replace(".csv", "")
-        # Add the username to the set
-        cached_username_set.add(username)
-    return cached_username_set
+    # Users whose ingestion has finished and whose opening book exists, from the persona registry
+    return persona_registry.cloned_usernames()
 
 
 def preprocess_lichess_export_data(lichess_username: str) -> list[dict]:
@@ -178,41 +462,34 @@ def make_prediction_using_model(moves_in_san_str: str, lichess_username: str) ->
     Returns:
         str: The predicted move.
     """
-    # Define the paths of the model config, weights, tokenizer, and label encoder
-    model_config_path = f"../models/{lichess_username}/model_arch.json"
-    model_weights_path = f"../models/{lichess_username}/model_weights.h5"
-    tokenizer_path = f"../models/{lichess_username}/tokenizer.pickle"
-    label_encoder_path = f"../models/{lichess_username}/label_encoder.pickle"
-
-    # Load the model config and weights
-    with open(model_config_path, "r") as model_config_file:
-        model_config = model_config_file.read()
-    model = model_from_json(model_config)
-    model.load_weights(model_weights_path)
-
-    # Load the tokenizer and label encoder
-    with open(tokenizer_path, "rb") as tokenizer_file:
-        tokenizer = pickle.load(tokenizer_file)
-    with open(label_encoder_path, "rb") as label_encoder_file:
-        label_encoder = pickle.load(label_encoder_file)
-
-    # Compile the model
-    model.compile(
-        loss="categorical_crossentropy",
-        optimizer="adam",
-        metrics=["accuracy"]
+    # Make a prediction using the model, batched with concurrent requests for the same user
+    persona_model, prediction = inference_scheduler.predict(
+        lichess_username,
+        moves_in_san_str
     )
+    return persona_model.decode(prediction)
+
 
-    # Preprocess the moves
-    moves_in_san_str = moves_in_san_str.strip()
-    sequence = tokenizer.texts_to_sequences([moves_in_san_str])
-    padded_sequence = pad_sequences(
-        sequence,
-        maxlen=MAX_SEQUENCE_LENGTH,
-        padding="pre"
+def make_ranked_prediction_using_model(
+    moves_in_san_str: str,
+    lichess_username: str,
+    legal_move_list: list[str],
+    top_k: int
+) -> list[tuple[str, float]]:
+    """
+    Make a prediction using the model of a user, restricted to the legal moves of the position.
+
+    Args:
+        moves_in_san_str (str): The moves in Standard Algebraic Notation (SAN) string.
+        lichess_username (str): The Lichess username of the user.
+        legal_move_list (list[str]): The legal moves of the position in SAN.
+        top_k (int): The number of moves to return.
+
+    Returns:
+        list[tuple[str, float]]: The most likely legal moves and their probabilities, best first.
+    """
+    persona_model, prediction = inference_scheduler.predict(
+        lichess_username,
+        moves_in_san_str
     )
-    # Make a prediction using the model
-    prediction = model.predict(padded_sequence)
-    predicted_move_index = np.argmax(prediction)
-    predicted_move = label_encoder.inverse_transform([predicted_move_index])
-    return str(predicted_move[0]).strip()
+    return persona_model.decode_legal(prediction, legal_move_list, top_k)
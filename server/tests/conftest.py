@@ -0,0 +1,7 @@
+import os
+import sys
+
+# Server modules import each other by bare name, as they do when run from server/
+SERVER_DIRECTORY = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if SERVER_DIRECTORY not in sys.path:
+    sys.path.insert(0, SERVER_DIRECTORY)
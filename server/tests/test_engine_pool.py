@@ -0,0 +1,167 @@
+import os
+import threading
+import time
+
+import chess
+import pytest
+
+from engine_pool import EngineError, EnginePool, UCIEngine
+
+FAKE_UCI_ENGINE_PATH = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "scripts", "fake_uci_engine.py")
+
+
+def get_expected_move(move_list_in_uci: list[str]) -> str:
+    """Return the move the fake engine answers: the first legal move in UCI order."""
+    board = chess.Board()
+    for move in move_list_in_uci:
+        board.push_uci(move)
+    return min(move.uci() for move in board.legal_moves)
+
+
+def record_commands(engine: UCIEngine, monkeypatch) -> list[str]:
+    """Record every command sent to an engine from now on."""
+    command_list = []
+    send = engine._send
+
+    def record_and_send(command: str):
+        command_list.append(command)
+        send(command)
+
+    monkeypatch.setattr(engine, "_send", record_and_send)
+    return command_list
+
+
+@pytest.fixture
+def engine_pool():
+    engine_pool = EnginePool(FAKE_UCI_ENGINE_PATH, 2)
+    yield engine_pool
+    while not engine_pool._idle_engines.empty():
+        engine_pool._idle_engines.get_nowait().quit()
+
+
+def test_checkout_gives_each_request_its_own_engine(engine_pool):
+    game_list = [
+        ["e2e4", "e7e5", "g1f3"],
+        ["d2d4", "d7d5", "c2c4", "e7e6"],
+    ]
+    result_dict = {}
+    # Both requests hold their engine while the other one searches
+    barrier = threading.Barrier(len(game_list))
+
+    def play(game_index: int, skill_level: int):
+        with engine_pool.checkout(timeout=5) as engine:
+            engine.configure(skill_level=skill_level, depth=3)
+            barrier.wait(timeout=5)
+            move_list = []
+            for move in game_list[game_index]:
+                move_list.append(move)
+                assert engine.best_move(move_list) == get_expected_move(move_list)
+            result_dict[game_index] = (id(engine), engine.skill_level)
+
+    thread_list = [
+        threading.Thread(target=play, args=(game_index, skill_level))
+        for game_index, skill_level in ((0, 3), (1, 17))
+    ]
+    for thread in thread_list:
+        thread.start()
+    for thread in thread_list:
+        thread.join()
+
+    assert result_dict[0][0] != result_dict[1][0]
+    assert result_dict[0][1] == 3
+    assert result_dict[1][1] == 17
+
+
+def test_configure_sends_skill_level_and_depth_of_the_request(engine_pool, monkeypatch):
+    with engine_pool.checkout() as engine:
+        command_list = record_commands(engine, monkeypatch)
+        engine.configure(skill_level=5, depth=7)
+        engine.best_move(["e2e4"])
+        # Out of range skill levels are clamped, unchanged ones are not resent
+        engine.configure(skill_level=35, depth=2)
+        engine.configure(skill_level=20, depth=4)
+        engine.best_move([])
+
+    assert command_list == [
+        "setoption name Skill Level value 5",
+        "position startpos moves e2e4",
+        "go depth 7",
+        "setoption name Skill Level value 20",
+        "position startpos",
+        "go depth 4",
+    ]
+
+
+def test_killed_engine_is_restarted(engine_pool):
+    with pytest.raises(EngineError):
+        with engine_pool.checkout() as engine:
+            engine.process.kill()
+            engine.process.wait()
+            engine.best_move([])
+
+    # The failed checkout was replaced with a fresh process
+    with engine_pool.checkout() as engine:
+        assert engine.is_alive()
+        assert engine.best_move([]) == get_expected_move([])
+        # Also when an idle engine dies between requests
+        idle_engine = engine
+    idle_engine.process.kill()
+    idle_engine.process.wait()
+    with engine_pool.checkout() as engine:
+        assert engine is not idle_engine
+        assert engine.best_move(["e2e4"]) == get_expected_move(["e2e4"])
+    assert engine_pool.stats()["restarts"] == 2
+
+
+def test_failed_restart_is_retried_on_next_checkout(engine_pool, monkeypatch):
+    with engine_pool.checkout() as engine:
+        dead_engine = engine
+        monkeypatch.setattr(engine_pool, "engine_path", os.path.join(
+            os.path.dirname(FAKE_UCI_ENGINE_PATH), "missing_engine"))
+        engine.process.kill()
+        engine.process.wait()
+    assert dead_engine.needs_restart
+
+    monkeypatch.setattr(engine_pool, "engine_path", FAKE_UCI_ENGINE_PATH)
+    with engine_pool.checkout() as engine:
+        assert engine is not dead_engine
+        assert engine.best_move([]) == get_expected_move([])
+
+
+def test_health_check_restarts_dead_idle_engines(engine_pool):
+    with engine_pool.checkout() as first_engine, engine_pool.checkout() as second_engine:
+        engine_list = [first_engine, second_engine]
+    engine_list[0].process.kill()
+    engine_list[0].process.wait()
+
+    engine_pool.health_check()
+
+    stats_dict = engine_pool.stats()
+    assert stats_dict["restarts"] == 1
+    assert stats_dict["idle"] == 2
+    idle_engine_list = list(engine_pool._idle_engines.queue)
+    assert engine_list[0] not in idle_engine_list
+    assert engine_list[1] in idle_engine_list
+    assert all(engine.is_alive() for engine in idle_engine_list)
+
+
+def test_checkout_times_out_when_pool_is_exhausted(engine_pool):
+    with engine_pool.checkout(), engine_pool.checkout():
+        start_time = time.monotonic()
+        with pytest.raises(EngineError, match="No engine became available"):
+            with engine_pool.checkout(timeout=0.2):
+                pass
+        assert time.monotonic() - start_time >= 0.2
+    # The held engines went back to the pool
+    with engine_pool.checkout(timeout=0.2) as engine:
+        assert engine.is_alive()
+
+
+def test_best_move_searches_from_a_fen(engine_pool, monkeypatch):
+    board = chess.Board()
+    board.push_uci("e2e4")
+    with engine_pool.checkout() as engine:
+        command_list = record_commands(engine, monkeypatch)
+        assert engine.best_move(["e7e5"], start_fen=board.fen()) == get_expected_move(["e2e4", "e7e5"])
+    assert command_list[0] == f"position fen {board.fen()} moves e7e5"
@@ -0,0 +1,103 @@
+import pytest
+
+# The move pipeline imports the data scripts, which need tqdm
+pytest.importorskip("tqdm")
+
+import chess_client
+import game_session as game_session_module
+
+from chess_client import ChessClient
+from engine_cache import EngineCache
+from engine_pool import EngineError, EnginePool, UCIEngine
+from game_session import GameSession, PersonaNotFoundError
+from opening_book import OpeningBook, OpeningBookBuilder
+from tests.test_engine_pool import FAKE_UCI_ENGINE_PATH, get_expected_move
+
+USERNAME = "tester"
+
+
+@pytest.fixture
+def engine_pool(tmp_path, monkeypatch):
+    engine_pool = EnginePool(FAKE_UCI_ENGINE_PATH, 1)
+    monkeypatch.setattr(chess_client, "get_engine_pool", lambda: engine_pool)
+    monkeypatch.setattr(chess_client, "engine_cache", EngineCache(str(tmp_path / "engine_cache.sqlite"), 1_000))
+    yield engine_pool
+    while not engine_pool._idle_engines.empty():
+        engine_pool._idle_engines.get_nowait().quit()
+
+
+@pytest.fixture
+def opening_book(tmp_path) -> OpeningBook:
+    # A book the user never played into, so every move comes from the model or the engine
+    move_tree_path = str(tmp_path / "move_tree.bin")
+    OpeningBookBuilder().write(move_tree_path)
+    return OpeningBook(move_tree_path)
+
+
+@pytest.fixture
+def no_model(monkeypatch):
+    def predict_using_model(self, partial_sequence_str: str):
+        raise FileNotFoundError(f"No model for {self.lichess_username}")
+
+    monkeypatch.setattr(ChessClient, "predict_using_model", predict_using_model)
+
+
+def test_failed_engine_search_does_not_keep_the_engine(engine_pool, opening_book, no_model, monkeypatch):
+    client = ChessClient(move_list_in_san=["e4", "e5"], lichess_username=USERNAME)
+    best_move = UCIEngine.best_move
+
+    def crash_once(engine: UCIEngine, move_list_in_uci: list[str], start_fen: str = None) -> str:
+        monkeypatch.setattr(UCIEngine, "best_move", best_move)
+        engine.process.kill()
+        engine.process.wait()
+        raise EngineError("Engine process exited")
+
+    monkeypatch.setattr(UCIEngine, "best_move", crash_once)
+    with pytest.raises(EngineError):
+        client.compute_next_move(opening_book)
+    assert client.engine is None
+
+    # The next move checks out the restarted engine instead of the dead one
+    result = client.compute_next_move(opening_book)
+    assert result["predicted_move"] == get_expected_move(client.move_list_in_uci)
+    assert engine_pool.stats()["restarts"] == 1
+
+
+def test_failed_reply_takes_back_the_move_of_the_user(engine_pool, opening_book, no_model, monkeypatch):
+    game_session = GameSession(USERNAME, ["e4", "e5"])
+    opening_book_list = []
+
+    def get_missing_opening_book(lichess_username: str) -> OpeningBook:
+        if not opening_book_list:
+            raise FileNotFoundError(f"No opening book for {lichess_username}")
+        return opening_book_list[0]
+
+    monkeypatch.setattr(game_session_module, "get_opening_book", get_missing_opening_book)
+    with pytest.raises(PersonaNotFoundError):
+        game_session.play("Nf3")
+    assert game_session.chess_client.move_list_in_san == ["e4", "e5"]
+    assert game_session.to_dict()["ply_count"] == 2
+
+    # The retry of the same move is played as if the first attempt never happened
+    opening_book_list.append(opening_book)
+    state = game_session.play("Nf3")
+    assert state["ply_count"] == 4
+    assert state["reply"]["source"] == "stockfish"
+
+
+def test_pop_san_restores_the_state_of_the_shorter_game(engine_pool, opening_book, no_model):
+    move_list_in_san = ["e4", "e5", "Nf3", "Nc6", "Bb5", "a6", "Bxc6", "dxc6"]
+    client = ChessClient(move_list_in_san=move_list_in_san, lichess_username=USERNAME)
+    client.compute_next_move(opening_book)
+
+    for ply_count in range(len(move_list_in_san) - 1, 2, -1):
+        assert client.pop_san() == move_list_in_san[ply_count]
+        shorter_client = ChessClient(move_list_in_san=move_list_in_san[:ply_count], lichess_username=USERNAME)
+        assert client.board == shorter_client.board
+        assert client.move_list_in_uci == shorter_client.move_list_in_uci
+        assert client.normalized_san_list == shorter_client.normalized_san_list
+        assert client.reset_ply_list == shorter_client.reset_ply_list
+        assert client.reset_fen_list == shorter_client.reset_fen_list
+        assert client.position_key_list == shorter_client.position_keys()
+        assert client.compute_next_move(opening_book) == shorter_client.compute_next_move(opening_book)
+        assert client.player_score == shorter_client.player_score
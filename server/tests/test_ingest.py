@@ -0,0 +1,207 @@
+import csv
+import os
+
+import pytest
+
+from constants import ANONYMOUS_PLAYER
+
+# The export goes through tqdm, a server dependency
+pytest.importorskip("tqdm")
+
+from scripts import util
+from scripts.util import (
+    RAW_GAME_COLUMNS,
+    get_ingest_state_path,
+    get_raw_games_path,
+    ingest_games_by_username,
+    iter_games_and_moves_by_username,
+    iter_local_games_by_username,
+    read_ingest_state,
+)
+
+USERNAME = "tester"
+
+
+def make_game(game_index: int, created_at: int = None) -> dict:
+    """Return a game as the Berserk export yields it."""
+    return {
+        "id": f"game{game_index:04d}",
+        "variant": "standard",
+        "players": {
+            "white": {"user": {"name": USERNAME}},
+            "black": {"user": {"name": f"opponent{game_index}"}},
+        },
+        "winner": "white",
+        "moves": "e4 e5 Nf3",
+        "createdAt": created_at if created_at is not None else 1_000 * (game_index + 1),
+    }
+
+
+class FakeExport:
+    """
+    A stand-in for export_by_player that serves a fixed game list, oldest
+    first, from since (inclusive), and can fail after a number of games.
+    """
+
+    def __init__(self, game_list: list[dict], fail_after: int = None):
+        self.game_list = game_list
+        self.fail_after = fail_after
+        self.call_list = []
+
+    def __call__(self, username: str, since: int = None, sort: str = None, max: int = None, **kwargs):
+        self.call_list.append({"username": username, "since": since, "sort": sort})
+        assert sort == "dateAsc"
+        return self._iter_games(since)
+
+    def _iter_games(self, since: int):
+        for yielded_game_count, game in enumerate(
+                game for game in self.game_list if since is None or game["createdAt"] >= since):
+            if self.fail_after is not None and yielded_game_count >= self.fail_after:
+                raise ConnectionError("Export stream broke")
+            yield game
+
+
+def read_game_ids() -> list[str]:
+    """Return the game IDs of the raw game history file, in file order."""
+    with open(get_raw_games_path(USERNAME), "r", newline="") as raw_games_file:
+        return [game["game_id"] for game in csv.DictReader(raw_games_file)]
+
+
+@pytest.fixture(autouse=True)
+def data_directory(tmp_path, monkeypatch):
+    # Paths are relative to server/, next to the data directory
+    (tmp_path / "data" / "raw").mkdir(parents=True)
+    (tmp_path / "server").mkdir()
+    monkeypatch.chdir(tmp_path / "server")
+    monkeypatch.setattr(util, "INGEST_CHUNK_SIZE", 2)
+    return tmp_path / "data"
+
+
+def test_games_are_written_in_fsynced_chunks(monkeypatch):
+    fsync_list = []
+    fsync = os.fsync
+    raw_games_path = get_raw_games_path(USERNAME)
+
+    def record_fsync(file_descriptor: int):
+        # Files are told apart by inode, since the state file is replaced on every write
+        fsync_list.append(os.fstat(file_descriptor).st_ino)
+        fsync(file_descriptor)
+
+    monkeypatch.setattr(os, "fsync", record_fsync)
+    chunk_list = []
+
+    def check_chunk(game_count: int):
+        # The chunk is synced and the state points at its end before the callback runs
+        ingest_state = read_ingest_state(USERNAME)
+        chunk_list.append((game_count, len(read_game_ids())))
+        assert ingest_state["game_count"] == game_count
+        assert ingest_state["file_size"] == os.path.getsize(raw_games_path)
+        assert fsync_list.count(os.stat(raw_games_path).st_ino) == len(chunk_list)
+
+    added_game_count = ingest_games_by_username(
+        USERNAME, export_games=FakeExport([make_game(i) for i in range(5)]), on_chunk_written=check_chunk)
+
+    assert added_game_count == 5
+    assert chunk_list == [(2, 2), (4, 4), (5, 5)]
+    assert read_game_ids() == [f"game{i:04d}" for i in range(5)]
+    ingest_state = read_ingest_state(USERNAME)
+    assert ingest_state["complete"]
+    assert ingest_state["since"] == 5_000
+    assert ingest_state["last_game_id"] == "game0004"
+
+
+def test_refresh_exports_games_since_the_high_water_mark():
+    game_list = [make_game(i) for i in range(3)]
+    ingest_games_by_username(USERNAME, export_games=FakeExport(game_list))
+
+    # A new game in the same millisecond as the newest stored one, and a later game
+    game_list += [make_game(3, created_at=3_000), make_game(4)]
+    fake_export = FakeExport(game_list)
+    added_game_count = ingest_games_by_username(USERNAME, export_games=fake_export)
+
+    assert fake_export.call_list == [{"username": USERNAME, "since": 3_000, "sort": "dateAsc"}]
+    assert added_game_count == 2
+    assert read_game_ids() == [f"game{i:04d}" for i in range(5)]
+    assert read_ingest_state(USERNAME)["game_count"] == 5
+
+
+def test_interrupted_ingestion_resumes_without_duplicates_or_gaps():
+    game_list = [make_game(i) for i in range(7)]
+    with pytest.raises(ConnectionError):
+        ingest_games_by_username(USERNAME, export_games=FakeExport(game_list, fail_after=5))
+
+    # Only complete chunks are recorded; the fifth game was still buffered
+    ingest_state = read_ingest_state(USERNAME)
+    assert not ingest_state["complete"]
+    assert ingest_state["game_count"] == 4
+    # A crash can leave half a row after the last complete chunk
+    with open(get_raw_games_path(USERNAME), "a") as raw_games_file:
+        raw_games_file.write("4,game0004,tes")
+
+    fake_export = FakeExport(game_list)
+    added_game_count = ingest_games_by_username(USERNAME, export_games=fake_export)
+
+    assert fake_export.call_list[0]["since"] == 4_000
+    assert added_game_count == 3
+    assert read_game_ids() == [f"game{i:04d}" for i in range(7)]
+    with open(get_raw_games_path(USERNAME), "r", newline="") as raw_games_file:
+        assert [int(game[""]) for game in csv.DictReader(raw_games_file)] == list(range(7))
+    assert read_ingest_state(USERNAME)["complete"]
+
+
+def test_legacy_raw_file_is_migrated():
+    # Files written before incremental ingestion have no created_at column and no state
+    with open(get_raw_games_path(USERNAME), "w", newline="") as raw_games_file:
+        csv_writer = csv.writer(raw_games_file)
+        csv_writer.writerow(RAW_GAME_COLUMNS[:-1])
+        csv_writer.writerow([0, "legacy", USERNAME, "someone", USERNAME, "d4 d5"])
+    assert not os.path.exists(get_ingest_state_path(USERNAME))
+
+    fake_export = FakeExport([make_game(i) for i in range(3)])
+    added_game_count = ingest_games_by_username(USERNAME, export_games=fake_export)
+
+    assert fake_export.call_list[0]["since"] is None
+    assert added_game_count == 3
+    with open(get_raw_games_path(USERNAME), "r", newline="") as raw_games_file:
+        csv_reader = csv.reader(raw_games_file)
+        assert next(csv_reader) == RAW_GAME_COLUMNS
+        assert [row[1] for row in csv_reader] == [f"game{i:04d}" for i in range(3)]
+    assert read_ingest_state(USERNAME)["complete"]
+
+
+def test_local_games_are_served_oldest_first():
+    ingest_games_by_username(USERNAME, export_games=FakeExport([make_game(i) for i in range(5)]))
+
+    game_list = list(iter_local_games_by_username(USERNAME, since=2_000, limit=3))
+
+    assert [game["game_id"] for game in game_list] == ["game0001", "game0002", "game0003"]
+    assert [game["created_at"] for game in game_list] == [2_000, 3_000, 4_000]
+
+
+def test_legacy_raw_file_is_served_oldest_first():
+    # The old exporter wrote the newest game first and no ingestion state
+    with open(get_raw_games_path(USERNAME), "w", newline="") as raw_games_file:
+        csv_writer = csv.writer(raw_games_file)
+        csv_writer.writerow(RAW_GAME_COLUMNS[:-1])
+        for row_index, game_index in enumerate(range(4, -1, -1)):
+            csv_writer.writerow([row_index, f"game{game_index:04d}", USERNAME, "someone", USERNAME, "d4 d5"])
+
+    assert [game["game_id"] for game in iter_local_games_by_username(USERNAME)] == \
+        [f"game{i:04d}" for i in range(5)]
+    assert [game["game_id"] for game in iter_local_games_by_username(USERNAME, limit=2)] == \
+        ["game0000", "game0001"]
+
+
+def test_players_without_an_account_are_named_the_same_from_both_sources():
+    game = make_game(0)
+    del game["players"]["black"]["user"]
+    game["winner"] = "black"
+    ingest_games_by_username(USERNAME, export_games=FakeExport([game]))
+
+    exported_game_list = list(iter_games_and_moves_by_username(
+        USERNAME, sort="dateAsc", export_games=FakeExport([game])))
+    local_game_list = list(iter_local_games_by_username(USERNAME))
+
+    assert exported_game_list == local_game_list
+    assert local_game_list[0]["black_player"] == ANONYMOUS_PLAYER
+    assert local_game_list[0]["winning_player"] == ANONYMOUS_PLAYER
@@ -0,0 +1,127 @@
+import asyncio
+import threading
+import time
+
+import pytest
+
+# The client talks to the stand-in server through the Gemini SDK
+pytest.importorskip("google.generativeai")
+
+import llm_client
+
+from llm_client import LLMClient
+from scripts.fake_llm_server import FakeLLMServer
+
+
+@pytest.fixture
+def fake_llm_server(monkeypatch):
+    fake_llm_server = FakeLLMServer(("127.0.0.1", 0))
+    server_thread = threading.Thread(target=fake_llm_server.serve_forever, daemon=True)
+    server_thread.start()
+    monkeypatch.setattr(llm_client, "GEMINI_API_KEY", "stub")
+    monkeypatch.setattr(llm_client, "LLM_API_ENDPOINT",
+                        f"http://127.0.0.1:{fake_llm_server.server_address[1]}")
+    yield fake_llm_server
+    fake_llm_server.shutdown()
+    fake_llm_server.server_close()
+    server_thread.join()
+
+
+def prompt_concurrently(client: LLMClient, text_list: list[str]) -> list:
+    """Send every prompt from its own thread at the same time and return the responses in order."""
+    response_list = [None] * len(text_list)
+    barrier = threading.Barrier(len(text_list))
+
+    def prompt(text_index: int):
+        barrier.wait(timeout=5)
+        response_list[text_index] = client.prompt_blocking(text_list[text_index])
+
+    thread_list = [threading.Thread(target=prompt, args=(text_index,)) for text_index in range(len(text_list))]
+    for thread in thread_list:
+        thread.start()
+    for thread in thread_list:
+        thread.join()
+    return response_list
+
+
+def test_identical_concurrent_prompts_share_one_request(fake_llm_server):
+    fake_llm_server.delay_seconds = 0.3
+    client = LLMClient(timeout_seconds=5)
+
+    response_list = prompt_concurrently(client, ["Same prompt"] * 8)
+
+    assert response_list == ["Echo: Same prompt"] * 8
+    assert fake_llm_server.stats()["requests"] == 1
+    stats_dict = client.stats()
+    assert stats_dict["requests"] == 1
+    assert stats_dict["coalesced"] == 7
+
+
+def test_identical_concurrent_async_prompts_share_one_request(fake_llm_server):
+    fake_llm_server.delay_seconds = 0.3
+    client = LLMClient(timeout_seconds=5)
+
+    async def prompt_all() -> list[str]:
+        return await asyncio.gather(*(client.prompt("Same prompt") for _ in range(8)))
+
+    assert asyncio.run(prompt_all()) == ["Echo: Same prompt"] * 8
+    assert fake_llm_server.stats()["requests"] == 1
+
+
+def test_responses_are_cached_per_prompt_and_settings_until_they_expire(fake_llm_server):
+    client = LLMClient(timeout_seconds=5, cache_ttl_seconds=0.5)
+
+    assert client.prompt_blocking("First") == "Echo: First"
+    assert client.prompt_blocking("First") == "Echo: First"
+    assert fake_llm_server.stats()["requests"] == 1
+    # Settings are part of the key, whatever their order
+    client.prompt_blocking("First", generation_config={"temperature": 0.5, "top_k": 3})
+    client.prompt_blocking("First", generation_config={"top_k": 3, "temperature": 0.5})
+    client.prompt_blocking("Second")
+    assert fake_llm_server.stats()["requests"] == 3
+    assert client.stats()["hits"] == 2
+
+    time.sleep(0.6)
+    client.prompt_blocking("First")
+    assert fake_llm_server.stats()["requests"] == 4
+
+
+def test_in_flight_requests_are_bounded(fake_llm_server):
+    fake_llm_server.delay_seconds = 0.2
+    client = LLMClient(max_concurrent_requests=2, timeout_seconds=5)
+
+    response_list = prompt_concurrently(client, [f"Prompt {index}" for index in range(6)])
+
+    assert response_list == [f"Echo: Prompt {index}" for index in range(6)]
+    assert fake_llm_server.stats() == {"requests": 6, "max_in_flight": 2}
+
+
+def test_slow_response_raises_timeout_and_is_not_cached(fake_llm_server):
+    fake_llm_server.delay_seconds = 1.0
+    client = LLMClient(timeout_seconds=0.3)
+
+    start_time = time.monotonic()
+    with pytest.raises(TimeoutError):
+        client.prompt_blocking("Slow prompt")
+    assert time.monotonic() - start_time < 0.9
+    stats_dict = client.stats()
+    assert stats_dict["timeouts"] == 1
+    assert stats_dict["cached_responses"] == 0
+    assert stats_dict["in_flight"] == 0
+
+    # The next attempt is sent again rather than served a cached failure
+    fake_llm_server.delay_seconds = 0.0
+    assert client.prompt_blocking("Slow prompt") == "Echo: Slow prompt"
+
+
+def test_waiting_for_a_request_slot_counts_against_the_timeout(fake_llm_server):
+    client = LLMClient(max_concurrent_requests=1, timeout_seconds=0.2)
+    # Another prompt holds the only slot
+    client._semaphore.acquire()
+    try:
+        with pytest.raises(TimeoutError, match="No free LLM request slot"):
+            client.prompt_blocking("Queued prompt")
+    finally:
+        client._semaphore.release()
+    assert fake_llm_server.stats()["requests"] == 0
+    assert client.stats()["timeouts"] == 1
@@ -25,6 +25,7 @@ import { TextGenerateEffect } from "../components/ui/text-generate-effect";
 
 // Constants
 const LOADER_DURATION = 3000;
+const JOB_POLL_INTERVAL = 2000;
 
 /**
  * Function to get loading states
@@ -140,7 +141,18 @@ export default function SplashPage() {
 
     const endpointUrl = `/train/persona/${lichessUsername}`;
     const apiResponse = await axios.get(endpointUrl);
-    const apiResponseData = apiResponse.data;
+    let apiResponseData = apiResponse.data;
+    // Training runs in the background, so poll its job until it finishes
+    while (
+      apiResponseData["status"] === "CLONING_QUEUED" ||
+      apiResponseData["status"] === "CLONING_IN_PROGRESS"
+    ) {
+      await new Promise((resolve) => setTimeout(resolve, JOB_POLL_INTERVAL));
+      const jobResponse = await axios.get(
+        `/train/jobs/${apiResponseData["job_id"]}`
+      );
+      apiResponseData = jobResponse.data;
+    }
     const cloningStatus = apiResponseData["status"];
     if (cloningStatus === "CLONING_COMPLETE") {
       navigate("game", {